@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+from itertools import product
+import random
+import time
+
+from bravo.factories.beta import BravoFactory
+
+class Transport(object):
+
+    def write(self, data):
+        pass
+
+class Protocol(object):
+    """
+    A player who has the chunks in a circle around them loaded.
+    """
+
+    def __init__(self, x, z):
+        self.transport = Transport()
+        self.chunks = dict(((x + i, z + j), None)
+            for i, j in product(xrange(-10, 11), repeat=2)
+            if i**2 + j**2 <= 100)
+
+factory = BravoFactory("benchmark")
+
+# Several hundred players, spread out over a few hundred chunks each way.
+random.seed(0)
+for i in xrange(300):
+    protocol = Protocol(random.randint(-150, 150), random.randint(-150, 150))
+    factory.protocols["player%d" % i] = protocol
+    for x, z in protocol.chunks:
+        factory.subscribe_chunk(protocol, x, z)
+
+targets = [(random.randint(-150, 150), random.randint(-150, 150))
+    for i in xrange(1000)]
+
+def scan_for_chunk(packet, x, z):
+    """
+    The original broadcast, which asks every player whether they have the
+    chunk loaded.
+    """
+
+    for player in factory.protocols.itervalues():
+        if (x, z) in player.chunks:
+            player.transport.write(packet)
+
+def broadcast(f):
+    before = time.time()
+    for x, z in targets:
+        f("packet", x, z)
+    return (time.time() - before) * 1000
+
+def scan_bench():
+    l = [broadcast(scan_for_chunk) for i in xrange(25)]
+    return "broadcast_for_chunk_scan", l
+
+def indexed_bench():
+    l = [broadcast(factory.broadcast_for_chunk) for i in xrange(25)]
+    return "broadcast_for_chunk_indexed", l
+
+benchmarks = [scan_bench, indexed_bench]
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 
+from itertools import product
 import time
 
+from numpy import cast, logical_not, logical_and, transpose, zeros, amax
+from numpy import uint8, vectorize
+from numpy.testing import assert_array_equal
+
+from bravo.blocks import blocks
 from bravo.chunk import Chunk
 from bravo.ibravo import ITerrainGenerator
-from bravo.plugin import retrieve_plugins
+from bravo.plugin import retrieve_plugins, retrieve_named_plugins
 
 def timed(f):
     def wrapped(*args, **kwargs):
@@ -27,13 +33,124 @@ def repeated_seeds(i, p):
     chunk = Chunk(i, i)
     p.populate(chunk, 0)
 
+def reference_skylight(chunk):
+    """
+    The original, pure-Python skylight algorithm.
+
+    This is kept around to check the vectorized skylight against. The
+    changes from the original are that dimming saturates at zero instead of
+    wrapping around, and that light reaching a block only ever brightens it.
+    The original could darken a block which dims light, such as water, when
+    dimmer light reached it later, and turned light away from blocks which
+    were waiting to spread their own light at a dimmer glow level, leaving
+    them darker than their brightest neighbour allows.
+    """
+
+    lightmap = zeros((16, 16, 128), dtype=uint8)
+
+    for x, z in product(xrange(16), repeat=2):
+        light = 0xf
+        height = chunk.heightmap[x, z] + 1
+        lightmap[x, z, height:] = light
+
+        for y in range(height, -1, -1):
+            dim = blocks[chunk.blocks[x, z, y]].dim
+            light -= dim
+            if light <= 0:
+                break
+
+            lightmap[x, z, y] = light
+
+    max_height = amax(chunk.heightmap)
+    lightable = vectorize(lambda block: blocks[block].dim < 15)(chunk.blocks)
+    unlighted = logical_not(lightmap) & lightable
+
+    mask = zeros((16, 16, max_height), dtype=bool)
+    mask[:-1,:,:max_height] |= unlighted[1:, :, :max_height]
+    mask[:,:-1,:max_height] |= unlighted[:, 1:, :max_height]
+    mask[1:,:,:max_height] |= unlighted[:-1, :, :max_height]
+    mask[:,1:,:max_height] |= unlighted[:, :-1, :max_height]
+
+    edges = logical_and(mask, lightmap[:, :, :max_height]).nonzero()
+
+    spread = [tuple(coords) for coords in transpose(edges)]
+    visited = set()
+    glow = 14
+
+    while glow:
+        for coords in spread:
+            if lightmap[coords] <= glow:
+                visited.add(coords)
+                continue
+
+            for dx, dz, dy in (
+                (1, 0, 0),
+                (-1, 0, 0),
+                (0, 1, 0),
+                (0, -1, 0),
+                (0, 0, 1),
+                (0, 0, -1)):
+                x, z, y = coords
+                x += dx
+                z += dz
+                y += dy
+
+                if not (0 <= x < 16 and
+                    0 <= z < 16 and
+                    0 <= y < 128):
+                    continue
+
+                if lightable[x, z, y] and lightmap[x, z, y] < glow:
+                    dim = blocks[chunk.blocks[x, z, y]].dim
+                    lightmap[x, z, y] = max(lightmap[x, z, y], glow - dim)
+                    visited.add((x, z, y))
+        glow -= 1
+        spread = visited
+        visited = set()
+
+    return cast[uint8](lightmap.clip(0, 15))
+
 plugins = retrieve_plugins(ITerrainGenerator)
+pipeline = retrieve_named_plugins(ITerrainGenerator, ["complex", "caves",
+    "erosion", "watertable", "beaches", "grass", "saplings", "safety"])
+
+def generated_chunk(i):
+    chunk = Chunk(i, i)
+    for stage in pipeline:
+        stage.populate(chunk, 0)
+    chunk.regenerate_heightmap()
+    return chunk
 
 def empty_bench():
     l = [empty_chunk(i) for i in xrange(25)]
     return "chunk_baseline", l
 
-benchmarks = [empty_bench]
+def skylight_bench():
+    l = []
+    for i in xrange(25):
+        chunk = generated_chunk(i)
+
+        before = time.time()
+        chunk.regenerate_skylight()
+        l.append((time.time() - before) * 1000)
+
+        # The vectorized skylight must be identical to the original.
+        assert_array_equal(chunk.skylight, reference_skylight(chunk))
+    return "chunk_skylight", l
+
+def blocklight_bench():
+    chunk = Chunk(0, 0)
+    chunk.blocks[:, :, :40] = blocks["lava"].slot
+    chunk.blocks[::3, ::3, 60] = blocks["torch"].slot
+
+    l = []
+    for i in xrange(25):
+        before = time.time()
+        chunk.regenerate_blocklight()
+        l.append((time.time() - before) * 1000)
+    return "chunk_blocklight", l
+
+benchmarks = [empty_bench, skylight_bench, blocklight_bench]
 for name, plugin in plugins.items():
     def seq(name=name, plugin=plugin):
         l = [sequential_seeded(i, plugin) for i in xrange(25)]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+from tempfile import mkdtemp
+import time
+
+from bravo.blocks import blocks, items
+from bravo.chunk import Chunk
+from bravo.entity import Chest, Player, Sign
+from bravo.ibravo import ITerrainGenerator
+from bravo.inventory import Slot
+from bravo.nbt import NBTFile, TAG_Compound, TAG_Double, TAG_List, TAG_Short
+from bravo.plugin import retrieve_named_plugins
+from bravo.plugins.serializers import Beta
+
+serializer = Beta("file://%s" % mkdtemp())
+
+class Level(object):
+    seed = 0
+    spawn = 0, 64, 0
+    time = 24000
+
+def level_data():
+    """
+    The level data of a world with a player in it, in the layout used by
+    Notchian level.dat files.
+    """
+
+    player = Player(username="bench")
+    for i in range(len(player.inventory.storage)):
+        player.inventory.storage[i] = Slot(blocks["stone"].slot, 0, 64)
+    for i in range(len(player.inventory.holdables)):
+        player.inventory.holdables[i] = Slot(items["iron-pickaxe"].slot,
+            i * 10, 1)
+
+    tag = serializer._save_level_to_tag(Level())
+
+    tag["Data"]["Player"] = playertag = TAG_Compound()
+    for name, values in (("Pos", (0.5, 65.62, 0.5)), ("Motion", (0, 0, 0)),
+        ("Rotation", (90.0, 0.0))):
+        playertag[name] = TAG_List(type=TAG_Double)
+        playertag[name].tags = [TAG_Double(i) for i in values]
+    for name in ("Air", "AttackTime", "DeathTime", "Fire", "Health",
+        "HurtTime"):
+        playertag[name] = TAG_Short(0)
+    playertag["Inventory"] = serializer._save_inventory_to_tag(
+        player.inventory)
+
+    return tag.render()
+
+pipeline = retrieve_named_plugins(ITerrainGenerator, ["complex", "caves",
+    "erosion", "watertable", "beaches", "grass", "saplings", "safety"])
+
+def chunk_data():
+    """
+    The data stored in a region file for a generated chunk, with a few tiles.
+    """
+
+    chunk = Chunk(0, 0)
+    for stage in pipeline:
+        stage.populate(chunk, 0)
+    chunk.regenerate()
+    chunk.populated = True
+
+    for i in range(4):
+        chunk.tiles[i, 70, i] = chest = Chest(i, 70, i)
+        chest.inventory.storage[0] = Slot(blocks["dirt"].slot, 0, 64)
+        chunk.tiles[i, 70, i + 8] = sign = Sign(i, 70, i + 8)
+        sign.text1 = "Bravo"
+
+    return serializer._save_chunk_to_tag(chunk).render()
+
+def parse(data):
+    before = time.time()
+    for i in xrange(100):
+        NBTFile().parse_data(data)
+    return (time.time() - before) * 10
+
+def render(data):
+    tag = NBTFile()
+    tag.parse_data(data)
+    before = time.time()
+    for i in xrange(100):
+        tag.render()
+    return (time.time() - before) * 10
+
+def parse_level_bench():
+    data = level_data()
+    l = [parse(data) for i in xrange(25)]
+    return "nbt_parse_level", l
+
+def render_level_bench():
+    data = level_data()
+    l = [render(data) for i in xrange(25)]
+    return "nbt_render_level", l
+
+def parse_chunk_bench():
+    data = chunk_data()
+    l = [parse(data) for i in xrange(25)]
+    return "nbt_parse_chunk", l
+
+def render_chunk_bench():
+    data = chunk_data()
+    l = [render(data) for i in xrange(25)]
+    return "nbt_render_chunk", l
+
+benchmarks = [parse_level_bench, render_level_bench, parse_chunk_bench,
+    render_chunk_bench]
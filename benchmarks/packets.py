@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import time
+
+from construct import Container
+
+from bravo.packets.beta import make_packet, packets, packets_by_name
+
+fields = {
+    "ping": {},
+    "time": {"timestamp": 24000},
+    "destroy": {"eid": 42},
+    "entity-orientation": {"eid": 42, "yaw": 64, "pitch": 12},
+    "entity-location": {"eid": 42, "x": 3, "y": -1, "z": 7, "yaw": 64,
+        "pitch": 12},
+    "teleport": {"eid": 42, "x": 1234, "y": 2100, "z": -5678, "yaw": 64,
+        "pitch": 12},
+    "prechunk": {"x": 10, "z": -10, "enabled": 1},
+    "block": {"x": 150, "y": 64, "z": -150, "type": 4, "meta": 0},
+}
+
+def build(name):
+    """
+    Build a packet with Construct, as every packet used to be built.
+    """
+
+    header = packets_by_name[name]
+    before = time.time()
+    for i in xrange(1000):
+        chr(header) + packets[header].build(Container(**fields[name]))
+    return (time.time() - before) * 1000
+
+def make(name):
+    before = time.time()
+    for i in xrange(1000):
+        make_packet(name, **fields[name])
+    return (time.time() - before) * 1000
+
+benchmarks = []
+for name in sorted(fields):
+    def built(name=name):
+        l = [build(name) for i in xrange(25)]
+        return ("packet_%s_construct" % name), l
+    def made(name=name):
+        l = [make(name) for i in xrange(25)]
+        return ("packet_%s_struct" % name), l
+    benchmarks.append(built)
+    benchmarks.append(made)
@@ -1,13 +1,15 @@
 from itertools import product
 from warnings import warn
 
-from numpy import int8, uint8, uint32, bool
-from numpy import cast, logical_not, logical_and, transpose, where, zeros, amax
-from numpy import vectorize
+from numpy import int8, uint8, uint32, int32, bool
+from numpy import cast, where, zeros, arange, ogrid, rint, roll
+from numpy import maximum
+from numpy import broadcast_to, empty, frombuffer, unique
+from numpy.fft import irfftn, rfftn
 
 from bravo.blocks import blocks, glowing_blocks
 from bravo.packets.beta import make_packet
-from bravo.utilities.bits import pack_nibbles
+from bravo.utilities.bits import pack_nibble_array, unpack_nibble_array
 
 class ChunkWarning(Warning):
     """
@@ -26,6 +28,167 @@ for i in range(16):
         glow[i][ x,  y,  z] = i + 1 - distance
     glow[i] = cast[uint8](glow[i].clip(0, 15))
 
+# Set up lighting tables.
+# These tables are indexed by block slot, so that they can be applied to an
+# entire array of blocks at once. Unknown slots are treated as opaque.
+dims = zeros(256, dtype=uint8)
+dims.fill(16)
+for block in blocks.itervalues():
+    dims[block.slot] = block.dim
+lightable = dims < 15
+
+strengths = zeros(256, dtype=uint8)
+for slot, strength in glowing_blocks.iteritems():
+    strengths[slot] = strength
+
+def fft_size(size):
+    """
+    Round a size up to the nearest multiple of 16, which is always quick to
+    transform.
+    """
+
+    return (size + 15) & ~15
+
+# Frequency-domain glow maps, for compositing many light sources at once.
+# These are built on demand, since they are fairly large, and there are only
+# ever a few of them kept around.
+glow_spectra = {}
+
+def glow_spectrum(strength, shape):
+    """
+    Get the frequency-domain glow map for a light source.
+
+    The glow map is centered on the origin and wraps around the edges of
+    the given shape.
+    """
+
+    key = strength, shape
+    if key not in glow_spectra:
+        if len(glow_spectra) >= 16:
+            glow_spectra.clear()
+
+        kernel = zeros(shape, dtype=uint32)
+        dim = 2 * strength + 1
+        kernel[:dim, :dim, :dim] = glow[strength]
+        for axis in range(3):
+            kernel = roll(kernel, -strength, axis)
+        glow_spectra[key] = rfftn(kernel)
+
+    return glow_spectra[key]
+
+def spread_light(lightmap, dimmed, lighted, frontier):
+    """
+    Spread light outwards from some blocks, in place.
+
+    Light is spread one glow level at a time. Blocks brighter than the
+    current glow level light up their darker neighbours, which then join the
+    frontier of blocks waiting to spread light at dimmer glow levels. Light
+    reaching a block only ever brightens it, even if the block is itself
+    waiting to spread light, so the lightmap may already hold light, such as
+    light kept around a region being relit.
+
+    :param `ndarray` lightmap: lightmap
+    :param `ndarray` dimmed: how much each block dims light
+    :param `ndarray` lighted: whether each block can be lit
+    :param `ndarray` frontier: boolean array marking the blocks which should
+        spread their light
+    """
+
+    reached = zeros(lightmap.shape, dtype=bool)
+
+    for glow in range(14, 0, -1):
+        # Blocks brighter than this glow level spread light to their
+        # neighbours; the rest wait for a dimmer glow level.
+        spreading = frontier & (lightmap > glow)
+        waiting = frontier ^ spreading
+
+        reached.fill(False)
+        reached[1:, :, :] |= spreading[:-1, :, :]
+        reached[:-1, :, :] |= spreading[1:, :, :]
+        reached[:, 1:, :] |= spreading[:, :-1, :]
+        reached[:, :-1, :] |= spreading[:, 1:, :]
+        reached[:, :, 1:] |= spreading[:, :, :-1]
+        reached[:, :, :-1] |= spreading[:, :, 1:]
+
+        reached &= lighted & (lightmap < glow)
+
+        # Blocks which are already brighter than the light reaching them
+        # keep their own light.
+        incoming = (glow - dimmed[reached].astype(int32)).clip(0, 0xf)
+        lightmap[reached] = maximum(lightmap[reached], incoming)
+
+        frontier = waiting | reached
+
+def unspread_light(lightmap, base, removed):
+    """
+    Take away the light which spread outwards from some blocks, in place.
+
+    The removed blocks drop to their base light, and so does every block
+    which might have been lit by them: any block dimmer than a darkened
+    neighbour, but brighter than its own base light. Blocks at least as
+    bright as a darkened neighbour are lit by something else, and can shine
+    back into the darkness.
+
+    :param `ndarray` lightmap: lightmap
+    :param `ndarray` base: light which each block keeps regardless of its
+        neighbours
+    :param `ndarray` removed: boolean array marking the blocks whose light
+        should be taken away
+    :rtype: `ndarray`
+    :returns: boolean array marking the blocks which should spread their
+        light again
+    """
+
+    levels = where(removed, lightmap, 0)
+    lightmap[removed] = base[removed]
+
+    frontier = removed.copy()
+    darkened = removed.copy()
+    relit = zeros(lightmap.shape, dtype=bool)
+    reached = zeros(lightmap.shape, dtype=bool)
+
+    for glow in range(15, 0, -1):
+        # Blocks which had this much light take it away from their
+        # neighbours; the rest wait for a dimmer glow level.
+        darkening = frontier & (levels == glow)
+        frontier ^= darkening
+
+        reached.fill(False)
+        reached[1:, :, :] |= darkening[:-1, :, :]
+        reached[:-1, :, :] |= darkening[1:, :, :]
+        reached[:, 1:, :] |= darkening[:, :-1, :]
+        reached[:, :-1, :] |= darkening[:, 1:, :]
+        reached[:, :, 1:] |= darkening[:, :, :-1]
+        reached[:, :, :-1] |= darkening[:, :, 1:]
+
+        dimmer = reached & (lightmap < glow) & (lightmap > base)
+        levels[dimmer] = lightmap[dimmer]
+        lightmap[dimmer] = base[dimmer]
+        frontier |= dimmer
+        darkened |= dimmer
+
+        relit |= reached & (lightmap >= glow)
+
+    return relit | (darkened & (lightmap != 0))
+
+def light_window(lx, lz, ux, uz, neighbors):
+    """
+    Find the part of a chunk and its neighbours within reach of light from a
+    region of the chunk, or of light shining into it.
+
+    :param dict neighbors: neighbouring chunks, keyed by their offsets
+    :returns: tuple of the lower x and z and upper x and z bounds of the
+        window, in the chunk's coordinates
+    """
+
+    xs = set(dx for dx, dz in neighbors)
+    zs = set(dz for dx, dz in neighbors)
+
+    return (max(lx - 15, -16 if -1 in xs else 0),
+        max(lz - 15, -16 if -1 in zs else 0),
+        min(ux + 15, 32 if 1 in xs else 16),
+        min(uz + 15, 32 if 1 in zs else 16))
+
 def composite_glow(target, strength, x, y, z):
     """
     Composite a light source onto a lightmap.
@@ -41,12 +204,12 @@ def composite_glow(target, strength, x, y, z):
     sy = y - strength
     sz = z - strength
 
-    ex = x + strength
-    ey = y + strength
-    ez = z + strength
+    ex = x + strength + 1
+    ey = y + strength + 1
+    ez = z + strength + 1
 
     si, sj, sk = 0, 0, 0
-    ei, ej, ek = strength * 2, strength * 2, strength * 2
+    ei, ej, ek = strength * 2 + 1, strength * 2 + 1, strength * 2 + 1
 
     if sx < 0:
         sx, si = 0, -sx
@@ -69,6 +232,167 @@ def composite_glow(target, strength, x, y, z):
     # Composite!
     target[sx:ex, sz:ez, sy:ey] += ambient[si:ei, sk:ek, sj:ej]
 
+def composite_glows(target, strength, sources):
+    """
+    Composite many light sources of the same strength onto a lightmap.
+
+    The result is exactly the same as compositing each light source in turn
+    with :func:`composite_glow`. When there are lots of light sources, they
+    are all composited at once with a convolution, which is much faster.
+
+    :param `ndarray` target: lightmap
+    :param int strength: strength of all of the light sources
+    :param `ndarray` sources: boolean array, with the same shape as the
+        lightmap, marking the light sources
+    """
+
+    coords = sources.nonzero()
+
+    if len(coords[0]) < 512:
+        for x, z, y in zip(*coords):
+            composite_glow(target, strength, x, y, z)
+        return
+
+    # Pad the convolution out far enough that the glow maps of light sources
+    # on one edge can't wrap around onto the other edge, and then a bit
+    # further, to a size which is quick to transform.
+    shape = tuple(fft_size(i + strength) for i in target.shape)
+    spectrum = rfftn(sources, shape) * glow_spectrum(strength, shape)
+    lightmap = irfftn(spectrum, shape)
+
+    xbound, zbound, ybound = target.shape
+    target += rint(lightmap[:xbound, :zbound, :ybound]).astype(target.dtype)
+
+# The per-block arrays of a chunk, and the ones which only hold nibbles.
+layers = ("blocks", "metadata", "skylight", "blocklight")
+nibble_layers = frozenset(("metadata", "skylight", "blocklight"))
+
+# Sections which hold a single value throughout are stored as read-only
+# views of that value, shared between all chunks.
+uniform_sections = [broadcast_to(uint8(i), (16, 16, 16)) for i in range(256)]
+uniform_nibble_sections = [broadcast_to(uint8(i << 4 | i), (16, 16, 8))
+    for i in range(16)]
+
+def split_sections(array, packed=False):
+    """
+    Split a chunk array into 16-high sections.
+
+    Only the low nibble of each value is kept in nibble-packed sections.
+
+    :param `ndarray` array: chunk array
+    :param bool packed: whether to nibble-pack the sections
+    :rtype: list
+    :returns: sections, from the bottom of the chunk upwards
+    """
+
+    # Empty arrays are common enough, and cheap enough to spot, to skip the
+    # section-by-section scan.
+    if not array.any():
+        if packed:
+            return [uniform_nibble_sections[0]] * 8
+        else:
+            return [uniform_sections[0]] * 8
+
+    sections = []
+
+    for y in range(0, 128, 16):
+        section = array[:, :, y:y + 16]
+        value = section[0, 0, 0]
+        if (section == value).all():
+            if packed:
+                sections.append(uniform_nibble_sections[value & 0xf])
+            else:
+                sections.append(uniform_sections[value])
+        elif packed:
+            sections.append(pack_nibble_array(section))
+        else:
+            sections.append(section.copy())
+
+    return sections
+
+def split_packed_sections(array):
+    """
+    Split a nibble-packed chunk array into nibble-packed sections.
+
+    :param `ndarray` array: nibble-packed chunk array
+    :rtype: list
+    :returns: sections, from the bottom of the chunk upwards
+    """
+
+    if not array.any():
+        return [uniform_nibble_sections[0]] * 8
+
+    sections = []
+
+    for y in range(0, 64, 8):
+        section = array[:, :, y:y + 8]
+        value = section[0, 0, 0]
+        if value >> 4 == value & 0xf and (section == value).all():
+            sections.append(uniform_nibble_sections[value & 0xf])
+        else:
+            sections.append(section.copy())
+
+    return sections
+
+def join_sections(sections):
+    """
+    Join 16-high sections back into a chunk array.
+
+    Nibble-packed sections are joined into a nibble-packed array.
+
+    :param list sections: sections, from the bottom of the chunk upwards
+    :rtype: `ndarray`
+    :returns: chunk array
+    """
+
+    height = sections[0].shape[2]
+    array = empty((16, 16, height * 8), dtype=uint8)
+
+    for y, section in zip(range(0, height * 8, height), sections):
+        array[:, :, y:y + height] = section
+
+    return array
+
+# Hits and misses of the chunk packet caches of all chunks.
+packet_cache_stats = {"hits": 0, "misses": 0}
+
+def make_chunk_packet(x, z, data):
+    """
+    Make a chunk packet.
+
+    This is where chunk data gets compressed. It only touches its arguments,
+    so it is safe to call from any thread.
+
+    :param int x: X coordinate in chunk coords
+    :param int z: Z coordinate in chunk coords
+    :param str data: chunk data, as returned by `Chunk.get_packet_data()`
+    :rtype: str
+    """
+
+    return make_packet("chunk", x=x * 16, y=0, z=z * 16, x_size=15,
+        y_size=127, z_size=15, data=data)
+
+def layer(name):
+    """
+    Make a property for one of the per-block arrays of a chunk.
+
+    Compacted chunks are expanded the first time any of their arrays are
+    needed.
+    """
+
+    def fget(self):
+        if self.layers is None:
+            self.expand()
+        return self.layers[name]
+
+    def fset(self, value):
+        if self.layers is None:
+            self.expand()
+        self.layers[name] = value
+        self.generation += 1
+
+    return property(fget, fset)
+
 class Chunk(object):
     """
     A chunk of blocks.
@@ -86,6 +410,11 @@ class Chunk(object):
     dirty = True
     populated = False
 
+    blocks = layer("blocks")
+    metadata = layer("metadata")
+    skylight = layer("skylight")
+    blocklight = layer("blocklight")
+
     def __init__(self, x, z):
         """
         :param int x: X coordinate in chunk coords
@@ -93,35 +422,165 @@ class Chunk(object):
 
         :ivar numpy.ndarray heightmap: Tracks the tallest block in each xz-column.
         :ivar numpy.ndarray skylight: Ambient light map.
-        :ivar numpy.ndarray damaged: Array for tracking damaged coordinates.
+        :ivar dict layers: The per-block arrays, keyed by name, or None if
+            this chunk is compacted.
+        :ivar dict sections: The per-block arrays split into sections, keyed
+            by name, or None if this chunk is not compacted.
+        :ivar set damaged: Set of damaged coordinates, packed as
+            ``x << 11 | z << 7 | y`` like the indices of the flattened chunk
+            arrays.
         :ivar bool all_damaged: Flag for forcing the entire chunk to be
             damaged. This is for efficiency; past a certain point, it is not
             efficient to batch block updates or track damage. Heavily damaged
             chunks have their damage represented as a complete resend of the
             entire chunk.
+        :ivar tuple dirty_light: Lower and upper corners of the region whose
+            lighting is out of date, or None if all lighting is current.
+        :ivar int generation: Counter which is bumped every time this chunk's
+            blocks, metadata, or lighting change. Code which modifies the
+            per-block arrays directly should call :meth:`touch`.
         """
 
         self.x = int(x)
         self.z = int(z)
 
-        self.blocks = zeros((16, 16, 128), dtype=uint8)
+        self.layers = dict((name, zeros((16, 16, 128), dtype=uint8))
+            for name in layers)
+        self.sections = None
+        self.layers_nbytes = 16 * 16 * 128 * len(layers)
+
         self.heightmap = zeros((16, 16), dtype=uint8)
-        self.blocklight = zeros((16, 16, 128), dtype=uint8)
-        self.metadata = zeros((16, 16, 128), dtype=uint8)
-        self.skylight = zeros((16, 16, 128), dtype=uint8)
 
         self.entities = set()
         self.tiles = {}
 
-        self.damaged = zeros((16, 16, 128), dtype=bool)
+        self.damaged = set()
 
         self.all_damaged = False
 
+        self.dirty_light = None
+
+        self.generation = 0
+        self.packet = None
+
     def __repr__(self):
         return "Chunk(%d, %d)" % (self.x, self.z)
 
     __str__ = __repr__
 
+    def compact(self):
+        """
+        Split this chunk's per-block arrays into 16-high sections.
+
+        Sections which hold a single value throughout, like the air above the
+        terrain or the darkness below it, are shared between all chunks
+        instead of taking up memory of their own. Metadata and light sections
+        are nibble-packed, the same as on disk and on the wire.
+
+        Single blocks and packets can be read straight from the sections. Any
+        other use of the per-block arrays expands the chunk again.
+        """
+
+        if self.layers is None:
+            return
+
+        self.sections = {}
+
+        for name, array in self.layers.iteritems():
+            self.sections[name] = split_sections(array, name in nibble_layers)
+
+        self.layers = None
+        self.count_sections()
+
+    def count_sections(self):
+        """
+        Count how much memory the sections of this compacted chunk take up.
+        """
+
+        # Shared sections don't count.
+        self.layers_nbytes = sum(section.nbytes
+            for sections in self.sections.itervalues()
+            for section in sections if section.strides[2])
+
+    def expand(self):
+        """
+        Join this chunk's sections back into per-block arrays.
+        """
+
+        if self.sections is None:
+            return
+
+        self.layers = {}
+
+        for name, sections in self.sections.iteritems():
+            array = join_sections(sections)
+            if name in nibble_layers:
+                array = unpack_nibble_array(array)
+            self.layers[name] = array
+
+        self.sections = None
+        self.layers_nbytes = 16 * 16 * 128 * len(layers)
+
+    @property
+    def nbytes(self):
+        """
+        Roughly how much memory this chunk takes up, in bytes.
+
+        Only block data and the cached packet are counted.
+        """
+
+        nbytes = self.layers_nbytes + self.heightmap.nbytes
+        if self.packet is not None:
+            nbytes += len(self.packet[1])
+        return nbytes
+
+    def get_layer_bytes(self, name):
+        """
+        Get one of the per-block arrays, as stored on disk and on the wire.
+
+        Blocks take up a byte each, and metadata and light take up a nibble
+        each. Compacted chunks are not expanded.
+
+        :param str name: name of the array
+        :rtype: str
+        """
+
+        if self.sections is not None:
+            array = join_sections(self.sections[name])
+        elif name in nibble_layers:
+            array = pack_nibble_array(self.layers[name])
+        else:
+            array = self.layers[name]
+
+        return array.tostring()
+
+    def set_layer_bytes(self, name, data):
+        """
+        Set one of the per-block arrays from data as stored on disk and on
+        the wire.
+
+        The data is split straight into sections, leaving this chunk
+        compacted; only non-uniform sections are copied out of the data.
+
+        :param str name: name of the array
+        :param data: `ndarray` of bytes, or anything which supports the
+                     buffer interface
+        """
+
+        array = frombuffer(data, dtype=uint8)
+
+        if self.sections is None:
+            self.compact()
+
+        if name in nibble_layers:
+            sections = split_packed_sections(array.reshape(16, 16, 64))
+        else:
+            sections = split_sections(array.reshape(16, 16, 128))
+
+        self.sections[name] = sections
+        self.count_sections()
+        self.generation += 1
+
     def regenerate_heightmap(self):
         """
         Regenerate the height map array.
@@ -130,119 +589,223 @@ class Chunk(object):
         xz-column.
         """
 
-        for x, z in product(xrange(16), repeat=2):
-            for y in range(127, -1, -1):
-                if self.blocks[x, z, y]:
-                    break
+        # Find the first block in each column, looking down from the top.
+        filled = self.blocks[:, :, ::-1] != 0
+        height = 127 - filled.argmax(axis=2)
+        self.heightmap[:] = where(filled.any(axis=2), height, 0)
+
+    def regenerate_blocklight(self, lower=(0, 0, 0), upper=(16, 128, 16),
+        neighbors=None):
+        """
+        Regenerate the block light map.
+
+        By default, the entire block light map is regenerated. A smaller
+        region may be given instead, in which case only the light within the
+        region is regenerated; light sources outside of the region are still
+        taken into account.
+
+        Light sources in neighbouring chunks are only taken into account if
+        the neighbouring chunks are given.
+
+        :param tuple lower: lower corner of the region, inclusive
+        :param tuple upper: upper corner of the region, exclusive
+        :param dict neighbors: neighbouring chunks, keyed by their offsets
+            from this chunk in chunk coords
+        :rtype: bool
+        :returns: whether the block light map changed
+        """
+
+        if neighbors is None:
+            neighbors = {}
+
+        lx, ly, lz = [max(i, 0) for i in lower]
+        ux, uy, uz = [min(i, j) for i, j in zip(upper, (16, 128, 16))]
+
+        if lx >= ux or ly >= uy or lz >= uz:
+            return False
+
+        # Any light source further away than this can't possibly reach the
+        # region. Light sources might be in neighbouring chunks, if there are
+        # any.
+        sx, sz, ex, ez = light_window(lx, lz, ux, uz, neighbors)
+        sy, ey = max(ly - 15, 0), min(uy + 15, 128)
+
+        glowing = zeros((ex - sx, ez - sz, ey - sy), dtype=uint8)
 
-            self.heightmap[x, z] = y
+        chunks = dict(neighbors)
+        chunks[0, 0] = self
+        for (dx, dz), chunk in chunks.iteritems():
+            # Find the part of the chunk which overlaps the light sources.
+            ox, oz = dx * 16, dz * 16
+            ix, jx = max(sx, ox), min(ex, ox + 16)
+            iz, jz = max(sz, oz), min(ez, oz + 16)
+            if ix < jx and iz < jz:
+                glowing[ix - sx:jx - sx, iz - sz:jz - sz] = strengths[
+                    chunk.blocks[ix - ox:jx - ox, iz - oz:jz - oz, sy:ey]]
 
-    def regenerate_blocklight(self):
-        lightmap = zeros((16, 16, 128), dtype=uint32)
+        lightmap = zeros(glowing.shape, dtype=uint32)
 
-        for x, y, z in product(xrange(16), xrange(128), xrange(16)):
-            block = self.blocks[x, z, y]
-            if block in glowing_blocks:
-                composite_glow(lightmap, glowing_blocks[block], x, y, z)
+        for strength in unique(glowing):
+            if strength:
+                composite_glows(lightmap, int(strength), glowing == strength)
 
-        self.blocklight = cast[uint8](lightmap.clip(0, 15))
+        lightmap = lightmap[lx - sx:ux - sx, lz - sz:uz - sz, ly - sy:uy - sy]
+        lightmap = lightmap.clip(0, 15)
+
+        region = self.blocklight[lx:ux, lz:uz, ly:uy]
+        if (region == lightmap).all():
+            return False
+
+        region[:] = lightmap
+        self.generation += 1
+        return True
 
     def regenerate_metadata(self):
         pass
 
-    def regenerate_skylight(self):
+    def column_skylight(self):
+        """
+        Get the skylight which falls straight down each column of this chunk.
+
+        This is the light which every block gets from the sky regardless of
+        its neighbours. The height map must be valid for this method to
+        produce valid results.
+
+        :rtype: `ndarray`
+        """
+
+        dimmed = dims[self.blocks]
+
+        # Apparently, skylights start at the block *above* the block on which
+        # the light is incident?
+        height = self.heightmap.astype(int32) + 1
+
+        # Light entering a column from the top is dimmed by every block that
+        # it passes through. Take the running total of dimming from the top
+        # of the column downwards, and subtract the dimming above the
+        # starting height; the result is the total dimming between the
+        # starting height and each block.
+        total = zeros((16, 16, 129), dtype=int32)
+        total[:, :, :128] = dimmed[:, :, ::-1].cumsum(axis=2)[:, :, ::-1]
+        x, z = ogrid[:16, :16]
+        above = total[x, z, (height + 1).clip(0, 128)]
+        column = (0xf - total[:, :, :128] + above[:, :, None]).clip(0, 0xf)
+
+        # The topmost block, regardless of type, is set to maximum lighting,
+        # as are all the blocks above it. If the starting block is opaque,
+        # then it keeps its light, and the light simply doesn't go any
+        # further.
+        y = arange(128)[None, None, :]
+        height = height[:, :, None]
+        column[y > height] = 0xf
+        column[(y == height) & (column == 0)] = 0xf
+
+        return column.astype(uint8)
+
+    def regenerate_skylight(self, lower=(0, 0, 0), upper=(16, 128, 16),
+        neighbors=None):
         """
         Regenerate the ambient light map.
 
         Each block's individual light comes from two sources. The ambient
         light comes from the sky.
 
-        The height map must be valid for this method to produce valid results.
-        """
-
-        lightmap = zeros((16, 16, 128), dtype=uint8)
-
-        for x, z in product(xrange(16), repeat=2):
-            # The maximum lighting value, unsurprisingly, is 0xf, which is the
-            # biggest possible value for a nibble.
-            light = 0xf
-
-            # Apparently, skylights start at the block *above* the block on
-            # which the light is incident?
-            height = self.heightmap[x, z] + 1
-
-            # The topmost block, regardless of type, is set to maximum
-            # lighting, as are all the blocks above it.
-            lightmap[x, z, height:] = light
-
-            # Dim the light going throught the remaining blocks, until there
-            # is no more light left.
-            for y in range(height, -1, -1):
-                dim = blocks[self.blocks[x, z, y]].dim
-                light -= dim
-                if light <= 0:
-                    break
-
-                lightmap[x, z, y] = light
-
-        # Now it's time to spread the light around. This flavor uses extra
-        # memory to speed things up; the basic idea is to spread *all* light,
-        # one glow level at a time, rather than spread each block
-        # individually.
-        max_height = amax(self.heightmap)
-        lightable = vectorize(lambda block: blocks[block].dim < 15)(self.blocks)
-        unlighted = logical_not(lightmap) & lightable
-
-        # Create a mask to find all blocks that have an unlighted block
-        # as a neighbour in the xz-plane.
-        mask = zeros((16, 16, max_height), dtype=bool)
-        mask[:-1,:,:max_height] |= unlighted[1:, :, :max_height]
-        mask[:,:-1,:max_height] |= unlighted[:, 1:, :max_height]
-        mask[1:,:,:max_height] |= unlighted[:-1, :, :max_height]
-        mask[:,1:,:max_height] |= unlighted[:, :-1, :max_height]
-
-        # Apply the mask to the lightmap to find all lighted blocks with one
-        # or more unlighted blocks as neighbours.
-        edges = logical_and(mask, lightmap[:, :, :max_height]).nonzero()
-
-        spread = [tuple(coords) for coords in transpose(edges)]
-        visited = set()
-        glow = 14
-
-        while glow:
-            for coords in spread:
-                if lightmap[coords] <= glow:
-                    visited.add(coords)
-                    continue
-
-                for dx, dz, dy in (
-                    (1, 0, 0),
-                    (-1, 0, 0),
-                    (0, 1, 0),
-                    (0, -1, 0),
-                    (0, 0, 1),
-                    (0, 0, -1)):
-                    x, z, y = coords
-                    x += dx
-                    z += dz
-                    y += dy
-
-                    if not (0 <= x < 16 and
-                        0 <= z < 16 and
-                        0 <= y < 128):
-                        continue
-
-                    if (x, z, y) in visited:
-                        continue
-
-                    if lightable[x, z, y] and lightmap[x, z, y] < glow:
-                        lightmap[x, z, y] = glow - blocks[self.blocks[x, z, y]].dim
-                        visited.add((x, z, y))
-            glow -= 1
-            spread = visited
-            visited = set()
-
-        self.skylight = lightmap.clip(0, 15)
+        By default, the entire ambient light map is regenerated. A smaller
+        region may be given instead, in which case only the light within the
+        region is regenerated; the blocks around the region keep their light
+        and shine it into the region.
+
+        If neighbouring chunks are given, light is regenerated across the
+        borders with them, in both directions. Light which spread out of the
+        region before, but which can't any longer, is taken away from the
+        neighbours too, instead of being shone straight back in. Neighbours
+        whose light changes have their generation bumped.
+
+        The height maps must be valid for this method to produce valid
+        results.
+
+        :param tuple lower: lower corner of the region, inclusive
+        :param tuple upper: upper corner of the region, exclusive
+        :param dict neighbors: neighbouring chunks, keyed by their offsets
+            from this chunk in chunk coords
+        :rtype: bool
+        :returns: whether this chunk's ambient light map changed
+        """
+
+        if neighbors is None:
+            neighbors = {}
+
+        lx, ly, lz = [max(i, 0) for i in lower]
+        ux, uy, uz = [min(i, j) for i, j in zip(upper, (16, 128, 16))]
+
+        if lx >= ux or ly >= uy or lz >= uz:
+            return False
+
+        # Light can only travel 15 blocks, so changes to the light in the
+        # region can't be felt any further away than this, and nothing
+        # further away can shine into the region.
+        sx, sz, ex, ez = light_window(lx, lz, ux, uz, neighbors)
+        sy, ey = max(ly - 15, 0), min(uy + 15, 128)
+
+        # Gather the light, dimming, and column light of the window from
+        # every chunk in it. Blocks in chunks which aren't loaded are opaque
+        # and unlit.
+        shape = ex - sx, ez - sz, ey - sy
+        lightmap = zeros(shape, dtype=uint8)
+        dimmed = empty(shape, dtype=uint8)
+        dimmed.fill(16)
+        base = zeros(shape, dtype=uint8)
+
+        chunks = dict(neighbors)
+        chunks[0, 0] = self
+        overlaps = []
+        for (dx, dz), chunk in chunks.iteritems():
+            ox, oz = dx * 16, dz * 16
+            ix, jx = max(sx, ox), min(ex, ox + 16)
+            iz, jz = max(sz, oz), min(ez, oz + 16)
+            if ix < jx and iz < jz:
+                here = slice(ix - sx, jx - sx), slice(iz - sz, jz - sz)
+                there = (slice(ix - ox, jx - ox), slice(iz - oz, jz - oz),
+                    slice(sy, ey))
+                lightmap[here] = chunk.skylight[there]
+                dimmed[here] = dims[chunk.blocks[there]]
+                base[here] = chunk.column_skylight()[there]
+                overlaps.append((chunk, here, there))
+
+        lighted = dimmed < 15
+
+        region = (slice(lx - sx, ux - sx), slice(lz - sz, uz - sz),
+            slice(ly - sy, uy - sy))
+
+        # Every block in the region which was lit by its neighbours might not
+        # be any longer. Take that light away, along with whatever light it
+        # spread in turn, wherever it went.
+        removed = zeros(shape, dtype=bool)
+        removed[region] = lightmap[region] > base[region]
+        frontier = unspread_light(lightmap, base, removed)
+
+        # Now spread the light again, from the region, from the shell of
+        # blocks around it, and from whatever is left lit around the
+        # darkness.
+        lightmap[region] = maximum(lightmap[region], base[region])
+        frontier[max(lx - sx - 1, 0):ux - sx + 1,
+            max(lz - sz - 1, 0):uz - sz + 1,
+            max(ly - sy - 1, 0):uy - sy + 1] = True
+        frontier &= lightmap != 0
+        spread_light(lightmap, dimmed, lighted, frontier)
+
+        changed = False
+        for chunk, here, there in overlaps:
+            old = chunk.skylight[there]
+            if (old == lightmap[here]).all():
+                continue
+
+            old[:] = lightmap[here]
+            chunk.generation += 1
+            if chunk is self:
+                changed = True
+
+        return changed
 
     def regenerate(self):
         """
@@ -254,8 +817,50 @@ class Chunk(object):
         self.regenerate_metadata()
         self.regenerate_skylight()
 
+        self.dirty_light = None
         self.dirty = True
 
+    def damage_light(self, lower, upper):
+        """
+        Record that the lighting of a region is out of date.
+
+        Regions are coalesced into a single bounding box, which is relit all
+        at once by :meth:`relight`.
+
+        :param tuple lower: lower corner of the region, inclusive
+        :param tuple upper: upper corner of the region, exclusive
+        """
+
+        lower = tuple(max(i, 0) for i in lower)
+        upper = tuple(min(i, j) for i, j in zip(upper, (16, 128, 16)))
+
+        if self.dirty_light is not None:
+            lower = tuple(min(i) for i in zip(lower, self.dirty_light[0]))
+            upper = tuple(max(i) for i in zip(upper, self.dirty_light[1]))
+
+        self.dirty_light = lower, upper
+
+    def relight(self, neighbors=None):
+        """
+        Regenerate any lighting which is out of date.
+
+        :param dict neighbors: neighbouring chunks, keyed by their offsets
+            from this chunk in chunk coords, for block light
+        :returns: tuple of the lower and upper corners of the relit region,
+            or None if all lighting was current
+        """
+
+        if self.dirty_light is None:
+            return None
+
+        lower, upper = self.dirty_light
+        self.dirty_light = None
+
+        self.regenerate_blocklight(lower, upper, neighbors)
+        self.regenerate_skylight(lower, upper)
+
+        return lower, upper
+
     def damage(self, coords):
         """
         Record damage on this chunk.
@@ -266,10 +871,11 @@ class Chunk(object):
         if self.all_damaged:
             return
 
-        self.damaged[x, z, y] = True
+        self.damaged.add(x << 11 | z << 7 | y)
 
-        if self.damaged.sum() > 176:
+        if len(self.damaged) > 176:
             self.all_damaged = True
+            self.damaged.clear()
 
     def is_damaged(self):
         """
@@ -279,7 +885,7 @@ class Chunk(object):
         :returns: True if any damage is pending on this chunk, False if not.
         """
 
-        return self.all_damaged or self.damaged.any()
+        return self.all_damaged or bool(self.damaged)
 
     def get_damage_packet(self):
         """
@@ -309,11 +915,12 @@ class Chunk(object):
         if self.all_damaged:
             # Resend the entire chunk!
             return self.save_to_packet()
-        elif not self.damaged.any():
+        elif not self.damaged:
             return ""
-        elif self.damaged.sum() == 1:
+        elif len(self.damaged) == 1:
             # Use a single block update packet.
-            x, z, y = [int(i) for i in zip(*self.damaged.nonzero())[0]]
+            index = iter(self.damaged).next()
+            x, z, y = index >> 11, index >> 7 & 0xf, index & 0x7f
             return make_packet("block",
                     x=x + self.x * 16,
                     y=y,
@@ -322,15 +929,16 @@ class Chunk(object):
                     meta=int(self.metadata[x, z, y]))
         else:
             # Use a batch update.
-            damaged = self.damaged.nonzero()
+            damaged = sorted(self.damaged)
             # Coordinates are not quite packed in the same system as the
             # indices for chunk data structures.
             # Chunk data structures are ((x * 16) + z) * 128) + y, or in
             # bit-twiddler's parlance, x << 11 | z << 7 | y. However, for
             # this, we need x << 12 | z << 8 | y, so repack accordingly.
-            coords = [int(x << 12 | z << 8 | y) for x, z, y in zip(*damaged)]
-            types = [int(i) for i in self.blocks[damaged]]
-            metadata = [int(i) for i in self.metadata[damaged]]
+            coords = [(i & 0x7800) << 1 | (i & 0x780) << 1 | i & 0x7f
+                for i in damaged]
+            types = [int(i) for i in self.blocks.take(damaged)]
+            metadata = [int(i) for i in self.metadata.take(damaged)]
 
             return make_packet("batch", x=self.x, z=self.z,
                 length=len(coords), coords=coords, types=types,
@@ -341,22 +949,63 @@ class Chunk(object):
         Clear this chunk's damage.
         """
 
-        self.damaged.fill(False)
+        self.damaged.clear()
         self.all_damaged = False
 
     def save_to_packet(self):
         """
         Generate a chunk packet.
+
+        The packet is cached until the next time that this chunk changes.
         """
 
-        array = self.blocks.tostring()
-        array += pack_nibbles(self.metadata)
-        array += pack_nibbles(self.blocklight)
-        array += pack_nibbles(self.skylight)
-        packet = make_packet("chunk", x=self.x * 16, y=0, z=self.z * 16,
-            x_size=15, y_size=127, z_size=15, data=array)
+        packet = self.get_cached_packet()
+
+        if packet is None:
+            packet = make_chunk_packet(self.x, self.z, self.get_packet_data())
+            self.cache_packet(self.generation, packet)
+
         return packet
 
+    def get_packet_data(self):
+        """
+        Get the uncompressed data for a chunk packet.
+
+        :rtype: str
+        """
+
+        return "".join(self.get_layer_bytes(name)
+            for name in ("blocks", "metadata", "blocklight", "skylight"))
+
+    def get_cached_packet(self):
+        """
+        Get the cached chunk packet, if this chunk hasn't changed since it was
+        made.
+
+        :returns: the packet, or None if there isn't a current packet
+        """
+
+        if self.packet is not None and self.packet[0] == self.generation:
+            packet_cache_stats["hits"] += 1
+            return self.packet[1]
+
+        packet_cache_stats["misses"] += 1
+        return None
+
+    def cache_packet(self, generation, packet):
+        """
+        Cache a chunk packet made from this chunk.
+
+        Packets are made outside of this chunk, and might arrive out of
+        order; older packets never replace newer ones.
+
+        :param int generation: generation of the chunk data in the packet
+        :param str packet: the packet
+        """
+
+        if self.packet is None or self.packet[0] <= generation:
+            self.packet = generation, packet
+
     def get_block(self, coords):
         """
         Look up a block value.
@@ -368,6 +1017,8 @@ class Chunk(object):
 
         try:
             x, y, z = coords
+            if self.sections is not None:
+                return self.sections["blocks"][y >> 4][x, z, y & 0xf]
             return self.blocks[x, z, y]
         except IndexError:
             # Coordinates were out-of-bounds; warn and pretend it's air.
@@ -386,8 +1037,10 @@ class Chunk(object):
         x, y, z = coords
 
         try:
-            if self.blocks[x, z, y] != block:
+            previous = self.blocks[x, z, y]
+            if previous != block:
                 self.blocks[x, z, y] = block
+                self.generation += 1
 
                 if not self.populated:
                     return
@@ -396,21 +1049,22 @@ class Chunk(object):
                 if not block:
                     # If we replace the highest block with air, we need to go
                     # through all blocks below it to find the new top block.
-                    height = self.heightmap[x, z]
-                    if y == height:
-                        for y in range(height, -1, -1):
-                            if self.blocks[x, z, y]:
-                                break
-                        self.heightmap[x, z] = y
+                    if y == self.heightmap[x, z]:
+                        below = self.blocks[x, z, :y].nonzero()[0]
+                        self.heightmap[x, z] = below[-1] if len(below) else 0
                 else:
                     self.heightmap[x, z] = max(self.heightmap[x, z], y)
 
-                # Add to lightmap at this coordinate.
-                if block in glowing_blocks:
-                    composite_glow(self.blocklight, glowing_blocks[block],
-                        x, y, z)
-
-                    self.blocklight = cast[uint8](self.blocklight.clip(0, 15))
+                # Mark the lighting around this coordinate as out of date.
+                # Light sources only reach so far, but changing how much
+                # light gets through can also change the light all the way
+                # down the column.
+                if dims[previous] != dims[block]:
+                    self.damage_light((x - 15, 0, z - 15),
+                        (x + 16, y + 16, z + 16))
+                elif strengths[previous] != strengths[block]:
+                    self.damage_light((x - 15, y - 15, z - 15),
+                        (x + 16, y + 16, z + 16))
 
                 self.dirty = True
                 self.damage(coords)
@@ -430,6 +1084,10 @@ class Chunk(object):
         x, y, z = coords
 
         try:
+            if self.sections is not None:
+                section = self.sections["metadata"][y >> 4]
+                packed = section[x, z, (y & 0xf) >> 1]
+                return packed >> 4 if y & 1 else packed & 0xf
             return self.metadata[x, z, y]
         except IndexError:
             # Coordinates were out-of-bounds; warn.
@@ -450,6 +1108,7 @@ class Chunk(object):
         try:
             if self.metadata[x, z, y] != metadata:
                 self.metadata[x, z, y] = metadata
+                self.generation += 1
 
                 self.dirty = True
                 self.damage(coords)
@@ -514,12 +1173,26 @@ class Chunk(object):
         Return a slice of the block data at the given xz-column.
 
         The slice is a numpy array, so you do not have to set it again if you
-        are modifying it in-place.
+        are modifying it in-place; call :meth:`touch` afterwards instead.
 
         :rtype: :py:class:`numpy.ndarray`
         """
+
         return self.blocks[x, z]
 
+    def touch(self):
+        """
+        Record that this chunk's per-block arrays were modified directly.
+
+        The mutators of this class take care of this themselves; code which
+        writes straight into the arrays, or into the slices returned by
+        :meth:`get_column`, must call this afterwards, so that cached packets
+        are rebuilt and the chunk is saved.
+        """
+
+        self.generation += 1
+        self.dirty = True
+
     def set_column(self, x, z, column):
         """
         Atomically set an entire xz-column's block data.
@@ -530,6 +1203,7 @@ class Chunk(object):
         :param column: Column data, in the form of a NumPy array.
         """
         self.blocks[x, z] = column
+        self.generation += 1
 
         self.dirty = True
         for y in range(128):
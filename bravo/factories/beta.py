@@ -2,12 +2,16 @@ from collections import defaultdict
 from itertools import chain
 
 from twisted.internet import reactor
+from twisted.internet.defer import succeed
 from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Factory
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 from zope.interface import implements
 
+from bravo.chunk import make_chunk_packet
 from bravo.config import configuration
 from bravo.entity import entities
 from bravo.ibravo import (ISortedPlugin, IAutomaton, IAuthenticator, ISeason,
@@ -17,6 +21,7 @@ from bravo.location import Location
 from bravo.packets.beta import make_packet
 from bravo.plugin import retrieve_named_plugins, retrieve_sorted_plugins
 from bravo.protocols.beta import BannedProtocol, BravoProtocol
+from bravo.tracking import EntityTracker
 from bravo.utilities.chat import chat_name, sanitize_chat
 from bravo.weather import WeatherVane
 from bravo.world import World
@@ -41,6 +46,8 @@ class BravoFactory(Factory):
     handshake_hook = None
     login_hook = None
 
+    packet_pool = None
+
     interfaces = []
 
     def __init__(self, name):
@@ -61,6 +68,13 @@ class BravoFactory(Factory):
 
         self.protocols = dict()
 
+        # The protocols which have each chunk loaded.
+        self.chunk_subscribers = dict()
+
+        distance = configuration.getintdefault(self.config_name,
+            "view_distance", 10)
+        self.tracker = EntityTracker(self, distance)
+
         self.vane = WeatherVane(self)
 
     def startFactory(self):
@@ -79,6 +93,14 @@ class BravoFactory(Factory):
         log.msg("Starting world...")
         self.world.start()
 
+        threads = configuration.getintdefault(self.config_name,
+            "packet_threads", 2)
+        if threads > 0:
+            log.msg("Compressing chunk packets in %d threads" % threads)
+            self.packet_pool = ThreadPool(0, threads,
+                "%s packets" % self.name)
+            self.packet_pool.start()
+
         if configuration.has_option(self.config_name, "perm_cache"):
             cache_level = configuration.getint(self.config_name, "perm_cache")
             self.world.enable_cache(cache_level)
@@ -122,6 +144,10 @@ class BravoFactory(Factory):
         # And now stop the world.
         self.world.stop()
 
+        if self.packet_pool is not None:
+            self.packet_pool.stop()
+            self.packet_pool = None
+
         log.msg("World data saved!")
 
     def buildProtocol(self, addr):
@@ -365,9 +391,33 @@ class BravoFactory(Factory):
         `x` and `z` are chunk coordinates, not block coordinates.
         """
 
-        for player in self.protocols.itervalues():
-            if (x, z) in player.chunks:
-                player.transport.write(packet)
+        for player in self.chunk_subscribers.get((x, z), ()):
+            player.transport.write(packet)
+
+    def subscribe_chunk(self, protocol, x, z):
+        """
+        Note that a protocol has a chunk loaded, so that packets for the chunk
+        are sent to it.
+
+        `x` and `z` are chunk coordinates, not block coordinates.
+        """
+
+        self.chunk_subscribers.setdefault((x, z), set()).add(protocol)
+        self.tracker.subscribed(protocol, x, z)
+
+    def unsubscribe_chunk(self, protocol, x, z):
+        """
+        Note that a protocol no longer has a chunk loaded.
+
+        `x` and `z` are chunk coordinates, not block coordinates.
+        """
+
+        subscribers = self.chunk_subscribers.get((x, z))
+        if subscribers is not None:
+            subscribers.discard(protocol)
+            if not subscribers:
+                del self.chunk_subscribers[x, z]
+            self.tracker.unsubscribed(protocol, x, z)
 
     def scan_chunk(self, chunk):
         """
@@ -377,16 +427,46 @@ class BravoFactory(Factory):
         for automaton in self.automatons:
             automaton.scan(chunk)
 
+    def make_chunk_packet(self, chunk):
+        """
+        Make a packet for a chunk, without tying up the reactor.
+
+        Cached packets are used as-is. Otherwise, the chunk's data is copied
+        right away, and compressed in the packet pool.
+
+        :returns: `Deferred` that will fire with the packet
+        """
+
+        packet = chunk.get_cached_packet()
+        if packet is not None:
+            return succeed(packet)
+
+        generation = chunk.generation
+        data = chunk.get_packet_data()
+
+        if self.packet_pool is None:
+            d = succeed(make_chunk_packet(chunk.x, chunk.z, data))
+        else:
+            d = deferToThreadPool(reactor, self.packet_pool,
+                make_chunk_packet, chunk.x, chunk.z, data)
+
+        def cache(packet):
+            chunk.cache_packet(generation, packet)
+            return packet
+        d.addCallback(cache)
+
+        return d
+
     def flush_chunk(self, chunk):
         """
         Flush a damaged chunk to all players that have it loaded.
         """
 
+        self.world.relight_chunk(chunk)
+
         if chunk.is_damaged():
             packet = chunk.get_damage_packet()
-            for player in self.protocols.itervalues():
-                if (chunk.x, chunk.z) in player.chunks:
-                    player.transport.write(packet)
+            self.broadcast_for_chunk(packet, chunk.x, chunk.z)
             chunk.clear_damage()
 
     def flush_all_chunks(self):
@@ -227,6 +227,18 @@ class ISerializer(IBravoPlugin):
     implementation of their serialization technique.
     """
 
+    def recover():
+        """
+        Bring the world on disk back to a consistent state, after a crash
+        interrupted writing to it.
+        """
+
+    def close():
+        """
+        Release any files held open, once the world has been saved for the
+        last time.
+        """
+
     def save_chunk(chunk):
         """
         Save a chunk.
@@ -241,6 +253,55 @@ class ISerializer(IBravoPlugin):
         May return a ``Deferred`` that will fire on completion.
         """
 
+    def save_chunks(chunks):
+        """
+        Save several chunks at once.
+
+        May return a ``Deferred`` that will fire on completion.
+        """
+
+    def load_chunks(chunks):
+        """
+        Load several chunks at once.
+
+        Serializers may take advantage of chunks being stored near each
+        other. Chunks which aren't stored are left alone.
+
+        May return a ``Deferred`` that will fire on completion.
+        """
+
+    def encode_chunk(chunk):
+        """
+        Encode a chunk into a record which can be written with
+        ``write_chunk()``.
+
+        This is the only part of saving a chunk which looks at the chunk.
+        """
+
+    def write_chunk(x, z, record):
+        """
+        Write a record made by ``encode_chunk()``.
+
+        Unlike every other method, this may be called from a thread other
+        than the reactor, although never from more than one thread at once.
+
+        Serializers may hold the record back and write it along with later
+        ones, as long as it is written by the time ``close()`` returns, and
+        loading the chunk in the meantime finds the record.
+
+        :returns: the number of bytes written, or None if unknown
+        """
+
+    def write_chunks(records):
+        """
+        Write several records made by ``encode_chunk()`` at once.
+
+        Like ``write_chunk()``, this may be called from another thread.
+
+        :param records: list of (x, z, record) tuples
+        :returns: the number of bytes written, or None if unknown
+        """
+
     def save_level(level):
         """
         Save a level.
@@ -1,4 +1,5 @@
-from struct import Struct, error as StructError
+from collections import MutableSequence, OrderedDict
+from struct import Struct, error as StructError, pack_into, unpack_from
 from gzip import GzipFile
 from UserDict import DictMixin
 
@@ -16,6 +17,26 @@ TAG_STRING = 8
 TAG_LIST = 9
 TAG_COMPOUND = 10
 
+_byte = Struct(">b")
+_short = Struct(">h")
+_int = Struct(">i")
+
+# Tags are parsed from, and rendered into, buffers in memory. Parsing walks a
+# memoryview with offsets, and rendering measures the whole tree first so
+# that it can be written into a single bytearray; file-like objects are only
+# ever read or written once.
+#
+# Each tag has a _parse_data() method, which fills the tag in from data at an
+# offset and returns the offset where the tag ends, and a pair of _nbytes()
+# and _render_data() methods, which measure the tag and write it into a
+# buffer at an offset, returning the offset where the tag ends. Neither
+# includes the tag's type or name, which belong to the containing compound.
+#
+# Lists and compounds can also be parsed lazily, with _parse_lazy(), which
+# only records where their payload lies. They are parsed, one level at a
+# time, when their contents are first needed, and are rendered by copying
+# their payload as long as they haven't been.
+
 class TAG(object):
     """Each Tag needs to take a file-like object for reading and writing.
     The file object will be initialised by the calling code."""
@@ -26,12 +47,27 @@ class TAG(object):
         self.value = value
 
     #Parsers and Generators
-    def _parse_buffer(self, buffer):
+    def _parse_data(self, data, offset):
         raise NotImplementedError(self.__class__.__name__)
 
-    def _render_buffer(self, buffer, offset=None):
+    def _nbytes(self):
+        raise NotImplementedError(self.__class__.__name__)
+
+    def _render_data(self, buf, offset):
         raise NotImplementedError(self.__class__.__name__)
 
+    def _parse_buffer(self, buffer, offset=None):
+        data = buffer.read()
+        end = self._parse_data(memoryview(data), 0)
+        # Hand back whatever wasn't part of this tag.
+        if end < len(data) and hasattr(buffer, "seek"):
+            buffer.seek(end - len(data), 1)
+
+    def _render_buffer(self, buffer, offset=None):
+        buf = bytearray(self._nbytes())
+        self._render_data(buf, 0)
+        buffer.write(str(buf))
+
     #Printing and Formatting of tree
     def tag_info(self):
         return self.__class__.__name__ + \
@@ -44,16 +80,20 @@ class TAG(object):
 class _TAG_Numeric(TAG):
     def __init__(self, value=None, name=None, buffer=None):
         super(_TAG_Numeric, self).__init__(value, name)
-        self.size = self.fmt.size
         if buffer:
             self._parse_buffer(buffer)
 
     #Parsers and Generators
-    def _parse_buffer(self, buffer, offset=None):
-        self.value = self.fmt.unpack(buffer.read(self.size))[0]
+    def _parse_data(self, data, offset):
+        self.value = self.fmt.unpack_from(data, offset)[0]
+        return offset + self.size
 
-    def _render_buffer(self, buffer, offset=None):
-        buffer.write(self.fmt.pack(self.value))
+    def _nbytes(self):
+        return self.size
+
+    def _render_data(self, buf, offset):
+        self.fmt.pack_into(buf, offset, self.value)
+        return offset + self.size
 
     #Printing and Formatting of tree
     def __repr__(self):
@@ -62,27 +102,33 @@ class _TAG_Numeric(TAG):
 #== Value Tags ==#
 class TAG_Byte(_TAG_Numeric):
     id = TAG_BYTE
-    fmt = Struct(">b")
+    fmt = _byte
+    size = fmt.size
 
 class TAG_Short(_TAG_Numeric):
     id = TAG_SHORT
-    fmt = Struct(">h")
+    fmt = _short
+    size = fmt.size
 
 class TAG_Int(_TAG_Numeric):
     id = TAG_INT
-    fmt = Struct(">i")
+    fmt = _int
+    size = fmt.size
 
 class TAG_Long(_TAG_Numeric):
     id = TAG_LONG
     fmt = Struct(">q")
+    size = fmt.size
 
 class TAG_Float(_TAG_Numeric):
     id = TAG_FLOAT
     fmt = Struct(">f")
+    size = fmt.size
 
 class TAG_Double(_TAG_Numeric):
     id = TAG_DOUBLE
     fmt = Struct(">d")
+    size = fmt.size
 
 class TAG_Byte_Array(TAG):
     id = TAG_BYTE_ARRAY
@@ -93,19 +139,51 @@ class TAG_Byte_Array(TAG):
             self._parse_buffer(buffer)
 
     #Parsers and Generators
-    def _parse_buffer(self, buffer, offset=None):
-        length = TAG_Int(buffer=buffer)
-        self.value = buffer.read(length.value)
-
-    def _render_buffer(self, buffer, offset=None):
-        length = TAG_Int(len(self.value))
-        length._render_buffer(buffer, offset)
-        buffer.write(self.value)
+    def _parse_data(self, data, offset):
+        length = _int.unpack_from(data, offset)[0]
+        offset += 4
+        if offset + length > len(data):
+            raise StructError("Byte array runs past the end of the data")
+        self.value = data[offset:offset + length].tobytes()
+        return offset + length
+
+    def _nbytes(self):
+        return 4 + len(self.value)
+
+    def _render_data(self, buf, offset):
+        length = len(self.value)
+        _int.pack_into(buf, offset, length)
+        offset += 4
+        buf[offset:offset + length] = self.value
+        return offset + length
 
     #Printing and Formatting of tree
     def __repr__(self):
         return "[%i bytes]" % len(self.value)
 
+def _read_string(data, offset):
+    """
+    Read a length-prefixed UTF-8 string, for TAG_String and tag names.
+    """
+
+    length = _short.unpack_from(data, offset)[0]
+    offset += 2
+    if offset + length > len(data):
+        raise StructError("String runs past the end of the data")
+    return data[offset:offset + length].tobytes().decode("utf-8"), \
+        offset + length
+
+def _write_string(buf, offset, s):
+    """
+    Write a length-prefixed, already encoded, string.
+    """
+
+    length = len(s)
+    _short.pack_into(buf, offset, length)
+    offset += 2
+    buf[offset:offset + length] = s
+    return offset + length
+
 class TAG_String(TAG):
     id = TAG_STRING
     def __init__(self, value=None, name=None, buffer=None):
@@ -114,26 +192,58 @@ class TAG_String(TAG):
             self._parse_buffer(buffer)
 
     #Parsers and Generators
-    def _parse_buffer(self, buffer, offset=None):
-        length = TAG_Short(buffer=buffer)
-        read = buffer.read(length.value)
-        if len(read) != length.value:
-            raise StructError()
-        self.value = unicode(read, "utf-8")
+    def _parse_data(self, data, offset):
+        self.value, offset = _read_string(data, offset)
+        return offset
 
-    def _render_buffer(self, buffer, offset=None):
-        save_val = self.value.encode("utf-8")
-        length = TAG_Short(len(save_val))
-        length._render_buffer(buffer, offset)
-        buffer.write(save_val)
+    def _nbytes(self):
+        return 2 + len(self.value.encode("utf-8"))
+
+    def _render_data(self, buf, offset):
+        return _write_string(buf, offset, self.value.encode("utf-8"))
 
     #Printing and Formatting of tree
     def __repr__(self):
         return self.value
 
+def _copy_span(buf, offset, span):
+    """
+    Copy the payload of a lazily parsed tag, as it was parsed.
+    """
+
+    data, start, end = span
+    buf[offset:offset + end - start] = data[start:end]
+    return offset + end - start
+
+def parse_payload(data, tagid, offset, lazy=False):
+    """
+    Parse a tag, given its type.
+
+    :param data: NBT data, as a `memoryview`
+    :param int tagid: type of the tag
+    :param int offset: where the tag's payload starts
+    :param bool lazy: whether to leave lists and compounds unparsed until
+                      they are used
+    :returns: tuple of the tag and the offset where its payload ends
+    """
+
+    try:
+        cls = TAGLIST[tagid]
+    except KeyError:
+        raise ValueError("Unrecognised tag type")
+
+    # Skip the constructors; _parse_data() fills in everything but the name.
+    tag = cls.__new__(cls)
+    tag.name = None
+    if lazy and cls in (TAG_List, TAG_Compound):
+        return tag, tag._parse_lazy(data, offset)
+    return tag, tag._parse_data(data, offset)
+
 #== Collection Tags ==#
 class TAG_List(TAG):
     id = TAG_LIST
+    # Where the payload of a lazily parsed list lies, until it is parsed.
+    _span = None
     def __init__(self, type=None, value=None, name=None, buffer=None):
         super(TAG_List, self).__init__(value, name)
         if type:
@@ -145,23 +255,87 @@ class TAG_List(TAG):
         if not self.tagID:
             raise ValueError("No type specified for list")
 
-    #Parsers and Generators
-    def _parse_buffer(self, buffer, offset=None):
-        self.tagID = TAG_Byte(buffer=buffer).value
-        self.tags = []
-        length = TAG_Int(buffer=buffer)
-        for x in range(length.value):
-            self.tags.append(TAGLIST[self.tagID](buffer=buffer))
+    def _get_tags(self):
+        if self._span is not None:
+            data, start, end = self._span
+            self._parse_data(data, start, True)
+        return self._tags
 
-    def _render_buffer(self, buffer, offset=None):
-        TAG_Byte(self.tagID)._render_buffer(buffer, offset)
-        length = TAG_Int(len(self.tags))
-        length._render_buffer(buffer, offset)
+    def _set_tags(self, tags):
+        self._span = None
+        self._tags = tags
+
+    tags = property(_get_tags, _set_tags)
+
+    #Parsers and Generators
+    def _parse_lazy(self, data, offset):
+        self.value = None
+        self.tagID = ord(data[offset])
+        end = skip_payload(data, TAG_LIST, offset)
+        self._span = data, offset, end
+        return end
+
+    def _parse_data(self, data, offset, lazy=False):
+        self.value = None
+        self._span = None
+        self.tagID = ord(data[offset])
+        length = _int.unpack_from(data, offset + 1)[0]
+        offset += 5
+
+        cls = TAGLIST.get(self.tagID)
+        if cls is not None and issubclass(cls, _TAG_Numeric):
+            # Lists of numbers are common (positions, rotations, motions)
+            # and can be unpacked in one go.
+            values = unpack_from(">%d%s" % (length, cls.fmt.format[-1]),
+                data, offset)
+            self._tags = tags = []
+            for value in values:
+                tag = cls.__new__(cls)
+                tag.name = None
+                tag.value = value
+                tags.append(tag)
+            return offset + length * cls.size
+
+        self._tags = tags = []
+        for x in range(length):
+            tag, offset = parse_payload(data, self.tagID, offset, lazy)
+            tags.append(tag)
+        return offset
+
+    def _check_types(self):
         for i, tag in enumerate(self.tags):
             if tag.id != self.tagID:
                 raise ValueError("List element %d(%s) has type %d != container type %d" %
                          (i, tag, tag.id, self.tagID))
-            tag._render_buffer(buffer, offset)
+
+    def _nbytes(self):
+        if self._span is not None:
+            data, start, end = self._span
+            return end - start
+
+        self._check_types()
+        cls = TAGLIST.get(self.tagID)
+        if cls is not None and issubclass(cls, _TAG_Numeric):
+            return 5 + len(self.tags) * cls.size
+        return 5 + sum(tag._nbytes() for tag in self.tags)
+
+    def _render_data(self, buf, offset):
+        if self._span is not None:
+            return _copy_span(buf, offset, self._span)
+
+        _byte.pack_into(buf, offset, self.tagID)
+        _int.pack_into(buf, offset + 1, len(self.tags))
+        offset += 5
+
+        cls = TAGLIST.get(self.tagID)
+        if cls is not None and issubclass(cls, _TAG_Numeric):
+            pack_into(">%d%s" % (len(self.tags), cls.fmt.format[-1]), buf,
+                offset, *[tag.value for tag in self.tags])
+            return offset + len(self.tags) * cls.size
+
+        for tag in self.tags:
+            offset = tag._render_data(buf, offset)
+        return offset
 
     #Printing and Formatting of tree
     def __repr__(self):
@@ -175,89 +349,199 @@ class TAG_List(TAG):
             output.append(("\t"*indent) + "}")
         return '\n'.join(output)
 
+class _CompoundTags(MutableSequence):
+    """
+    The tags of a compound, in order, as a list.
+
+    Tags are stored by name, so adding a tag replaces any tag in the compound
+    which already has its name.
+    """
+
+    def __init__(self, compound):
+        self.compound = compound
+
+    def _replace(self, tags):
+        self.compound._tags = OrderedDict((tag.name, tag) for tag in tags)
+
+    def __getitem__(self, index):
+        self.compound._load()
+        return self.compound._tags.values()[index]
+
+    def __setitem__(self, index, tag):
+        self.compound._load()
+        tags = self.compound._tags.values()
+        tags[index] = tag
+        self._replace(tags)
+
+    def __delitem__(self, index):
+        self.compound._load()
+        tags = self.compound._tags.values()
+        del tags[index]
+        self._replace(tags)
+
+    def __len__(self):
+        self.compound._load()
+        return len(self.compound._tags)
+
+    def insert(self, index, tag):
+        self.compound._load()
+        tags = self.compound._tags
+        if index >= len(tags) and tag.name not in tags:
+            tags[tag.name] = tag
+        else:
+            tags = tags.values()
+            tags.insert(index, tag)
+            self._replace(tags)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
 class TAG_Compound(TAG, DictMixin):
+    """
+    A compound of named tags.
+
+    Tags are kept in an ordered dict, by name, so that they can be looked up
+    without scanning the whole compound. ``tags`` is a live, list-like view
+    of the tags, in order; changes made through it, such as appending a tag,
+    are made to the compound.
+    """
+
     id = TAG_COMPOUND
+    # Where the payload of a lazily parsed compound lies, until it is parsed.
+    _span = None
     def __init__(self, buffer=None):
         super(TAG_Compound, self).__init__()
-        self.tags = []
+        self._tags = OrderedDict()
         if buffer:
             self._parse_buffer(buffer)
 
+    def _load(self):
+        """
+        Parse this compound, if it was parsed lazily and hasn't been yet.
+        """
+
+        if self._span is not None:
+            data, start, end = self._span
+            self._parse_data(data, start, True)
+
+    def _get_tags(self):
+        return _CompoundTags(self)
+
+    def _set_tags(self, tags):
+        self._span = None
+        self._tags = OrderedDict((tag.name, tag) for tag in tags)
+
+    tags = property(_get_tags, _set_tags)
+
     #Parsers and Generators
-    def _parse_buffer(self, buffer, offset=None):
+    def _parse_lazy(self, data, offset):
+        self.value = None
+        end = skip_payload(data, TAG_COMPOUND, offset)
+        self._span = data, offset, end
+        return end
+
+    def _parse_data(self, data, offset, lazy=False):
+        self.value = None
+        self._span = None
+        self._tags = tags = OrderedDict()
         while True:
-            type = TAG_Byte(buffer=buffer)
-            if type.value == TAG_END:
-                #print "found tag_end"
-                break
-            else:
-                name = TAG_String(buffer=buffer).value
-                try:
-                    #DEBUG print type, name
-                    tag = TAGLIST[type.value](buffer=buffer)
-                    tag.name = name
-                    self.tags.append(tag)
-                except KeyError:
-                    raise ValueError("Unrecognised tag type")
-
-    def _render_buffer(self, buffer, offset=None):
-        for tag in self.tags:
-            TAG_Byte(tag.id)._render_buffer(buffer, offset)
-            TAG_String(tag.name)._render_buffer(buffer, offset)
-            tag._render_buffer(buffer,offset)
-        buffer.write('\x00') #write TAG_END
+            tagid = ord(data[offset])
+            if tagid == TAG_END:
+                return offset + 1
+
+            name, offset = _read_string(data, offset + 1)
+            tag, offset = parse_payload(data, tagid, offset, lazy)
+            tag.name = name
+            tags[name] = tag
+
+    def _nbytes(self):
+        if self._span is not None:
+            data, start, end = self._span
+            return end - start
+
+        size = 1
+        for tag in self._tags.itervalues():
+            size += 3 + len(tag.name.encode("utf-8")) + tag._nbytes()
+        return size
+
+    def _render_data(self, buf, offset):
+        if self._span is not None:
+            return _copy_span(buf, offset, self._span)
+
+        for tag in self._tags.itervalues():
+            _byte.pack_into(buf, offset, tag.id)
+            offset = _write_string(buf, offset + 1, tag.name.encode("utf-8"))
+            offset = tag._render_data(buf, offset)
+        buf[offset] = TAG_END
+        return offset + 1
 
     # Dict compatibility.
     # DictMixin requires at least __getitem__, and for more functionality,
     # __setitem__, __delitem__, and keys.
 
     def __getitem__(self, key):
-        if isinstance(key,int):
-            return self.tags[key]
-        elif isinstance(key, str):
-            for tag in self.tags:
-                if tag.name == key:
-                    return tag
-            else:
+        self._load()
+        if isinstance(key, int):
+            return self._tags.values()[key]
+        elif isinstance(key, basestring):
+            try:
+                return self._tags[key]
+            except KeyError:
                 raise KeyError("A tag with this name does not exist")
         else:
             raise ValueError("key needs to be either name of tag, or index of tag")
 
     def __setitem__(self, key, value):
+        self._load()
         if isinstance(key, int):
             # Just try it. The proper error will be raised if it doesn't work.
             self.tags[key] = value
-        elif isinstance(key, str):
+        elif isinstance(key, basestring):
             value.name = key
-            for i, tag in enumerate(self.tags):
-                if tag.name == key:
-                    self.tags[i] = value
-                    return
-            self.tags.append(value)
+            self._tags[key] = value
 
     def __delitem__(self, key):
+        self._load()
         if isinstance(key, int):
-            self.tags = self.tags[:key] + self.tags[key:]
-        elif isinstance(key, str):
-            for i, tag in enumerate(self.tags):
-                if tag.name == key:
-                    self.tags = self.tags[:i] + self.tags[i:]
-                    return
-            raise KeyError("A tag with this name does not exist")
+            del self._tags[self._tags.keys()[key]]
+        elif isinstance(key, basestring):
+            try:
+                del self._tags[key]
+            except KeyError:
+                raise KeyError("A tag with this name does not exist")
         else:
             raise ValueError("key needs to be either name of tag, or index of tag")
 
+    def __contains__(self, key):
+        self._load()
+        return key in self._tags
+
+    def __iter__(self):
+        self._load()
+        return iter(self._tags)
+
+    def __len__(self):
+        self._load()
+        return len(self._tags)
+
     def keys(self):
-        return [tag.name for tag in self.tags]
+        self._load()
+        return self._tags.keys()
 
 
     #Printing and Formatting of tree
     def __repr__(self):
-        return '%i Entries' % len(self.tags)
+        return '%i Entries' % len(self)
 
     def pretty_tree(self, indent=0):
         output = [super(TAG_Compound,self).pretty_tree(indent)]
-        if len(self.tags):
+        if len(self):
             output.append(("\t"*indent) + "{")
             output.extend([tag.pretty_tree(indent+1) for tag in self.tags])
             output.append(("\t"*indent) + "}")
@@ -269,7 +553,8 @@ TAGLIST = {TAG_BYTE:TAG_Byte, TAG_SHORT:TAG_Short, TAG_INT:TAG_Int, TAG_LONG:TAG
 class NBTFile(TAG_Compound):
     """Represents an NBT file object"""
 
-    def __init__(self, filename=None, mode=None, buffer=None, fileobj=None):
+    def __init__(self, filename=None, mode=None, buffer=None, fileobj=None,
+        lazy=False):
         super(NBTFile,self).__init__()
         self.__class__.__name__ = "TAG_Compound"
         self.filename = filename
@@ -285,12 +570,13 @@ class NBTFile(TAG_Compound):
             self.file = None
         #parse the file given intitially
         if self.file:
-            self.parse_file()
+            self.parse_file(lazy=lazy)
             if filename and 'close' in dir(self.file):
                 self.file.close()
             self.file = None
 
-    def parse_file(self, filename=None, buffer=None, fileobj=None):
+    def parse_file(self, filename=None, buffer=None, fileobj=None,
+        lazy=False):
         if filename:
             self.file = GzipFile(filename, 'rb')
         elif buffer:
@@ -298,19 +584,49 @@ class NBTFile(TAG_Compound):
         elif fileobj:
             self.file = GzipFile(fileobj=fileobj)
         if self.file:
-            try:
-                type = TAG_Byte(buffer=self.file)
-                if type.value == self.id:
-                    name = TAG_String(buffer=self.file).value
-                    self._parse_buffer(self.file)
-                    self.name = name
-                    self.file.close()
-                else:
-                    raise MalformedFileError("First record is not a Compound Tag")
-            except StructError:
-                raise MalformedFileError("Partial File Parse: file possibly truncated.")
+            self.parse_data(self.file.read(), lazy)
+            self.file.close()
         else: ValueError("need a file!")
 
+    def parse_data(self, data, lazy=False):
+        """
+        Parse uncompressed NBT data.
+
+        Lazily parsed files hold on to their data, and only parse the lists
+        and compounds in it as they are used.
+
+        :param data: str, or anything else which a `memoryview` can be made
+                     from
+        :param bool lazy: whether to parse lazily
+        """
+
+        data = memoryview(data)
+        try:
+            if not len(data) or ord(data[0]) != self.id:
+                raise MalformedFileError("First record is not a Compound Tag")
+            name, offset = _read_string(data, 1)
+            if lazy:
+                self._parse_lazy(data, offset)
+            else:
+                self._parse_data(data, offset)
+            self.name = name
+        except (StructError, IndexError):
+            raise MalformedFileError("Partial File Parse: file possibly truncated.")
+
+    def render(self):
+        """
+        Render this file into uncompressed NBT data.
+
+        :rtype: str
+        """
+
+        name = (self.name or u"").encode("utf-8")
+        buf = bytearray(3 + len(name) + self._nbytes())
+        buf[0] = self.id
+        offset = _write_string(buf, 1, name)
+        self._render_data(buf, offset)
+        return str(buf)
+
     def write_file(self, filename=None, buffer=None, fileobj=None):
         if buffer:
             self.file = buffer
@@ -323,15 +639,123 @@ class NBTFile(TAG_Compound):
         elif not self.file:
             raise ValueError("Need to specify either a filename or a file")
         #Render tree to file
-        TAG_Byte(self.id)._render_buffer(self.file)
-        TAG_String(self.name)._render_buffer(self.file)
-        self._render_buffer(self.file)
+        self.file.write(self.render())
         #make sure the file is complete
         if 'flush' in dir(self.file):
             self.file.flush()
         if filename and 'close' in dir(self.file):
             self.file.close()
 
+# Scanning. These functions find tags in NBT data without parsing it, for
+# callers which only want a few tags out of a large structure.
+
+fixed_sizes = {
+    TAG_BYTE: 1,
+    TAG_SHORT: 2,
+    TAG_INT: 4,
+    TAG_LONG: 8,
+    TAG_FLOAT: 4,
+    TAG_DOUBLE: 8,
+}
+
+def skip_payload(data, tagid, offset):
+    """
+    Skip over the payload of a tag.
+
+    :param data: NBT data, as a str or `memoryview`
+    :param int tagid: type of the tag
+    :param int offset: where the payload starts
+    :returns: where the payload ends
+    """
+
+    if tagid in fixed_sizes:
+        return offset + fixed_sizes[tagid]
+    elif tagid == TAG_BYTE_ARRAY:
+        return offset + 4 + _int.unpack_from(data, offset)[0]
+    elif tagid == TAG_STRING:
+        return offset + 2 + _short.unpack_from(data, offset)[0]
+    elif tagid == TAG_LIST:
+        itemid = ord(data[offset])
+        count = _int.unpack_from(data, offset + 1)[0]
+        offset += 5
+        if itemid in fixed_sizes:
+            return offset + count * fixed_sizes[itemid]
+        for i in xrange(count):
+            offset = skip_payload(data, itemid, offset)
+        return offset
+    elif tagid == TAG_COMPOUND:
+        while True:
+            itemid = ord(data[offset])
+            if itemid == TAG_END:
+                return offset + 1
+            offset += 3 + _short.unpack_from(data, offset + 1)[0]
+            if itemid in fixed_sizes:
+                offset += fixed_sizes[itemid]
+            else:
+                offset = skip_payload(data, itemid, offset)
+    else:
+        raise MalformedFileError("Unrecognised tag type %d" % tagid)
+
+def scan_compound(data, offset):
+    """
+    Find the tags in a compound, without parsing them.
+
+    :param str data: NBT data
+    :param int offset: where the compound's payload starts
+    :returns: tuple of a dict, mapping the names of the compound's tags to
+              tuples of their types and the offsets where their payloads
+              start and end, and the offset where the compound ends
+    """
+
+    tags = {}
+
+    try:
+        while True:
+            tagid = ord(data[offset])
+            if tagid == TAG_END:
+                return tags, offset + 1
+
+            length = _short.unpack_from(data, offset + 1)[0]
+            start = offset + 3 + length
+            name = str(data[offset + 3:start])
+            offset = skip_payload(data, tagid, start)
+            tags[name] = tagid, start, offset
+    except (IndexError, StructError):
+        raise MalformedFileError("Partial compound: data possibly truncated.")
+
+def scan_root(data):
+    """
+    Find the tags in the root compound of NBT data, without parsing them.
+
+    :param str data: NBT data
+    :returns: dict, as in `scan_compound()`
+    """
+
+    if not len(data) or ord(data[0]) != TAG_COMPOUND:
+        raise MalformedFileError("First record is not a Compound Tag")
+
+    try:
+        length = _short.unpack_from(data, 1)[0]
+    except StructError:
+        raise MalformedFileError("Partial File Parse: file possibly truncated.")
+
+    return scan_compound(data, 3 + length)[0]
+
+def read_byte_array(data, offset):
+    """
+    Get the payload of a byte array, without copying it.
+
+    :param str data: NBT data
+    :param int offset: where the payload starts
+    :rtype: buffer
+    """
+
+    length = _int.unpack_from(data, offset)[0]
+    if offset + 4 + length > len(data):
+        raise MalformedFileError("Partial byte array: data possibly truncated.")
+
+    return buffer(data, offset + 4, length)
+
 # Useful utility functions for handling large NBT structures elegantly and
 # Pythonically.
 
@@ -379,10 +803,8 @@ def pack_nbt(s):
         return TAG_String(s)
     elif isinstance(s, dict):
         tag = TAG_Compound()
-        for k, v in s:
-            v = pack_nbt(v)
-            v.name = str(k)
-            tag.tags.append(v)
+        for k, v in s.iteritems():
+            tag[str(k)] = pack_nbt(v)
         return tag
     elif hasattr(s, "__iter__"):
         # We arrive at a slight quandry. NBT lists must be homogenous, unlike
@@ -1,5 +1,7 @@
 from collections import namedtuple
+from cStringIO import StringIO
 import functools
+import struct
 
 from construct import Struct, Container, Embed, Enum, MetaField
 from construct import MetaArray, If, Switch, Const, Peek
@@ -10,6 +12,7 @@ from construct import SBInt8, SBInt16, SBInt32, SBInt64
 from construct import BFloat32, BFloat64
 from construct import BitStruct, BitField
 from construct import StringAdapter, LengthValueAdapter, Sequence
+from construct import ConstructError, FieldError, FormatField
 
 DUMP_ALL_PACKETS = False
 
@@ -136,6 +139,15 @@ faces = {
 }
 face = Enum(SBInt8("face"), **faces)
 
+# Digging states.
+dig_states = {
+    "started": 0,
+    "digging": 1,
+    "stopped": 2,
+    "broken": 3,
+    "dropped": 4,
+}
+
 packets = {
     0: Struct("ping"),
     1: Struct("login",
@@ -184,13 +196,7 @@ packets = {
     12: Struct("orientation", orientation, grounded),
     13: Struct("location", position, orientation, grounded),
     14: Struct("digging",
-        Enum(UBInt8("state"),
-            started=0,
-            digging=1,
-            stopped=2,
-            broken=3,
-            dropped=4,
-        ),
+        Enum(UBInt8("state"), **dig_states),
         SBInt32("x"),
         UBInt8("y"),
         SBInt32("z"),
@@ -521,17 +527,126 @@ packets = {
     ),
 }
 
-packet_stream = Struct("packet_stream",
-    OptionalGreedyRange(
-        Struct("full_packet",
-            UBInt8("header"),
-            Switch("payload", lambda context: context["header"], packets),
-        ),
-    ),
-    OptionalGreedyRange(
-        UBInt8("leftovers"),
-    ),
-)
+# Decoders for the fixed-size packets which clients send most often. Each
+# takes the fields unpacked by its struct, and returns the same container as
+# the packet's Construct definition, or None to leave the packet to
+# Construct.
+
+dig_state_names = dict((v, k) for k, v in dig_states.iteritems())
+face_names = dict((v, k) for k, v in faces.iteritems())
+
+def decode_grounded(fields):
+    return Container(grounded=fields[0])
+
+def decode_position(fields):
+    x, y, stance, z, grounded = fields
+    return Container(position=Container(x=x, y=y, stance=stance, z=z),
+        grounded=Container(grounded=grounded))
+
+def decode_orientation(fields):
+    rotation, pitch, grounded = fields
+    return Container(orientation=Container(rotation=rotation, pitch=pitch),
+        grounded=Container(grounded=grounded))
+
+def decode_location(fields):
+    x, y, stance, z, rotation, pitch, grounded = fields
+    return Container(position=Container(x=x, y=y, stance=stance, z=z),
+        orientation=Container(rotation=rotation, pitch=pitch),
+        grounded=Container(grounded=grounded))
+
+def decode_digging(fields):
+    state, x, y, z, face = fields
+    if state not in dig_state_names or face not in face_names:
+        return None
+    return Container(state=dig_state_names[state], x=x, y=y, z=z,
+        face=face_names[face])
+
+fixed_packets = {
+    10: (struct.Struct(">B"), decode_grounded),
+    11: (struct.Struct(">ddddB"), decode_position),
+    12: (struct.Struct(">ffB"), decode_orientation),
+    13: (struct.Struct(">ddddffB"), decode_location),
+    14: (struct.Struct(">BiBib"), decode_digging),
+}
+
+class PacketDecoder(object):
+    """
+    Decoder for a stream of packets which arrives a piece at a time.
+
+    Data is appended to a buffer, and only the bytes after the last complete
+    packet are looked at again. The most common fixed-size packets are
+    unpacked with precompiled structs, and the rest are parsed with
+    Construct.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        """
+        Add data to the stream, and decode as many packets as possible.
+
+        A packet which can't be decoded yet stays in the buffer, along with
+        everything after it, until more data arrives.
+
+        :param str data: the data
+        :returns: list of tuples of packet headers and payloads
+        """
+
+        buf = self.buf
+        buf.extend(data)
+        offset = self.offset
+        end = len(buf)
+
+        l = []
+
+        while offset < end:
+            header = buf[offset]
+            payload = None
+
+            if header in fixed_packets:
+                unpacker, decoder = fixed_packets[header]
+                if offset + 1 + unpacker.size > end:
+                    break
+                payload = decoder(unpacker.unpack_from(buf, offset + 1))
+                length = unpacker.size
+
+            if payload is None:
+                if header not in packets:
+                    break
+                stream = StringIO(buffer(buf, offset + 1))
+                try:
+                    payload = packets[header].parse_stream(stream)
+                except ConstructError:
+                    break
+                length = stream.tell()
+
+            l.append((header, payload))
+            offset += 1 + length
+
+        # Only let go of decoded bytes once they make up most of the buffer,
+        # so that the rest isn't moved every time.
+        if offset > end // 2:
+            del buf[:offset]
+            offset = 0
+        self.offset = offset
+
+        if DUMP_ALL_PACKETS:
+            for packet in l:
+                print "Parsed packet %d" % packet[0]
+                print packet[1]
+
+        return l
+
+    def leftovers(self):
+        """
+        Get the data which hasn't been decoded yet.
+
+        :rtype: str
+        """
+
+        return str(self.buf[self.offset:])
 
 def parse_packets(bytestream):
     """
@@ -542,17 +657,9 @@ def parse_packets(bytestream):
     leftover unparseable bytes.
     """
 
-    container = packet_stream.parse(bytestream)
-
-    l = [(i.header, i.payload) for i in container.full_packet]
-    leftovers = "".join(chr(i) for i in container.leftovers)
-
-    if DUMP_ALL_PACKETS:
-        for packet in l:
-            print "Parsed packet %d" % packet[0]
-            print packet[1]
-
-    return l, leftovers
+    decoder = PacketDecoder()
+    l = decoder.feed(bytestream)
+    return l, decoder.leftovers()
 
 incremental_packet_stream = Struct("incremental_packet_stream",
     Struct("full_packet",
@@ -642,6 +749,40 @@ packets_by_name = {
     "error"              : 255,
 }
 
+def compile_encoder(header):
+    """
+    Compile a packet whose fields are all fixed-size into a function which
+    packs it with a single struct, instead of building it with Construct.
+
+    :param int header: the packet's header
+    :returns: function which takes a dictionary of the packet's fields, and
+              returns the packet, header and all
+    """
+
+    fields = packets[header].subcons
+    for field in fields:
+        if (not isinstance(field, FormatField) or
+            not field.packer.format.startswith(">")):
+            raise ValueError("Packet %d doesn't have a fixed layout" % header)
+
+    names = [field.name for field in fields]
+    packer = struct.Struct(">B" +
+        "".join(field.packer.format[1:] for field in fields))
+
+    def encode(container):
+        try:
+            return packer.pack(header, *[container[name] for name in names])
+        except struct.error, e:
+            raise FieldError(e)
+
+    return encode
+
+# Encoders for the packets which are sent most often.
+packet_encoders = dict((packets_by_name[name],
+    compile_encoder(packets_by_name[name])) for name in ("ping", "time",
+    "destroy", "entity-orientation", "entity-location", "teleport",
+    "prechunk", "block"))
+
 def make_packet(packet, *args, **kwargs):
     """
     Constructs a packet bytestream from a packet header and payload.
@@ -659,6 +800,10 @@ def make_packet(packet, *args, **kwargs):
 
     for arg in args:
         kwargs.update(dict(arg))
+
+    if header in packet_encoders and not DUMP_ALL_PACKETS:
+        return packet_encoders[header](kwargs)
+
     container = Container(**kwargs)
 
     if DUMP_ALL_PACKETS:
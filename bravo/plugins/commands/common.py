@@ -1,3 +1,4 @@
+from itertools import chain
 from textwrap import wrap
 
 from twisted.internet import reactor
@@ -250,8 +251,7 @@ class Quit(object):
         factory.broadcast(packet)
 
         yield "Saving all chunks to disk..."
-        for chunk in factory.world.dirty_chunk_cache.itervalues():
-            factory.world.save_chunk(chunk)
+        factory.world.save_chunks(factory.world.dirty_chunk_cache.values())
 
         yield "Halting."
         reactor.stop()
@@ -270,8 +270,9 @@ class SaveAll(object):
     def console_command(self, parameters):
         yield "Flushing all chunks..."
 
-        for chunk in factory.world.chunk_cache.itervalues():
-            factory.world.save_chunk(chunk)
+        world = factory.world
+        world.save_chunks(list(chain(world.chunk_cache.itervalues(),
+            world.dirty_chunk_cache.itervalues())))
 
         yield "Save complete!"
 
@@ -3,11 +3,9 @@ from __future__ import division
 from gzip import GzipFile
 from itertools import chain
 import os
-from StringIO import StringIO
-from struct import pack, unpack
 from urlparse import urlparse
 
-from numpy import array, fromstring, uint8
+from numpy import frombuffer, fromstring, uint8
 
 from twisted.python import log
 from twisted.python.filepath import FilePath
@@ -18,10 +16,12 @@ from bravo.errors import SerializerReadException, SerializerWriteException
 from bravo.ibravo import ISerializer, ISerializerFactory
 from bravo.inventory import Slot
 from bravo.location import Location
-from bravo.nbt import NBTFile
+from bravo.nbt import NBTFile, parse_payload
+from bravo.nbt import read_byte_array, scan_compound, scan_root
 from bravo.nbt import TAG_Compound, TAG_List, TAG_Byte_Array, TAG_String
 from bravo.nbt import TAG_Double, TAG_Long, TAG_Short, TAG_Int, TAG_Byte
-from bravo.utilities.bits import unpack_nibbles, pack_nibbles
+from bravo.region import RegionPool, decompress_record, recover_region
+from bravo.utilities.bits import unpack_nibble_array
 
 # Due to technical limitations in the way Twisted discovers plugins, here is
 # how this file works:
@@ -165,7 +165,8 @@ class Alpha(object):
 
     def _read_tag(self, fp):
         if fp.exists() and fp.getsize():
-            return NBTFile(fileobj=fp.open("r"))
+            # Only a few tags are ever wanted out of these files.
+            return NBTFile(fileobj=fp.open("r"), lazy=True)
         return None
 
     def _write_tag(self, fp, tag):
@@ -363,15 +364,63 @@ class Alpha(object):
             dtype=uint8).reshape(chunk.blocks.shape)
         chunk.heightmap = fromstring(level["HeightMap"].value,
             dtype=uint8).reshape(chunk.heightmap.shape)
-        chunk.blocklight = array(unpack_nibbles(
-            level["BlockLight"].value)).reshape(chunk.blocklight.shape)
-        chunk.metadata = array(unpack_nibbles(
-            level["Data"].value)).reshape(chunk.metadata.shape)
-        chunk.skylight = array(unpack_nibbles(
-            level["SkyLight"].value)).reshape(chunk.skylight.shape)
+        chunk.blocklight = unpack_nibble_array(fromstring(
+            level["BlockLight"].value, dtype=uint8)).reshape(
+            chunk.blocklight.shape)
+        chunk.metadata = unpack_nibble_array(fromstring(
+            level["Data"].value, dtype=uint8)).reshape(chunk.metadata.shape)
+        chunk.skylight = unpack_nibble_array(fromstring(
+            level["SkyLight"].value, dtype=uint8)).reshape(
+            chunk.skylight.shape)
 
         chunk.populated = bool(level["TerrainPopulated"])
 
+        self._load_chunk_entities_from_tag(chunk, level)
+
+        chunk.dirty = not chunk.populated
+
+    def _load_chunk_from_data(self, chunk, data):
+        """
+        Load a chunk from NBT data.
+
+        This is a faster `_load_chunk_from_tag()`. The per-block arrays are
+        found in the data and split straight into the chunk's sections,
+        without parsing the data into tags; only entities and tiles are
+        parsed.
+        """
+
+        tagid, start, end = scan_root(data)["Level"]
+        level = scan_compound(data, start)[0]
+
+        for name, layer in (("Blocks", "blocks"), ("Data", "metadata"),
+            ("SkyLight", "skylight"), ("BlockLight", "blocklight")):
+            chunk.set_layer_bytes(layer, read_byte_array(data,
+                level[name][1]))
+        chunk.heightmap = frombuffer(read_byte_array(data,
+            level["HeightMap"][1]), dtype=uint8).reshape(
+            chunk.heightmap.shape).copy()
+
+        # A chunk is populated as long as it has this tag, whatever its
+        # value, just like with _load_chunk_from_tag().
+        if "TerrainPopulated" not in level:
+            raise KeyError("TerrainPopulated")
+        chunk.populated = True
+
+        tags = TAG_Compound()
+        view = memoryview(data)
+        for name in ("Entities", "TileEntities"):
+            if name in level:
+                tagid, start, end = level[name]
+                tags[name] = parse_payload(view, tagid, start)[0]
+        self._load_chunk_entities_from_tag(chunk, tags)
+
+        chunk.dirty = not chunk.populated
+
+    def _load_chunk_entities_from_tag(self, chunk, level):
+        """
+        Load a chunk's entities and tiles from a tag.
+        """
+
         if "Entities" in level:
             for tag in level["Entities"].tags:
                 try:
@@ -392,8 +441,6 @@ class Alpha(object):
                     print "Tag for tile:"
                     print tag.pretty_tree()
 
-        chunk.dirty = not chunk.populated
-
     def _save_chunk_to_tag(self, chunk):
         tag = NBTFile()
         tag.name = ""
@@ -410,11 +457,11 @@ class Alpha(object):
         level["Data"] = TAG_Byte_Array()
         level["SkyLight"] = TAG_Byte_Array()
 
-        level["Blocks"].value = chunk.blocks.tostring()
+        level["Blocks"].value = chunk.get_layer_bytes("blocks")
         level["HeightMap"].value = chunk.heightmap.tostring()
-        level["BlockLight"].value = pack_nibbles(chunk.blocklight)
-        level["Data"].value = pack_nibbles(chunk.metadata)
-        level["SkyLight"].value = pack_nibbles(chunk.skylight)
+        level["BlockLight"].value = chunk.get_layer_bytes("blocklight")
+        level["Data"].value = chunk.get_layer_bytes("metadata")
+        level["SkyLight"].value = chunk.get_layer_bytes("skylight")
 
         level["TerrainPopulated"] = TAG_Byte(chunk.populated)
 
@@ -486,6 +533,14 @@ class Alpha(object):
 
     # ISerializer API.
 
+    def recover(self):
+        # Alpha files are rewritten whole, so there's nothing to recover.
+        pass
+
+    def close(self):
+        # Alpha files are never held open.
+        pass
+
     def load_chunk(self, chunk):
         first, second, filename = names_for_chunk(chunk.x, chunk.z)
         fp = self.folder.child(first).child(second)
@@ -493,22 +548,36 @@ class Alpha(object):
             fp.makedirs()
         fp = fp.child(filename)
 
-        tag = self._read_tag(fp)
-        if not tag:
+        if not fp.exists() or not fp.getsize():
             return
 
         try:
-            self._load_chunk_from_tag(chunk, tag)
+            handle = fp.open("r")
+            data = GzipFile(fileobj=handle).read()
+            handle.close()
+            self._load_chunk_from_data(chunk, data)
         except Exception, e:
             raise SerializerReadException(e)
 
+    def load_chunks(self, chunks):
+        for chunk in chunks:
+            self.load_chunk(chunk)
+
     def save_chunk(self, chunk):
+        return self.write_chunk(chunk.x, chunk.z, self.encode_chunk(chunk))
+
+    def save_chunks(self, chunks):
+        return self.write_chunks([(chunk.x, chunk.z, self.encode_chunk(chunk))
+            for chunk in chunks])
+
+    def encode_chunk(self, chunk):
         try:
-            tag = self._save_chunk_to_tag(chunk)
+            return self._save_chunk_to_tag(chunk)
         except Exception, e:
             raise SerializerWriteException(e)
 
-        first, second, filename = names_for_chunk(chunk.x, chunk.z)
+    def write_chunk(self, x, z, tag):
+        first, second, filename = names_for_chunk(x, z)
         fp = self.folder.child(first).child(second)
         if not fp.exists():
             fp.makedirs()
@@ -516,6 +585,10 @@ class Alpha(object):
 
         self._write_tag(fp, tag)
 
+    def write_chunks(self, records):
+        for x, z, tag in records:
+            self.write_chunk(x, z, tag)
+
     def load_level(self, level):
         tag = self._read_tag(self.folder.child("level.dat"))
         if not tag:
@@ -599,10 +672,44 @@ class Beta(Alpha):
 
     name = "beta"
 
+    open_regions = 16
+    """
+    The number of region files to keep open.
+    """
+
+    use_mmap = True
+    """
+    Whether to map region files into memory for reading.
+    """
+
+    journal = True
+    """
+    Whether to journal writes to region files, so that they survive crashes.
+    """
+
+    held_chunks = 32
+    """
+    The number of chunks written one at a time which are held back, to be
+    written together with one header update and sync per region.
+    """
+
     def __init__(self, url):
         Alpha.__init__(self, url)
 
-        self.regions = dict()
+        self.regions = RegionPool(self.open_regions, self.use_mmap,
+            self.journal)
+
+        # Records written one at a time, which haven't reached the disk yet.
+        self.held = []
+
+    def flush(self):
+        """
+        Write the chunks which were held back.
+
+        :returns: the number of bytes written
+        """
+
+        return self.write_chunks([])
 
     def _save_level_to_tag(self, level):
         tag = Alpha._save_level_to_tag(self, level)
@@ -614,152 +721,92 @@ class Beta(Alpha):
 
         return tag
 
-    def cache_region_pages(self, region):
-        """
-        Cache the pages of a region.
-        """
-
-        fp = self.folder.child("region").child(region)
-        handle = fp.open("r")
-        page = handle.read(4096)
-        # The + 1 is not gratuitous. Remember that range/xrange won't include
-        # the upper index, but we want it, so we need to increase our upper
-        # bound. Additionally, the first page is off-limits.
-        free_pages = set(xrange(2, (fp.getsize() // 4096) + 1))
-        positions = dict()
-
-        for x in xrange(32):
-            for z in xrange(32):
-                offset = 4 * (x + z * 32)
-                position = unpack(">L", page[offset:offset+4])[0]
-                pages = position & 0xff
-                position >>= 8
-                if position and pages:
-                    positions[x, z] = position, pages
-                    for i in xrange(pages):
-                        free_pages.discard(position + i)
-
-        self.regions[region] = positions, free_pages
-
-    def load_chunk(self, chunk):
-        region = name_for_region(chunk.x, chunk.z)
-        fp = self.folder.child("region").child(region)
+    def recover(self):
+        fp = self.folder.child("region")
         if not fp.exists():
             return
 
-        x, z = chunk.x % 32, chunk.z % 32
+        for journal in fp.globChildren("*.mcr.journal"):
+            region = journal.sibling(journal.basename()[:-len(".journal")])
+            if region in self.regions:
+                continue
+            if recover_region(region):
+                log.msg("Finished interrupted write to %s" % region.path)
+            else:
+                log.msg("Discarded interrupted write to %s" % region.path)
 
-        if region not in self.regions:
-            self.cache_region_pages(region)
+    def close(self):
+        self.flush()
+        self.regions.close()
 
-        positions = self.regions[region][0]
-
-        if (x, z) not in positions:
-            return
-
-        position, pages = positions[x, z]
-
-        if not position or not pages:
-            return
+    def region_for_chunk(self, x, z, create=False):
+        """
+        Get the open region containing a chunk.
 
-        handle = fp.open("r")
-        handle.seek(position * 4096)
-        data = handle.read(pages * 4096)
-        length = unpack(">L", data[:4])[0] - 1
-        version = ord(data[4])
+        :returns: `Region`, or None if the region doesn't exist
+        """
 
-        data = data[5:length+5]
-        if version == 1:
-            data = data.decode("gzip")
-            fileobj = GzipFile(fileobj=StringIO(data))
-        elif version == 2:
-            fileobj = StringIO(data.decode("zlib"))
+        fp = self.folder.child("region")
+        if create and not fp.exists():
+            fp.makedirs()
 
-        tag = NBTFile(buffer=fileobj)
+        return self.regions.get(fp.child(name_for_region(x, z)), create)
 
-        return self._load_chunk_from_tag(chunk, tag)
+    def load_chunk(self, chunk):
+        self.load_chunks([chunk])
 
-    def save_chunk(self, chunk):
-        tag = self._save_chunk_to_tag(chunk)
-        b = StringIO()
-        tag.write_file(buffer=b)
-        data = b.getvalue().encode("zlib")
+    def load_chunks(self, chunks):
+        # Chunks which were held back must be read back as they were saved.
+        if self.held:
+            self.flush()
 
-        region = name_for_region(chunk.x, chunk.z)
-        fp = self.folder.child("region")
-        if not fp.exists():
-            fp.makedirs()
-        fp = fp.child(region)
-        if not fp.exists():
-            # Create the file and zero out the header, plus a spare page for
-            # Notchian software.
-            handle = fp.open("w")
-            handle.write("\x00" * 8192)
-            handle.close()
+        regions = dict()
+        for chunk in chunks:
+            name = name_for_region(chunk.x, chunk.z)
+            regions.setdefault(name, []).append(chunk)
 
-        if region not in self.regions:
-            self.cache_region_pages(region)
+        for chunks in regions.itervalues():
+            region = self.region_for_chunk(chunks[0].x, chunks[0].z)
+            if region is None:
+                continue
 
-        positions = self.regions[region][0]
+            records = region.read_many((chunk.x % 32, chunk.z % 32)
+                for chunk in chunks)
 
-        x, z = chunk.x % 32, chunk.z % 32
+            for chunk in chunks:
+                record = records.get((chunk.x % 32, chunk.z % 32))
+                if record is None:
+                    continue
 
-        if (x, z) in positions:
-            position, pages = positions[x, z]
-        else:
-            position, pages = 0, 0
-
-        # Pack up the data, all ready to go.
-        data = "%s\x02%s" % (pack(">L", len(data) + 1), data)
-        needed_pages = (len(data) + 4095) // 4096
-
-        handle = fp.open("r+")
-
-        # I should comment this, since it's not obvious in the original MCR
-        # code either. The reason that we might want to reallocate pages if we
-        # have shrunk, and not just grown, is that it allows the region to
-        # self-vacuum somewhat by reusing single unused pages near the
-        # beginning of the file. While this isn't an absolute guarantee, the
-        # potential savings, and the guarantee that sometime during this
-        # method we *will* be blocking, makes it worthwhile computationally.
-        # This is a lot cheaper than an explicit vacuum, by the way!
-        if not position or not pages or pages != needed_pages:
-            free_pages = self.regions[region][1]
-
-            # Deallocate our current home.
-            for i in xrange(pages):
-                free_pages.add(position + i)
-
-            # Find a new home for us.
-            found = False
-            for candidate in sorted(free_pages):
-                if all(candidate + i in free_pages
-                    for i in range(needed_pages)):
-                        # Excellent.
-                        position = candidate
-                        found = True
-                        break
-
-            # If we couldn't find a reusable run of pages, we should just go
-            # to the end of the file.
-            if not found:
-                position = (fp.getsize() + 4095) // 4096
-
-            # And allocate our new home.
-            for i in xrange(needed_pages):
-                free_pages.discard(position + i)
-
-        pages = needed_pages
-
-        positions[x, z] = position, pages
-
-        # Write our payload.
-        handle.seek(position * 4096)
-        handle.write(data)
-
-        # Write our position and page count.
-        offset = 4 * (x + z * 32)
-        position = position << 8 | pages
-        handle.seek(offset)
-        handle.write(pack(">L", position))
-        handle.close()
+                try:
+                    self._load_chunk_from_data(chunk,
+                        decompress_record(*record))
+                except Exception, e:
+                    raise SerializerReadException(e)
+
+    def _compress_tag(self, tag):
+        return tag.render().encode("zlib")
+
+    def write_chunk(self, x, z, tag):
+        # Writing chunks one at a time would sync the region every time, so
+        # they are held back and written together with the next batch.
+        self.held.append((x, z, tag))
+        if len(self.held) >= self.held_chunks:
+            return self.flush()
+
+    def write_chunks(self, records):
+        held, self.held = self.held, []
+
+        regions = dict()
+        for x, z, tag in chain(held, records):
+            name = name_for_region(x, z)
+            regions.setdefault(name, []).append((x, z, tag))
+
+        written = 0
+        for records in regions.itervalues():
+            x, z, tag = records[0]
+            region = self.region_for_chunk(x, z, create=True)
+            written += region.write_many((x % 32, z % 32,
+                self._compress_tag(tag)) for x, z, tag in records)
+
+        return written
@@ -1,17 +1,18 @@
-from collections import namedtuple
+from collections import deque, namedtuple
 from itertools import product, chain
 from time import time
 from urlparse import urlunparse
-from math import pi
 
 from twisted.internet import reactor
-from twisted.internet.defer import (DeferredList, inlineCallbacks,
-    maybeDeferred, succeed)
+from twisted.internet.defer import (Deferred, DeferredList,
+    inlineCallbacks, maybeDeferred, succeed)
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Protocol
 from twisted.internet.task import cooperate, deferLater, LoopingCall
 from twisted.internet.task import TaskDone, TaskFailed
 from twisted.python import log
 from twisted.web.client import getPage
+from zope.interface import implements
 
 from bravo.blocks import blocks, items
 from bravo.config import configuration
@@ -23,25 +24,148 @@ from bravo.ibravo import (IChatCommand, IPreBuildHook, IPostBuildHook,
 from bravo.inventory import Workbench, sync_inventories
 from bravo.location import Location
 from bravo.motd import get_motd
-from bravo.packets.beta import parse_packets, make_packet, make_error_packet
+from bravo.packets.beta import PacketDecoder, make_packet, make_error_packet
 from bravo.plugin import retrieve_plugins
 from bravo.policy.dig import dig_policies
-from bravo.utilities.coords import split_coords
+from bravo.utilities.coords import circle, split_coords
 from bravo.utilities.chat import username_alternatives
 
 (STATE_UNAUTHENTICATED, STATE_CHALLENGED, STATE_AUTHENTICATED) = range(3)
 
 SUPPORTED_PROTOCOL = 13
 
-circle = [(i, j)
-    for i, j in product(xrange(-10, 10), xrange(-10, 10))
-    if i**2 + j**2 <= 100
-]
+BuildData = namedtuple("BuildData", "block, metadata, x, y, z, face")
+
+bulk_packets = set([13, 50, 51, 52, 53, 130])
 """
-A list of points in a filled circle of radius 10.
+The headers of packets which carry chunk data, or which clients can't handle
+before they have the chunk data they need.
 """
 
-BuildData = namedtuple("BuildData", "block, metadata, x, y, z, face")
+class PacketQueue(object):
+    """
+    A transport which queues packets, and writes them all out once per
+    reactor turn.
+
+    Packets fall into two classes: chunk data, which is "bulk", and
+    everything else, which is "interactive". Interactive packets queued
+    during a turn are written before bulk packets, and bulk packets are held
+    back while the transport is backed up, so that streaming chunks can't
+    hold up movement and chat. Packets within a class are written in the
+    order they were queued.
+
+    Packets which depend on chunk data, such as the avatars standing in a
+    chunk which was just queued, can be queued behind it by setting
+    ``behind_bulk`` while they are written; they are classed as bulk. If
+    they are written with a key, such as the ID of the entity they are
+    about, every later packet written with that key is queued behind them,
+    until the bulk packets are written out, so that packets about the same
+    thing are never reordered.
+
+    :ivar dict bytes: number of bytes written, for each class
+    """
+
+    implements(IPushProducer)
+
+    paused = False
+    pending = None
+    behind_bulk = False
+
+    def __init__(self, transport, clock=reactor):
+        """
+        :param transport: the transport to write to
+        :param clock: provider of ``callLater()``
+        """
+
+        self.transport = transport
+        self.clock = clock
+
+        self.interactive = []
+        self.bulk = []
+        # The keys of packets queued as bulk, which hold back later packets
+        # with the same keys.
+        self.held = set()
+        self.bytes = {"interactive": 0, "bulk": 0}
+
+        transport.registerProducer(self, True)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def write(self, data, key=None):
+        """
+        Queue some packets.
+
+        Data is classed by its first packet, so packets written together are
+        always written out together.
+
+        :param key: what the packets are about, if they have to stay in
+                    order with other packets about the same thing
+        """
+
+        if not data:
+            return
+
+        if self.behind_bulk or key in self.held:
+            self.bulk.append(data)
+            if key is not None:
+                self.held.add(key)
+        elif ord(data[0]) in bulk_packets:
+            self.bulk.append(data)
+        else:
+            self.interactive.append(data)
+
+        if self.pending is None:
+            self.pending = self.clock.callLater(0, self.flush)
+
+    def writeSequence(self, data):
+        for i in data:
+            self.write(i)
+
+    def flush(self, force=False):
+        """
+        Write out queued packets.
+
+        :param bool force: whether to write bulk packets even while the
+                           transport is backed up
+        """
+
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+
+        if self.interactive:
+            data = "".join(self.interactive)
+            self.interactive = []
+            self.bytes["interactive"] += len(data)
+            self.transport.write(data)
+
+        if self.bulk and (force or not self.paused):
+            data = "".join(self.bulk)
+            self.bulk = []
+            self.bytes["bulk"] += len(data)
+            self.transport.write(data)
+            self.held.clear()
+
+    def loseConnection(self):
+        self.flush(force=True)
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.bulk and self.pending is None:
+            self.pending = self.clock.callLater(0, self.flush)
+
+    def stopProducing(self):
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+        self.interactive = []
+        self.bulk = []
 
 class BetaServerProtocol(Protocol):
     """
@@ -56,7 +180,6 @@ class BetaServerProtocol(Protocol):
 
     state = STATE_UNAUTHENTICATED
 
-    buf = ""
     parser = None
     handler = None
 
@@ -70,6 +193,8 @@ class BetaServerProtocol(Protocol):
 
         self.location = Location()
 
+        self.decoder = PacketDecoder()
+
         self.handlers = {
             0: self.ping,
             1: self.login,
@@ -267,12 +392,11 @@ class BetaServerProtocol(Protocol):
     # Please don't override these needlessly, as they are pretty solid and
     # shouldn't need to be touched.
 
-    def dataReceived(self, data):
-        self.buf += data
-
-        packets, self.buf = parse_packets(self.buf)
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, PacketQueue(transport))
 
-        for header, payload in packets:
+    def dataReceived(self, data):
+        for header, payload in self.decoder.feed(data):
             if header in self.handlers:
                 self.handlers[header](payload)
             else:
@@ -422,6 +546,10 @@ class BravoProtocol(BetaServerProtocol):
 
     time_loop = None
 
+    # Whether the connection has been lost. Chunks which were on their way
+    # before then are dropped instead of being written.
+    disconnected = False
+
     eid = 0
 
     last_dig = None
@@ -431,6 +559,10 @@ class BravoProtocol(BetaServerProtocol):
 
         self.config_name = "world %s" % name
 
+        # Chunks which are waiting for their packets, in the order that they
+        # were sent.
+        self.chunk_queue = deque()
+
         log.msg("Registering client hooks...")
 
         # Retrieve the MOTD. Only needs to be done once.
@@ -468,23 +600,12 @@ class BravoProtocol(BetaServerProtocol):
             message="%s is joining the game..." % self.username)
         self.factory.broadcast(packet)
 
-        # Craft our avatar and send it to already-connected other players.
-        packet = self.player.save_to_packet()
-        packet += make_packet("create", eid=self.player.eid)
-        self.factory.broadcast_for_others(packet, self)
-
-        # And of course spawn all of those players' avatars in our client as
-        # well. Note that, at this point, we are not listed in the factory's
-        # list of protocols, so we won't accidentally send one of these to
-        # ourselves.
-        for protocol in self.factory.protocols.itervalues():
-            packet = protocol.player.save_to_packet()
-            packet += protocol.player.save_equipment_to_packet()
-            packet += make_packet("create", eid=protocol.player.eid)
-            self.transport.write(packet)
-
         self.factory.protocols[self.username] = self
 
+        # Our avatar is shown to other players, and theirs to us, as chunks
+        # around each other are loaded.
+        self.factory.tracker.add(self)
+
         # Send spawn and inventory.
         spawn = self.factory.world.spawn
         packet = make_packet("spawn", x=spawn[0], y=spawn[1], z=spawn[2])
@@ -501,29 +622,18 @@ class BravoProtocol(BetaServerProtocol):
 
     def orientation_changed(self):
         # Bang your head!
-        packet = make_packet("entity-orientation",
-            eid=self.player.eid,
-            yaw=int(self.location.theta * 255 / (2 * pi)) % 256,
-            pitch=int(self.location.phi * 255 / (2 * pi)) % 256,
-        )
-        self.factory.broadcast_for_others(packet, self)
+        self.factory.tracker.moved(self)
 
     def position_changed(self):
-        x, chaff, z, chaff = split_coords(self.location.x, self.location.z)
-
-        # Inform everybody of our new location.
-        packet = make_packet("teleport",
-            eid=self.player.eid,
-            x=self.location.x * 32,
-            y=self.location.y * 32,
-            z=self.location.z * 32,
-            yaw=int(self.location.theta * 255 / (2 * pi)) % 256,
-            pitch=int(self.location.phi * 255 / (2 * pi)) % 256,
-        )
-        self.factory.broadcast_for_others(packet, self)
+        # Inform everybody nearby of our new location.
+        self.factory.tracker.moved(self)
 
         self.update_chunks()
 
+        prefetcher = self.factory.world.prefetcher
+        if prefetcher is not None:
+            prefetcher.moved(self.username, self.location)
+
         for entity in self.entities_near(2):
             if entity.name != "Item":
                 continue
@@ -1034,6 +1144,7 @@ class BravoProtocol(BetaServerProtocol):
     def disable_chunk(self, x, z):
         # Remove the chunk from cache.
         chunk = self.chunks.pop(x, z)
+        self.factory.unsubscribe_chunk(self, x, z)
 
         for entity in chunk.entities:
             packet = make_packet("destroy", eid=entity.eid)
@@ -1062,23 +1173,87 @@ class BravoProtocol(BetaServerProtocol):
         return d
 
     def send_chunk(self, chunk):
-        packet = make_packet("prechunk", x=chunk.x, z=chunk.z, enabled=1)
-        self.transport.write(packet)
+        """
+        Send a chunk.
 
-        packet = chunk.save_to_packet()
-        self.transport.write(packet)
+        The chunk packet is made off of the reactor, so packets might be ready
+        out of order; chunks are still written in the order that they were
+        sent.
+
+        :returns: `Deferred` that will be fired when the chunk is written,
+                  with no arguments
+        """
+
+        if self.disconnected:
+            return succeed(None)
+
+        self.factory.world.relight_chunk(chunk)
+
+        entry = [chunk, chunk.generation, None, Deferred()]
+        self.chunk_queue.append(entry)
+
+        def ready(packet):
+            entry[2] = packet
+            self.flush_chunk_queue()
+
+        def failed(failure):
+            if entry in self.chunk_queue:
+                self.chunk_queue.remove(entry)
+            self.flush_chunk_queue()
+            entry[3].errback(failure)
+
+        self.factory.make_chunk_packet(chunk).addCallbacks(ready, failed)
+
+        return entry[3]
+
+    def flush_chunk_queue(self):
+        """
+        Write every chunk at the front of the chunk queue whose packet is
+        ready.
+        """
+
+        if self.disconnected:
+            return
+
+        while self.chunk_queue and self.chunk_queue[0][2] is not None:
+            chunk, generation, packet, d = self.chunk_queue.popleft()
+            self.write_chunk(chunk, packet)
+
+            if chunk.generation != generation:
+                # The chunk changed while its packet was being made, and the
+                # damage wasn't sent here, so send the whole chunk again.
+                self.send_chunk(chunk)
+
+            d.callback(None)
+
+    def write_chunk(self, chunk, packet):
+        if self.disconnected:
+            return
+
+        # The chunk's entities and signs are written along with the chunk,
+        # so that they can't arrive before it.
+        packets = [make_packet("prechunk", x=chunk.x, z=chunk.z, enabled=1),
+            packet]
 
         for entity in chunk.entities:
-            packet = entity.save_to_packet()
-            self.transport.write(packet)
+            packets.append(entity.save_to_packet())
 
         for entity in chunk.tiles.itervalues():
             if entity.name == "Sign":
-                packet = entity.save_to_packet()
-                self.transport.write(packet)
+                packets.append(entity.save_to_packet())
+
+        self.transport.write("".join(packets))
 
         self.chunks[chunk.x, chunk.z] = chunk
 
+        # Subscribing spawns the avatars standing in the chunk, which can't
+        # arrive before the chunk either.
+        self.transport.behind_bulk = True
+        try:
+            self.factory.subscribe_chunk(self, chunk.x, chunk.z)
+        finally:
+            self.transport.behind_bulk = False
+
     def send_initial_chunk_and_location(self):
         bigx, smallx, bigz, smallz = split_coords(self.location.x,
             self.location.z)
@@ -1165,11 +1340,22 @@ class BravoProtocol(BetaServerProtocol):
                 except (TaskDone, TaskFailed):
                     pass
 
+        # Chunks still waiting for their packets would subscribe this
+        # protocol again once they were written.
+        self.disconnected = True
+        self.chunk_queue.clear()
+
+        self.factory.tracker.remove(self)
+
+        for x, z in self.chunks:
+            self.factory.unsubscribe_chunk(self, x, z)
+
+        if self.factory.world.prefetcher is not None:
+            self.factory.world.prefetcher.forget(self.username)
+
         if self.player:
             self.factory.world.save_player(self.username, self.player)
             self.factory.destroy_entity(self.player)
-            packet = make_packet("destroy", eid=self.player.eid)
-            self.factory.broadcast(packet)
             self.factory.chat("%s has left the game." % self.username)
 
         if self.username in self.factory.protocols:
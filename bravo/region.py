@@ -0,0 +1,560 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from gzip import GzipFile
+import mmap
+import os
+from StringIO import StringIO
+from struct import pack, unpack, unpack_from
+from time import time
+from zlib import crc32, decompress
+
+from bravo.errors import MalformedFileError
+
+class PageAllocator(object):
+    """
+    Allocator for runs of pages in a region.
+
+    Free pages are kept as extents, which are indexed by position, so that
+    freed runs can be merged with their neighbours, and by length, so that
+    the smallest run which fits can be found with a binary search.
+    """
+
+    def __init__(self, used, end):
+        """
+        :param used: iterable of (position, pages) runs which are in use
+        :param int end: the first page past the end of the region
+        """
+
+        self.extents = dict()
+        self.starts = []
+        self.lengths = []
+
+        # Everything after the two header pages is free, except for the used
+        # runs. Runs might overlap in damaged regions, so be careful.
+        position = 2
+        for start, length in sorted(used):
+            if start > position:
+                self._add(position, start - position)
+            position = max(position, start + length)
+
+        self.end = max(end, position)
+        if self.end > position:
+            self._add(position, self.end - position)
+
+    def __len__(self):
+        """
+        The number of free pages.
+        """
+
+        return sum(self.extents.itervalues())
+
+    def _add(self, start, length):
+        self.extents[start] = length
+        insort(self.starts, start)
+        insort(self.lengths, (length, start))
+
+    def _remove(self, start):
+        length = self.extents.pop(start)
+        del self.starts[bisect_left(self.starts, start)]
+        del self.lengths[bisect_left(self.lengths, (length, start))]
+        return length
+
+    def allocate(self, pages):
+        """
+        Allocate a run of pages.
+
+        The smallest free run which fits is used, lowest position first.
+        Otherwise, the region grows, reusing any free pages at its end.
+
+        :returns: the position of the run
+        """
+
+        i = bisect_left(self.lengths, (pages, 0))
+        if i < len(self.lengths):
+            length, start = self.lengths[i]
+            self._remove(start)
+            if length > pages:
+                self._add(start + pages, length - pages)
+            return start
+
+        start = self.end
+        if self.starts:
+            last = self.starts[-1]
+            if last + self.extents[last] == self.end:
+                start = last
+                self._remove(last)
+
+        self.end = start + pages
+        return start
+
+    def free(self, position, pages):
+        """
+        Free a run of pages, merging it with its free neighbours.
+        """
+
+        if not pages:
+            return
+
+        i = bisect_left(self.starts, position)
+        if i:
+            previous = self.starts[i - 1]
+            if previous + self.extents[previous] == position:
+                pages += self._remove(previous)
+                position = previous
+
+        if position + pages in self.extents:
+            pages += self._remove(position + pages)
+
+        self._add(position, pages)
+
+class Region(object):
+    """
+    An open MCRegion file.
+
+    Regions are made of 4 KiB pages. The first page of the file is a header
+    which maps each of the region's 32x32 chunks to a run of pages; chunks
+    are stored as compressed NBT in those pages.
+
+    The second page holds the time at which each chunk was last written.
+
+    The header is parsed once, when the region is opened, and kept in sync
+    with the file afterwards. The file stays open, and may be mapped into
+    memory so that chunks can be read without copying them.
+
+    Regions may be journaled. Journaled regions never write over the pages
+    of a chunk; new copies of chunks are written to free pages, and then the
+    header is switched over to them with the help of a journal, so that a
+    crash at any point leaves either the old or the new copies of chunks.
+    """
+
+    def __init__(self, fp, use_mmap=True, journal=True):
+        """
+        Open a region file, creating it if necessary.
+
+        Interrupted writes to the region are finished or discarded first.
+
+        :param `FilePath` fp: the region file
+        :param bool use_mmap: whether to map the file for reading
+        :param bool journal: whether to journal writes
+        """
+
+        self.fp = fp
+        self.journal = journal
+
+        recover_region(fp)
+
+        if not fp.exists():
+            # Create the file and zero out the header, plus a spare page for
+            # Notchian software.
+            handle = fp.open("w")
+            handle.write("\x00" * 8192)
+            handle.close()
+
+        self.handle = fp.open("r+")
+        self.size = os.fstat(self.handle.fileno()).st_size
+
+        self.use_mmap = use_mmap
+        self.map = None
+
+        self.read_header()
+        self.remap()
+
+    def read_header(self):
+        """
+        Parse the header, finding the chunks and free pages in the region.
+        """
+
+        self.handle.seek(0)
+        header = self.handle.read(8192).ljust(8192, "\x00")
+
+        self.positions = dict()
+        self.timestamps = dict()
+
+        for i, position in enumerate(unpack(">1024L", header[:4096])):
+            pages = position & 0xff
+            position >>= 8
+            if position and pages:
+                self.positions[i % 32, i // 32] = position, pages
+
+        for i, timestamp in enumerate(unpack(">1024L", header[4096:])):
+            if timestamp:
+                self.timestamps[i % 32, i // 32] = timestamp
+
+        self.allocator = PageAllocator(self.positions.itervalues(),
+            (self.size + 4095) // 4096)
+
+    def remap(self):
+        """
+        Map the whole file into memory again, after it has grown.
+        """
+
+        if not self.use_mmap:
+            return
+
+        if self.map is not None:
+            self.map.close()
+
+        self.map = mmap.mmap(self.handle.fileno(), self.size,
+            access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        self.handle.close()
+
+    def header(self):
+        """
+        Pack both header pages.
+
+        :rtype: str
+        """
+
+        positions = [0] * 1024
+        timestamps = [0] * 1024
+
+        for (x, z), (position, pages) in self.positions.iteritems():
+            positions[x + z * 32] = position << 8 | pages
+        for (x, z), timestamp in self.timestamps.iteritems():
+            timestamps[x + z * 32] = timestamp
+
+        return pack(">1024L", *positions) + pack(">1024L", *timestamps)
+
+    def read(self, x, z):
+        """
+        Read a chunk's compressed data.
+
+        If the file is mapped, the data is a read-only buffer into the map,
+        which is only valid until the region is closed or remapped.
+
+        :param int x: X coordinate of the chunk within the region
+        :param int z: Z coordinate of the chunk within the region
+
+        :returns: tuple of the compression version and the data, or None if
+                  the chunk isn't in the region
+        """
+
+        return self.read_many([(x, z)]).get((x, z))
+
+    def read_many(self, coords):
+        """
+        Read several chunks' compressed data.
+
+        Chunks are read in the order in which they are laid out in the file,
+        and each contiguous run of chunks is read at once.
+
+        :param coords: iterable of (x, z) coordinates within the region
+
+        :returns: dict mapping the coordinates of each chunk in the region to
+                  a tuple of its compression version and its data
+        """
+
+        found = sorted((self.positions[c], c) for c in set(coords)
+            if c in self.positions)
+        records = dict()
+
+        if self.map is not None:
+            for (position, pages), c in found:
+                offset = position * 4096
+                length, version = unpack_from(">LB", self.map, offset)
+                records[c] = version, buffer(self.map, offset + 5, length - 1)
+            return records
+
+        i = 0
+        while i < len(found):
+            (start, pages), c = found[i]
+            end = start + pages
+            j = i + 1
+            while j < len(found) and found[j][0][0] == end:
+                end += found[j][0][1]
+                j += 1
+
+            self.handle.seek(start * 4096)
+            data = self.handle.read((end - start) * 4096)
+
+            for (position, pages), c in found[i:j]:
+                offset = (position - start) * 4096
+                length, version = unpack_from(">LB", data, offset)
+                records[c] = version, data[offset + 5:offset + length + 4]
+
+            i = j
+
+        return records
+
+    def read_nbt(self, x, z):
+        """
+        Read a chunk, and decompress it into a file-like object of NBT.
+
+        :returns: file-like object, or None if the chunk isn't in the region
+        """
+
+        chunk = self.read(x, z)
+        if chunk is None:
+            return None
+
+        return decode(*chunk)
+
+    def write(self, x, z, data):
+        """
+        Write a chunk's zlib-compressed data.
+
+        :param int x: X coordinate of the chunk within the region
+        :param int z: Z coordinate of the chunk within the region
+        :param str data: compressed data
+
+        :returns: the number of bytes written
+        """
+
+        return self.write_many([(x, z, data)])
+
+    def write_many(self, chunks):
+        """
+        Write several chunks' zlib-compressed data.
+
+        :param chunks: iterable of (x, z, data) tuples
+
+        :returns: the number of bytes written
+        """
+
+        timestamp = int(time())
+
+        # Pack up the data, all ready to go.
+        return self.write_records((x, z, "%s\x02%s" %
+            (pack(">L", len(data) + 1), data), timestamp)
+            for x, z, data in chunks)
+
+    def write_records(self, records):
+        """
+        Write chunks' records, including their lengths and compression
+        versions.
+
+        The records are written in file order, followed by the header, which
+        is only written once; then the file is synced.
+
+        :param records: iterable of (x, z, record, timestamp) tuples; only
+                        the last record of each chunk is written
+
+        :returns: the number of bytes written
+        """
+
+        latest = OrderedDict()
+        for x, z, data, timestamp in records:
+            latest[x, z] = data, timestamp
+
+        if not latest:
+            return 0
+
+        placed = []
+        freed = []
+        for (x, z), (data, timestamp) in latest.iteritems():
+            position, pages = self.positions.get((x, z), (0, 0))
+            needed_pages = (len(data) + 4095) // 4096
+
+            # Chunks which changed size move. This lets the region
+            # self-vacuum somewhat, since the allocator prefers snug runs of
+            # pages near the beginning of the file, and merges the runs left
+            # behind. In journaled regions, every chunk moves, and its old
+            # pages are only freed once the header stops pointing at them.
+            if self.journal:
+                freed.append((position, pages))
+                position = self.allocator.allocate(needed_pages)
+                pages = needed_pages
+            elif pages != needed_pages:
+                self.allocator.free(position, pages)
+                position = self.allocator.allocate(needed_pages)
+                pages = needed_pages
+
+            self.positions[x, z] = position, pages
+            self.timestamps[x, z] = timestamp
+            placed.append((position, data))
+
+        # Write our payloads.
+        written = 0
+        size = self.size
+        for position, data in sorted(placed):
+            self.handle.seek(position * 4096)
+            self.handle.write(data)
+            written += len(data)
+            size = max(size, position * 4096 + len(data))
+
+        header = self.header()
+        journal = self.fp.siblingExtension(".journal")
+
+        if self.journal:
+            # Make sure that our payloads are on disk before anything points
+            # at them, and then make sure that the new header is, too.
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+
+            handle = journal.open("w")
+            handle.write(pack(">L", crc32(header) & 0xffffffff))
+            handle.write(header)
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.close()
+
+        # Write our positions, page counts, and times.
+        self.handle.seek(0)
+        self.handle.write(header)
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+        if self.journal:
+            journal.remove()
+
+        for position, pages in freed:
+            self.allocator.free(position, pages)
+
+        if size > self.size:
+            self.size = size
+            self.remap()
+
+        return written
+
+def recover_region(fp):
+    """
+    Finish or discard an interrupted write to a region file.
+
+    If the region's journal is complete, its header is written to the
+    region; otherwise, the region's old header still stands. Either way, the
+    journal is removed.
+
+    :param `FilePath` fp: the region file
+
+    :returns: whether an interrupted write was finished
+    """
+
+    journal = fp.siblingExtension(".journal")
+    if not journal.exists():
+        return False
+
+    data = journal.getContent()
+    finished = (len(data) == 8196 and fp.exists() and
+        unpack(">L", data[:4])[0] == crc32(data[4:]) & 0xffffffff)
+
+    if finished:
+        handle = fp.open("r+")
+        handle.write(data[4:])
+        handle.flush()
+        os.fsync(handle.fileno())
+        handle.close()
+
+    journal.remove()
+
+    return finished
+
+def decompress_record(version, data):
+    """
+    Decompress a chunk read from a region into NBT data.
+
+    :rtype: str
+    """
+
+    if version == 1:
+        return GzipFile(fileobj=StringIO(str(data))).read()
+    elif version == 2:
+        return decompress(data)
+    else:
+        raise MalformedFileError("Unknown compression version %d" % version)
+
+def decode(version, data):
+    """
+    Decompress a chunk read from a region into a file-like object of NBT.
+    """
+
+    return StringIO(decompress_record(version, data))
+
+def compact_region(fp):
+    """
+    Defragment a region file, packing its chunks together.
+
+    The region is copied to a temporary file, which then replaces it. This
+    must not be done while the region is open elsewhere.
+
+    :param `FilePath` fp: the region file
+
+    :returns: the number of bytes reclaimed
+    """
+
+    region = Region(fp, use_mmap=False)
+
+    temp = fp.siblingExtension(".tmp")
+    if temp.exists():
+        temp.remove()
+    compacted = Region(temp, use_mmap=False, journal=False)
+
+    # Keep chunks in the order in which they were laid out before.
+    records = []
+    chunks = region.read_many(region.positions)
+    for position, x, z in sorted((position, x, z)
+        for (x, z), position in region.positions.iteritems()):
+        version, data = chunks[x, z]
+        record = pack(">LB", len(data) + 1, version) + data
+        records.append((x, z, record, region.timestamps.get((x, z), 0)))
+    compacted.write_records(records)
+
+    reclaimed = region.size - compacted.size
+
+    region.close()
+    compacted.close()
+    temp.moveTo(fp)
+
+    return reclaimed
+
+class RegionPool(object):
+    """
+    A pool of open regions, keeping the most recently used regions open.
+    """
+
+    def __init__(self, size=16, use_mmap=True, journal=True):
+        """
+        :param int size: the number of regions to keep open
+        :param bool use_mmap: whether to map regions for reading
+        :param bool journal: whether to journal writes to regions
+        """
+
+        self.size = size
+        self.use_mmap = use_mmap
+        self.journal = journal
+        self.regions = OrderedDict()
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __contains__(self, fp):
+        return fp.path in self.regions
+
+    def get(self, fp, create=False):
+        """
+        Get an open region.
+
+        :param `FilePath` fp: the region file
+        :param bool create: whether to create the region if it doesn't exist
+
+        :returns: `Region`, or None if the region doesn't exist
+        """
+
+        region = self.regions.pop(fp.path, None)
+
+        if region is None:
+            if not create and not fp.exists():
+                return None
+
+            region = Region(fp, self.use_mmap, self.journal)
+
+            while len(self.regions) >= self.size:
+                path, old = self.regions.popitem(last=False)
+                old.close()
+
+        self.regions[fp.path] = region
+        return region
+
+    def close(self):
+        """
+        Close every open region.
+        """
+
+        for region in self.regions.itervalues():
+            region.close()
+        self.regions.clear()
@@ -1,59 +1,270 @@
-from ampoule import AMPChild
-import ampoule.pool
+from multiprocessing import Pool, RawArray
+import signal
+from time import time
+import traceback
 
-from twisted.protocols.amp import ListOf, Command, Integer, String
+from numpy import frombuffer, uint8
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
 
 from bravo.chunk import Chunk
 from bravo.ibravo import ITerrainGenerator
 from bravo.plugin import retrieve_sorted_plugins
 
-class MakeChunk(Command):
-    arguments = [
-        ("x", Integer()),
-        ("z", Integer()),
-        ("seed", Integer()),
-        ("generators", ListOf(String())),
-    ]
-    response = [
-        ("blocks", String()),
-        ("metadata", String()),
-        ("skylight", String()),
-        ("blocklight", String()),
-        ("heightmap", String()),
-    ]
-    errors = {
-        Exception: "Exception",
-    }
+# Generated chunks are handed back through shared memory, one slot per chunk
+# being generated. Each slot holds the chunk's arrays as they are stored on
+# disk, followed by its height map.
+slot_layout = []
+slot_size = 0
+for name, size in (("blocks", 32768), ("metadata", 16384),
+    ("skylight", 16384), ("blocklight", 16384)):
+    slot_layout.append((name, slot_size, slot_size + size))
+    slot_size += size
+heightmap_offset = slot_size
+slot_size += 256
+
+# The state of a worker process, set up once when it starts.
+pipeline = None
+slots = None
+
+def setup_worker(generators, shared):
+    """
+    Prepare a worker process to generate chunks.
+
+    :param list generators: names of the terrain generators to use
+    :param list shared: slots of shared memory
+    """
+
+    global pipeline, slots
+
+    # Workers are forked from the server, and inherit the handlers that
+    # Twisted installed; they have to die when they are terminated, and
+    # leave interrupts to the server.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
 
-class Slave(AMPChild):
+    pipeline = retrieve_sorted_plugins(ITerrainGenerator, generators)
+    slots = shared
+
+def make_chunk(x, z, seed, slot):
     """
-    Process-based peon for processing and populating.
+    Generate a chunk in a worker process, and put it in a slot.
+
+    :returns: tuple of a formatted traceback, if generation failed, and how
+              long generation took, in seconds
+    """
+
+    try:
+        before = time()
+
+        chunk = Chunk(x, z)
+        for stage in pipeline:
+            stage.populate(chunk, seed)
+        chunk.regenerate()
+
+        data = frombuffer(slots[slot], dtype=uint8)
+        for name, start, end in slot_layout:
+            data[start:end] = frombuffer(chunk.get_layer_bytes(name),
+                dtype=uint8)
+        data[heightmap_offset:] = chunk.heightmap.ravel()
+
+        return None, time() - before
+    except Exception:
+        return traceback.format_exc(), 0
+
+class GenerationPool(object):
     """
+    A pool of processes which generate chunks.
 
-    def make_chunk(self, x, z, seed, generators):
+    Each process loads the terrain generators once, when it starts. Only as
+    many chunks as there are slots of shared memory are handed to the
+    processes at once; the rest wait in a queue, and the chunks with the
+    lowest priority are handed out first.
+
+    A process which dies, or gets stuck, never hands its chunk back; chunks
+    which take longer than the timeout are failed, along with every other
+    chunk being generated, and the processes are started afresh.
+    """
+
+    pool = None
+
+    timeout = 60
+    """
+    How long, in seconds, a chunk may take to generate before its process is
+    given up on.
+    """
+
+    priority = None
+    """
+    A callable which takes the coordinates of a queued chunk and returns its
+    priority, if any. Otherwise, chunks are generated in the order that they
+    were requested.
+    """
+
+    def __init__(self, processes, generators, limit=None, clock=reactor):
         """
-        Create a chunk using the given parameters.
+        :param int processes: number of processes
+        :param list generators: names of the terrain generators to use
+        :param int limit: number of chunks which may be generated at once;
+                          defaults to twice the number of processes
+        :param clock: provider of ``callFromThread()`` and ``callLater()``
         """
 
-        generators = retrieve_sorted_plugins(ITerrainGenerator, generators)
+        self.processes = processes
+        self.generators = generators
+        self.clock = clock
 
-        chunk = Chunk(x, z)
+        if limit is None:
+            limit = processes * 2
+        self.slots = [RawArray("B", slot_size) for i in range(limit)]
+        self.views = [frombuffer(slot, dtype=uint8) for slot in self.slots]
+        self.free = range(limit)
 
-        for stage in generators:
-            stage.populate(chunk, seed)
+        self.queue = []
 
-        chunk.regenerate()
+        # The chunks being generated, by slot, with their Deferreds and the
+        # calls which time them out.
+        self.running = {}
+
+        # Statistics.
+        self.generated = 0
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+
+    def start(self):
+        self.pool = Pool(self.processes, setup_worker,
+            (self.generators, self.slots))
+
+    def stop(self):
+        """
+        Stop the processes, and fail the chunks which they were generating.
+        """
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+        running, self.running = self.running, {}
+        for slot, (chunk, d, call) in running.iteritems():
+            if call.active():
+                call.cancel()
+            self.free.append(slot)
+            d.errback(RuntimeError("Couldn't generate %r" % chunk))
+
+    def restart(self):
+        """
+        Start the processes afresh, failing the chunks being generated and
+        handing out the queued ones again.
+        """
+
+        self.stop()
+        self.start()
+        self.dispatch()
+
+    def timed_out(self, slot):
+        """
+        Give up on a chunk which is taking too long to generate.
+        """
+
+        chunk, d, call = self.running[slot]
+        log.msg("Generating %r took more than %d seconds; restarting the "
+            "generation processes" % (chunk, self.timeout))
+        self.restart()
+
+    def generate(self, chunk, seed):
+        """
+        Generate a chunk.
+
+        :param `Chunk` chunk: an empty chunk, to be filled in
+        :param int seed: the world's seed
+        :returns: ``Deferred`` that will fire with the chunk once it has been
+                  generated
+        """
+
+        d = Deferred()
+        self.queue.append((chunk, seed, d, time()))
+        self.dispatch()
+        return d
+
+    def cancel(self, x, z):
+        """
+        Cancel a chunk which is still queued.
+
+        :returns: bool of whether the chunk was queued
+        """
+
+        for i, (chunk, seed, d, queued) in enumerate(self.queue):
+            if chunk.x == x and chunk.z == z:
+                del self.queue[i]
+                d.cancel()
+                return True
+
+        return False
+
+    def dispatch(self):
+        """
+        Hand queued chunks to the processes, while there are free slots.
+        """
+
+        if not self.free or not self.queue:
+            return
+
+        if self.priority is not None and len(self.queue) > 1:
+            # Priorities change as players move, so they are looked up
+            # afresh each time.
+            self.queue.sort(key=lambda (chunk, seed, d, queued):
+                (self.priority(chunk.x, chunk.z), queued))
+
+        while self.free and self.queue:
+            chunk, seed, d, queued = self.queue.pop(0)
+            slot = self.free.pop()
+            self.wait_time += time() - queued
+
+            call = self.clock.callLater(self.timeout, self.timed_out, slot)
+            self.running[slot] = chunk, d, call
+
+            def done(result, chunk=chunk, d=d, slot=slot):
+                self.clock.callFromThread(self.generated_chunk, chunk, d,
+                    slot, result)
+
+            self.pool.apply_async(make_chunk, (chunk.x, chunk.z, seed, slot),
+                callback=done)
+
+    def generated_chunk(self, chunk, d, slot, result):
+        """
+        Take a chunk out of its slot once it has been generated.
+        """
+
+        running = self.running.get(slot)
+        if running is None or running[1] is not d:
+            # The chunk was already failed when its processes were stopped.
+            return
+
+        call = self.running.pop(slot)[2]
+        if call.active():
+            call.cancel()
+
+        error, elapsed = result
+
+        if error is None:
+            data = self.views[slot]
+            for name, start, end in slot_layout:
+                chunk.set_layer_bytes(name, data[start:end])
+            chunk.heightmap = data[heightmap_offset:].reshape(
+                chunk.heightmap.shape).copy()
 
-        return {
-            "blocks": chunk.blocks.tostring(),
-            "metadata": chunk.metadata.tostring(),
-            "skylight": chunk.skylight.tostring(),
-            "blocklight": chunk.blocklight.tostring(),
-            "heightmap": chunk.heightmap.tostring(),
-        }
+            self.generated += 1
+            self.compute_time += elapsed
 
-    MakeChunk.responder(make_chunk)
+        self.free.append(slot)
+        self.dispatch()
 
-ampoule.pool.pp = ampoule.pool.ProcessPool(
-    ampChild=Slave,
-)
+        if error is None:
+            d.callback(chunk)
+        else:
+            log.msg("Couldn't generate %r:\n%s" % (chunk, error))
+            d.errback(RuntimeError("Couldn't generate %r" % chunk))
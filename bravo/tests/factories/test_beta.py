@@ -3,8 +3,11 @@ import tempfile
 
 from twisted.internet import reactor
 from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.threadpool import ThreadPool
 from twisted.trial import unittest
 
+from bravo.chunk import Chunk
 import bravo.config
 import bravo.factories.beta
 
@@ -45,6 +48,28 @@ class TestBravoFactory(unittest.TestCase):
 
         self.assertEqual(self.f.eid, 1)
 
+    def test_make_chunk_packet(self):
+        chunk = Chunk(1, 2)
+        packet = chunk.save_to_packet()
+        chunk.packet = None
+
+        d = self.f.make_chunk_packet(chunk)
+        self.assertEqual(self.successResultOf(d), packet)
+        self.assertEqual(chunk.get_cached_packet(), packet)
+
+    def test_make_chunk_packet_pool(self):
+        chunk = Chunk(1, 2)
+        packet = chunk.save_to_packet()
+        chunk.packet = None
+
+        self.f.packet_pool = ThreadPool(0, 1)
+        self.f.packet_pool.start()
+        self.addCleanup(self.f.packet_pool.stop)
+
+        d = self.f.make_chunk_packet(chunk)
+        d.addCallback(self.assertEqual, packet)
+        return d
+
     def test_update_time(self):
         """
         Timekeeping should work.
@@ -160,6 +185,33 @@ class TestBravoFactory(unittest.TestCase):
 
         self.assertFalse(self.f.set_username(p, "Hurp"))
 
+    def test_broadcast_for_chunk(self):
+        first = MockProtocol(None)
+        first.transport = StringTransport()
+        second = MockProtocol(None)
+        second.transport = StringTransport()
+
+        self.f.subscribe_chunk(first, 1, 2)
+        self.f.subscribe_chunk(second, 1, 2)
+        self.f.subscribe_chunk(second, 2, 1)
+        self.f.broadcast_for_chunk("packet", 1, 2)
+        self.f.broadcast_for_chunk("other", 2, 1)
+
+        self.assertEqual(first.transport.value(), "packet")
+        self.assertEqual(second.transport.value(), "packetother")
+
+    def test_unsubscribe_chunk(self):
+        p = MockProtocol(None)
+        p.transport = StringTransport()
+
+        self.f.subscribe_chunk(p, 1, 2)
+        self.f.unsubscribe_chunk(p, 1, 2)
+        self.f.unsubscribe_chunk(p, 1, 2)
+        self.f.broadcast_for_chunk("packet", 1, 2)
+
+        self.assertEqual(p.transport.value(), "")
+        self.assertEqual(self.f.chunk_subscribers, {})
+
 class TestBravoFactoryStarted(unittest.TestCase):
     """
     Tests which require ``startFactory()`` to be called.
@@ -1,12 +1,14 @@
 import unittest
 import shutil
+from StringIO import StringIO
 import tempfile
 
 from twisted.python.filepath import FilePath
 
 import bravo.chunk
+import bravo.entity
 import bravo.plugins.serializers
-from bravo.nbt import TAG_Compound, TAG_List, TAG_String
+from bravo.nbt import NBTFile, TAG_Compound, TAG_List, TAG_String
 from bravo.nbt import TAG_Double, TAG_Byte, TAG_Short
 
 class TestAlphaUtilities(unittest.TestCase):
@@ -90,6 +92,35 @@ class TestAlphaSerializer(unittest.TestCase):
         self.assertEqual(tag["Level"]["xPos"].value, 1)
         self.assertEqual(tag["Level"]["zPos"].value, 2)
 
+    def test_load_chunk_from_data(self):
+        chunk = bravo.chunk.Chunk(1, 2)
+        chunk.set_block((1, 2, 3), 4)
+        chunk.set_metadata((1, 2, 3), 5)
+        chunk.regenerate()
+        sign = bravo.entity.Sign(17, 2, 35)
+        sign.text1 = "Hello"
+        chunk.tiles[17, 2, 35] = sign
+
+        b = StringIO()
+        self.serializer._save_chunk_to_tag(chunk).write_file(buffer=b)
+        data = b.getvalue()
+
+        loaded = bravo.chunk.Chunk(1, 2)
+        self.serializer._load_chunk_from_data(loaded, data)
+        expected = bravo.chunk.Chunk(1, 2)
+        self.serializer._load_chunk_from_tag(expected,
+            NBTFile(buffer=StringIO(data)))
+
+        self.assertTrue(loaded.populated)
+        self.assertFalse(loaded.dirty)
+        for name in bravo.chunk.layers:
+            self.assertEqual(loaded.get_layer_bytes(name),
+                expected.get_layer_bytes(name))
+        self.assertEqual(loaded.heightmap.tostring(),
+            expected.heightmap.tostring())
+        self.assertEqual(loaded.get_metadata((1, 2, 3)), 5)
+        self.assertEqual(loaded.tiles[17, 2, 35].text1, "Hello")
+
     def test_save_data(self):
         data = 'Foo\nbar'
         self.serializer.save_plugin_data('plugin1', data)
@@ -101,3 +132,88 @@ class TestAlphaSerializer(unittest.TestCase):
         data = 'Foo\nbar'
         self.serializer.save_plugin_data('plugin1', data)
         self.assertEqual(self.serializer.load_plugin_data('plugin1'), data)
+
+class TestBetaSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.folder = FilePath(self.d)
+        self.serializer = bravo.plugins.serializers.Beta('file://' + self.folder.path)
+
+    def tearDown(self):
+        self.serializer.regions.close()
+        shutil.rmtree(self.d)
+
+    def test_load_chunk_missing(self):
+        chunk = bravo.chunk.Chunk(1, 2)
+        self.serializer.load_chunk(chunk)
+        self.assertFalse(chunk.populated)
+        self.assertEqual(len(self.serializer.regions), 0)
+
+    def test_save_chunk_readback(self):
+        chunk = bravo.chunk.Chunk(1, -2)
+        chunk.populated = True
+        chunk.set_block((1, 2, 3), 4)
+        self.serializer.save_chunk(chunk)
+
+        chunk = bravo.chunk.Chunk(1, -2)
+        self.serializer.load_chunk(chunk)
+        self.assertEqual(chunk.get_block((1, 2, 3)), 4)
+
+    def test_save_chunks_readback(self):
+        chunks = [bravo.chunk.Chunk(x, 0) for x in range(31, 34)]
+        for chunk in chunks:
+            chunk.populated = True
+            chunk.set_block((1, 2, 3), chunk.x)
+        self.serializer.save_chunks(chunks)
+
+        chunks = [bravo.chunk.Chunk(x, 0) for x in range(30, 34)]
+        self.serializer.load_chunks(chunks)
+        self.assertFalse(chunks[0].populated)
+        for chunk in chunks[1:]:
+            self.assertEqual(chunk.get_block((1, 2, 3)), chunk.x)
+
+    def test_save_chunk_held(self):
+        """
+        Chunks saved one at a time should be written together.
+        """
+
+        self.serializer.held_chunks = 3
+        written = []
+        write_chunks = self.serializer.write_chunks
+        def record(records):
+            written.append(len(self.serializer.held) + len(records))
+            return write_chunks(records)
+        self.serializer.write_chunks = record
+
+        for x in range(4):
+            chunk = bravo.chunk.Chunk(x, 0)
+            chunk.populated = True
+            self.serializer.save_chunk(chunk)
+
+        self.assertEqual(written, [3])
+        self.assertEqual(len(self.serializer.held), 1)
+
+    def test_close(self):
+        chunk = bravo.chunk.Chunk(0, 0)
+        chunk.populated = True
+        chunk.set_block((1, 2, 3), 4)
+        self.serializer.save_chunk(chunk)
+
+        self.serializer.close()
+        self.assertEqual(len(self.serializer.regions), 0)
+
+        chunk = bravo.chunk.Chunk(0, 0)
+        self.serializer.load_chunk(chunk)
+        self.assertEqual(chunk.get_block((1, 2, 3)), 4)
+
+    def test_recover(self):
+        chunk = bravo.chunk.Chunk(0, 0)
+        chunk.populated = True
+        self.serializer.save_chunk(chunk)
+        self.serializer.close()
+
+        journal = self.folder.child("region").child("r.0.0.mcr.journal")
+        journal.setContent("garbage")
+        self.serializer.recover()
+        self.assertFalse(journal.exists())
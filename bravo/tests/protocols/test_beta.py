@@ -1,9 +1,130 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial import unittest
 
 from construct import Container
 
+from bravo.chunk import Chunk
 import bravo.protocols.beta
 
+class MockWorld(object):
+
+    prefetcher = None
+
+    def relight_chunk(self, chunk):
+        pass
+
+class MockTracker(object):
+
+    def remove(self, protocol):
+        pass
+
+class MockFactory(object):
+
+    def __init__(self):
+        self.world = MockWorld()
+        self.tracker = MockTracker()
+        self.protocols = {}
+        self.packets = []
+        self.subscribed = []
+
+    def make_chunk_packet(self, chunk):
+        d = Deferred()
+        self.packets.append(d)
+        return d
+
+    def subscribe_chunk(self, protocol, x, z):
+        self.subscribed.append((x, z))
+
+    def unsubscribe_chunk(self, protocol, x, z):
+        self.subscribed.remove((x, z))
+
+class TestPacketQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.t = StringTransport()
+        self.q = bravo.protocols.beta.PacketQueue(self.t, self.clock)
+
+    def test_trivial(self):
+        pass
+
+    def test_producer(self):
+        self.assertTrue(self.t.producer is self.q)
+        self.assertTrue(self.t.streaming)
+
+    def test_batch(self):
+        self.q.write("\x03chat")
+        self.q.write("\x00")
+        self.assertEqual(self.t.value(), "")
+
+        self.clock.advance(0)
+        self.assertEqual(self.t.value(), "\x03chat\x00")
+        self.assertEqual(self.q.bytes, {"interactive": 6, "bulk": 0})
+
+    def test_priority(self):
+        self.q.write("\x32prechunk")
+        self.q.write("\x33chunk")
+        self.q.write("\x22teleport")
+        self.clock.advance(0)
+
+        self.assertEqual(self.t.value(),
+            "\x22teleport\x32prechunk\x33chunk")
+        self.assertEqual(self.q.bytes, {"interactive": 9, "bulk": 15})
+
+    def test_paused(self):
+        self.q.pauseProducing()
+        self.q.write("\x33chunk")
+        self.q.write("\x22teleport")
+        self.clock.advance(0)
+        self.assertEqual(self.t.value(), "\x22teleport")
+
+        self.q.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual(self.t.value(), "\x22teleport\x33chunk")
+
+    def test_behind_bulk(self):
+        self.q.write("\x32prechunk")
+        self.q.behind_bulk = True
+        self.q.write("\x14spawn")
+        self.q.behind_bulk = False
+        self.q.write("\x22teleport")
+        self.clock.advance(0)
+
+        self.assertEqual(self.t.value(),
+            "\x22teleport\x32prechunk\x14spawn")
+
+    def test_behind_bulk_key(self):
+        self.q.pauseProducing()
+        self.q.write("\x32prechunk")
+        self.q.behind_bulk = True
+        self.q.write("\x14spawn", 1)
+        self.q.behind_bulk = False
+        self.q.write("\x1fmove", 1)
+        self.q.write("\x1fother", 2)
+        self.clock.advance(0)
+        self.assertEqual(self.t.value(), "\x1fother")
+
+        self.q.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual(self.t.value(),
+            "\x1fother\x32prechunk\x14spawn\x1fmove")
+
+        self.q.write("\x1dgone", 1)
+        self.clock.advance(0)
+        self.assertTrue(self.t.value().endswith("\x1dgone"))
+
+    def test_lose_connection(self):
+        self.q.pauseProducing()
+        self.q.write("\x33chunk")
+        self.q.loseConnection()
+
+        self.assertEqual(self.t.value(), "\x33chunk")
+        self.assertTrue(self.t.disconnecting)
+        self.assertEqual(self.t.producer, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
 class TestBetaServerProtocol(unittest.TestCase):
 
     def setUp(self):
@@ -75,3 +196,84 @@ class TestBravoProtocol(unittest.TestCase):
         """
 
         list(self.p.entities_near(2))
+
+    def test_send_chunk_order(self):
+        """
+        Chunks should be written in the order they were sent, regardless of
+        the order in which their packets are made.
+        """
+
+        self.p.factory = MockFactory()
+        self.p.transport = StringTransport()
+
+        first = self.p.send_chunk(Chunk(1, 1))
+        second = self.p.send_chunk(Chunk(2, 2))
+
+        self.p.factory.packets[1].callback("second")
+        self.assertFalse(second.called)
+        self.assertEqual(self.p.chunks, {})
+
+        self.p.factory.packets[0].callback("first")
+        self.assertTrue(first.called)
+        self.assertTrue(second.called)
+        self.assertEqual(set(self.p.chunks), set([(1, 1), (2, 2)]))
+
+        written = self.p.transport.value()
+        self.assertTrue(written.index("first") < written.index("second"))
+
+    def test_send_chunk_changed(self):
+        """
+        Chunks which change while their packets are being made should be sent
+        again.
+        """
+
+        self.p.factory = MockFactory()
+        self.p.transport = StringTransport()
+
+        chunk = Chunk(1, 1)
+        self.p.send_chunk(chunk)
+        chunk.set_block((1, 2, 3), 1)
+
+        self.p.factory.packets[0].callback("stale")
+        self.assertEqual(len(self.p.factory.packets), 2)
+
+    def test_send_chunk_after_connection_lost(self):
+        """
+        Chunks whose packets are ready after the connection is lost shouldn't
+        be written, or subscribe the protocol again.
+        """
+
+        self.p.factory = MockFactory()
+        self.p.transport = StringTransport()
+
+        self.p.send_chunk(Chunk(1, 1))
+        self.p.connectionLost(None)
+        self.assertEqual(len(self.p.chunk_queue), 0)
+
+        self.p.factory.packets[0].callback("late")
+        self.p.write_chunk(Chunk(2, 2), "later")
+        self.assertEqual(self.p.factory.subscribed, [])
+        self.assertEqual(self.p.transport.value(), "")
+
+    def test_write_chunk_spawns_behind(self):
+        """
+        Avatars spawned when a chunk is written should be written after the
+        chunk.
+        """
+
+        clock = Clock()
+        self.p.factory = MockFactory()
+        self.p.transport = bravo.protocols.beta.PacketQueue(
+            StringTransport(), clock)
+
+        def subscribe_chunk(protocol, x, z):
+            protocol.transport.write("\x14spawn")
+        self.p.factory.subscribe_chunk = subscribe_chunk
+
+        self.p.write_chunk(Chunk(1, 1), "\x33chunk")
+        self.p.transport.write("\x22teleport")
+        clock.advance(0)
+
+        written = self.p.transport.transport.value()
+        self.assertTrue(written.startswith("\x22teleport"))
+        self.assertTrue(written.index("chunk") < written.index("spawn"))
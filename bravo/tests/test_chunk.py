@@ -1,10 +1,13 @@
 from twisted.trial import unittest
+from itertools import product
 import warnings
 
-from numpy import empty
+from numpy import empty, uint8, uint32, zeros
 from numpy.testing import assert_array_equal
 
+import bravo.blocks
 import bravo.chunk
+from bravo.utilities.bits import pack_nibbles
 
 class TestChunkBlocks(unittest.TestCase):
 
@@ -49,6 +52,31 @@ class TestChunkBlocks(unittest.TestCase):
         packet = chunk.get_damage_packet()
         self.assertEqual(packet, '\x35\x00\x00\x00\x02\x04\x00\x00\x00\x18\x01\x00')
 
+    def test_batch_damage_packet(self):
+        chunk = bravo.chunk.Chunk(0, 1)
+        chunk.populated = True
+        chunk.set_block((2, 4, 8), 1)
+        chunk.set_block((1, 5, 3), 2)
+        packet = chunk.get_damage_packet()
+        self.assertEqual(packet, '\x34\x00\x00\x00\x00\x00\x00\x00\x01'
+            '\x00\x02\x13\x05\x28\x04\x02\x01\x00\x00')
+
+    def test_damage_overflow(self):
+        """
+        Past a certain amount of damage, the entire chunk is damaged.
+        """
+
+        self.c.populated = True
+
+        for y in range(100):
+            self.c.set_block((1, y, 1), 1)
+            self.c.set_block((2, y, 1), 1)
+        self.assertTrue(self.c.all_damaged)
+        self.assertFalse(self.c.damaged)
+
+        self.c.clear_damage()
+        self.assertFalse(self.c.is_damaged())
+
     def test_set_block_correct_heightmap(self):
         """
         Test heightmap update for a single column.
@@ -110,6 +138,166 @@ class TestNumpyQuirks(unittest.TestCase):
         # ...And reset the warning filters.
         warnings.resetwarnings()
 
+class TestChunkSections(unittest.TestCase):
+
+    def setUp(self):
+        self.c = bravo.chunk.Chunk(0, 0)
+        self.c.blocks[:, :, :40] = bravo.blocks.blocks["stone"].slot
+        self.c.blocks[3, 4, 20] = bravo.blocks.blocks["dirt"].slot
+        self.c.metadata[3, 4, 20] = 2
+        self.c.regenerate()
+
+    def test_trivial(self):
+        pass
+
+    def test_compact(self):
+        blocks = self.c.blocks.copy()
+        skylight = self.c.skylight.copy()
+
+        self.c.compact()
+        self.assertEqual(self.c.layers, None)
+        self.assertTrue(self.c.sections["blocks"][7] is
+            bravo.chunk.uniform_sections[0])
+
+        assert_array_equal(self.c.blocks, blocks)
+        assert_array_equal(self.c.skylight, skylight)
+        self.assertEqual(self.c.sections, None)
+
+    def test_compact_get_block(self):
+        self.c.compact()
+
+        self.assertEqual(self.c.get_block((3, 20, 4)),
+            bravo.blocks.blocks["dirt"].slot)
+        self.assertEqual(self.c.get_block((3, 100, 4)), 0)
+        self.assertEqual(self.c.get_metadata((3, 20, 4)), 2)
+        self.assertEqual(self.c.get_metadata((3, 21, 4)), 0)
+        self.assertEqual(self.c.layers, None)
+
+    def test_compact_packed(self):
+        metadata = pack_nibbles(self.c.metadata)
+
+        self.c.compact()
+        self.assertEqual(self.c.sections["metadata"][1].shape, (16, 16, 8))
+        self.assertEqual(self.c.get_layer_bytes("metadata"), metadata)
+
+        self.c.expand()
+        self.assertEqual(self.c.get_layer_bytes("metadata"), metadata)
+
+    def test_compact_get_block_out_of_bounds(self):
+        self.c.compact()
+
+        warnings.simplefilter("error", bravo.chunk.ChunkWarning)
+        self.assertRaises(bravo.chunk.ChunkWarning, self.c.get_block,
+            (3, 128, 4))
+        self.assertRaises(bravo.chunk.ChunkWarning, self.c.get_block,
+            (16, 100, 4))
+        warnings.resetwarnings()
+
+    def test_compact_set_block(self):
+        self.c.compact()
+
+        self.c.set_block((3, 100, 4), bravo.blocks.blocks["dirt"].slot)
+        self.assertEqual(self.c.blocks[3, 4, 100],
+            bravo.blocks.blocks["dirt"].slot)
+
+    def test_compact_save_to_packet(self):
+        packet = self.c.save_to_packet()
+        self.c.compact()
+        self.assertEqual(self.c.save_to_packet(), packet)
+        self.assertEqual(self.c.layers, None)
+
+    def test_compact_uniform_nibbles_masked(self):
+        """
+        Uniform nibble sections only keep the low nibble of their value.
+        """
+
+        self.c.metadata[:, :, 16:32] = 0x13
+        self.c.compact()
+        self.assertTrue(self.c.sections["metadata"][1] is
+            bravo.chunk.uniform_nibble_sections[3])
+
+    def test_set_layer_bytes(self):
+        chunk = bravo.chunk.Chunk(0, 0)
+        for name in bravo.chunk.layers:
+            chunk.set_layer_bytes(name, self.c.get_layer_bytes(name))
+
+        self.assertEqual(chunk.layers, None)
+        self.assertTrue(chunk.sections["blocks"][7] is
+            bravo.chunk.uniform_sections[0])
+        self.assertTrue(chunk.sections["metadata"][7] is
+            bravo.chunk.uniform_nibble_sections[0])
+        assert_array_equal(chunk.blocks, self.c.blocks)
+        assert_array_equal(chunk.metadata, self.c.metadata)
+        assert_array_equal(chunk.skylight, self.c.skylight)
+
+    def test_set_layer_bytes_writable(self):
+        chunk = bravo.chunk.Chunk(0, 0)
+        chunk.set_layer_bytes("blocks", self.c.get_layer_bytes("blocks"))
+        chunk.set_block((3, 20, 4), bravo.blocks.blocks["stone"].slot)
+        self.assertEqual(chunk.get_block((3, 20, 4)),
+            bravo.blocks.blocks["stone"].slot)
+
+class TestChunkPacket(unittest.TestCase):
+
+    def setUp(self):
+        self.c = bravo.chunk.Chunk(0, 0)
+        self.c.populated = True
+
+    def test_trivial(self):
+        pass
+
+    def test_save_to_packet_cached(self):
+        hits = bravo.chunk.packet_cache_stats["hits"]
+
+        packet = self.c.save_to_packet()
+        self.assertTrue(self.c.save_to_packet() is packet)
+        self.assertEqual(bravo.chunk.packet_cache_stats["hits"], hits + 1)
+
+    def test_save_to_packet_set_block(self):
+        packet = self.c.save_to_packet()
+        self.c.set_block((1, 2, 3), bravo.blocks.blocks["stone"].slot)
+        self.assertNotEqual(self.c.save_to_packet(), packet)
+
+    def test_save_to_packet_set_metadata(self):
+        packet = self.c.save_to_packet()
+        self.c.set_metadata((1, 2, 3), 4)
+        self.assertNotEqual(self.c.save_to_packet(), packet)
+
+    def test_save_to_packet_sed(self):
+        self.c.set_block((1, 2, 3), bravo.blocks.blocks["stone"].slot)
+        packet = self.c.save_to_packet()
+        self.c.sed(bravo.blocks.blocks["stone"].slot,
+            bravo.blocks.blocks["dirt"].slot)
+        self.assertNotEqual(self.c.save_to_packet(), packet)
+
+    def test_save_to_packet_set_column(self):
+        packet = self.c.save_to_packet()
+        column = zeros(128, dtype=uint8)
+        column[:5] = bravo.blocks.blocks["stone"].slot
+        self.c.set_column(1, 3, column)
+        self.assertNotEqual(self.c.save_to_packet(), packet)
+
+    def test_save_to_packet_get_column(self):
+        """
+        Reading a column shouldn't throw away the cached packet.
+        """
+
+        packet = self.c.save_to_packet()
+        self.c.get_column(1, 3)
+        self.assertTrue(self.c.save_to_packet() is packet)
+
+    def test_save_to_packet_touch(self):
+        packet = self.c.save_to_packet()
+        self.c.get_column(1, 3)[:5] = bravo.blocks.blocks["stone"].slot
+        self.c.touch()
+        self.assertNotEqual(self.c.save_to_packet(), packet)
+
+    def test_save_to_packet_relight(self):
+        self.c.set_block((1, 2, 3), bravo.blocks.blocks["torch"].slot)
+        packet = self.c.save_to_packet()
+        self.c.relight()
+        self.assertNotEqual(self.c.save_to_packet(), packet)
+
 class TestLightmaps(unittest.TestCase):
 
     def setUp(self):
@@ -217,3 +405,126 @@ class TestLightmaps(unittest.TestCase):
         self.c.regenerate()
 
         self.assertEqual(self.c.skylight[1, 1, 1], 12)
+
+    def test_blocklight_torch(self):
+        """
+        A lone torch should light up its surroundings symmetrically.
+        """
+
+        self.c.blocks[8, 8, 64] = bravo.blocks.blocks["torch"].slot
+        self.c.regenerate_blocklight()
+
+        self.assertEqual(self.c.blocklight[8, 8, 64], 15)
+        for x, z, y in ((7, 8, 64), (9, 8, 64), (8, 7, 64), (8, 9, 64),
+            (8, 8, 63), (8, 8, 65)):
+            self.assertEqual(self.c.blocklight[x, z, y], 14)
+        self.assertEqual(self.c.blocklight[8, 8, 78], 1)
+        self.assertEqual(self.c.blocklight[8, 8, 50], 1)
+        self.assertEqual(self.c.blocklight[8, 8, 79], 0)
+
+    def test_blocklight_many_sources(self):
+        """
+        Compositing lots of light sources at once should give the same
+        results as compositing them one at a time.
+        """
+
+        self.c.blocks[:, :, :40:3] = bravo.blocks.blocks["lava"].slot
+        self.c.blocks[::5, ::7, 60] = bravo.blocks.blocks["torch"].slot
+        self.c.regenerate_blocklight()
+
+        reference = zeros((16, 16, 128), dtype=uint32)
+        for x, z, y in zip(*self.c.blocks.nonzero()):
+            strength = bravo.blocks.glowing_blocks[self.c.blocks[x, z, y]]
+            bravo.chunk.composite_glow(reference, strength, x, y, z)
+
+        assert_array_equal(self.c.blocklight, reference.clip(0, 15))
+
+    def test_set_block_blocklight(self):
+        """
+        Placing and removing light sources, then relighting, should update
+        the block light map to match a full regeneration.
+        """
+
+        self.c.populated = True
+
+        self.c.set_block((3, 64, 4), bravo.blocks.blocks["torch"].slot)
+        self.c.set_block((6, 66, 4), bravo.blocks.blocks["lightstone"].slot)
+        self.c.relight()
+        lightmap = self.c.blocklight.copy()
+        self.c.regenerate_blocklight()
+        assert_array_equal(self.c.blocklight, lightmap)
+
+        self.c.set_block((6, 66, 4), 0)
+        self.c.relight()
+        lightmap = self.c.blocklight.copy()
+        self.c.regenerate_blocklight()
+        assert_array_equal(self.c.blocklight, lightmap)
+
+        self.c.set_block((3, 64, 4), 0)
+        self.c.relight()
+        self.assertFalse(self.c.blocklight.any())
+
+    def test_set_block_dirty_light(self):
+        """
+        Edits should coalesce into a single region of out-of-date lighting.
+        """
+
+        self.c.populated = True
+
+        self.c.set_block((2, 64, 2), bravo.blocks.blocks["torch"].slot)
+        self.c.set_block((4, 70, 3), bravo.blocks.blocks["torch"].slot)
+        self.assertEqual(self.c.dirty_light, ((0, 49, 0), (16, 86, 16)))
+
+        self.assertEqual(self.c.relight(), ((0, 49, 0), (16, 86, 16)))
+        self.assertEqual(self.c.dirty_light, None)
+        self.assertEqual(self.c.relight(), None)
+
+    def test_set_block_skylight(self):
+        """
+        Building and removing a roof, then relighting, should update the sky
+        light map to match a full regeneration.
+        """
+
+        self.c.populated = True
+        self.c.blocks[:, :, 0] = bravo.blocks.blocks["stone"].slot
+        self.c.regenerate()
+
+        for x, z in product(range(2, 9), repeat=2):
+            self.c.set_block((x, 10, z), bravo.blocks.blocks["stone"].slot)
+        self.c.relight()
+        lightmap = self.c.skylight.copy()
+        self.c.regenerate_skylight()
+        assert_array_equal(self.c.skylight, lightmap)
+
+        self.c.set_block((5, 10, 5), 0)
+        self.c.set_block((2, 10, 2), bravo.blocks.blocks["glass"].slot)
+        self.c.relight()
+        lightmap = self.c.skylight.copy()
+        self.c.regenerate_skylight()
+        assert_array_equal(self.c.skylight, lightmap)
+
+    def test_set_block_heightmap(self):
+        """
+        The height map should follow the tallest block in each column.
+        """
+
+        self.c.populated = True
+
+        self.c.set_block((1, 20, 1), bravo.blocks.blocks["stone"].slot)
+        self.c.set_block((1, 30, 1), bravo.blocks.blocks["stone"].slot)
+        self.assertEqual(self.c.height_at(1, 1), 30)
+
+        self.c.set_block((1, 30, 1), 0)
+        self.assertEqual(self.c.height_at(1, 1), 20)
+
+        self.c.set_block((1, 20, 1), 0)
+        self.assertEqual(self.c.height_at(1, 1), 0)
+
+    def test_regenerate_heightmap(self):
+        self.c.blocks[3, 4, :40] = bravo.blocks.blocks["stone"].slot
+        self.c.blocks[5, 6, 127] = bravo.blocks.blocks["stone"].slot
+        self.c.regenerate_heightmap()
+
+        self.assertEqual(self.c.height_at(3, 4), 39)
+        self.assertEqual(self.c.height_at(5, 6), 127)
+        self.assertEqual(self.c.height_at(0, 0), 0)
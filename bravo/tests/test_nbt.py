@@ -4,7 +4,9 @@ import tempfile
 import unittest
 
 from bravo.nbt import NBTFile, MalformedFileError
-from bravo.nbt import TAG_Compound
+from bravo.nbt import TAG_Compound, TAG_BYTE_ARRAY, TAG_COMPOUND, TAG_LIST
+from bravo.nbt import TAG_Double, TAG_List, TAG_String, parse_payload
+from bravo.nbt import read_byte_array, scan_compound, scan_root
 
 bigtest = """
 H4sIAAAAAAAAAO1Uz08aQRR+wgLLloKxxBBjzKu1hKXbzUIRibGIFiyaDRrYqDGGuCvDgi67Znew
@@ -61,6 +63,113 @@ class ReadWriteTest(unittest.TestCase):
         mynbt = NBTFile(self.f.name)
         mynbt.write_file()
 
+class BufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = GzipFile(fileobj=StringIO(bigtest)).read()
+
+    def test_render(self):
+        nbt = NBTFile()
+        nbt.parse_data(self.data)
+        self.assertEqual(nbt.render(), self.data)
+
+    def test_parse_data_truncated(self):
+        nbt = NBTFile()
+        self.assertRaises(MalformedFileError, nbt.parse_data,
+            self.data[:500])
+
+    def test_parse_payload(self):
+        tagid, start, end = scan_root(self.data)["nested compound test"]
+        tag, offset = parse_payload(memoryview(self.data), tagid, start)
+        self.assertEqual(offset, end)
+        self.assertEqual(sorted(tag.keys()), ["egg", "ham"])
+
+    def test_numeric_list(self):
+        nbt = NBTFile()
+        nbt.name = ""
+        nbt["Pos"] = TAG_List(type=TAG_Double)
+        nbt["Pos"].tags = [TAG_Double(i) for i in (1.5, -2, 64)]
+
+        parsed = NBTFile(buffer=StringIO(nbt.render()))
+        self.assertEqual([tag.value for tag in parsed["Pos"].tags],
+            [1.5, -2, 64])
+
+    def test_list_wrong_type(self):
+        nbt = NBTFile()
+        nbt.name = ""
+        nbt["Pos"] = TAG_List(type=TAG_Double)
+        nbt["Pos"].tags = [TAG_String("north")]
+        self.assertRaises(ValueError, nbt.render)
+
+class LazyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = GzipFile(fileobj=StringIO(bigtest)).read()
+        self.nbt = NBTFile()
+        self.nbt.parse_data(self.data, lazy=True)
+
+    def test_lookup(self):
+        self.assertEqual(self.nbt["nested compound test"]["egg"]["name"].value,
+            "Eggbert")
+
+    def test_lookup_leaves_siblings(self):
+        self.nbt["nested compound test"]
+        self.assertNotEqual(self.nbt["listTest (compound)"]._span, None)
+        self.assertNotEqual(self.nbt["nested compound test"]["egg"]._span,
+            None)
+
+    def test_list(self):
+        tags = self.nbt["listTest (long)"].tags
+        self.assertEqual([tag.value for tag in tags], range(11, 16))
+
+    def test_render_untouched(self):
+        self.assertEqual(self.nbt.render(), self.data)
+
+    def test_render_changed(self):
+        self.nbt["nested compound test"]["egg"]["name"] = TAG_String("Egg")
+        nbt = NBTFile(buffer=StringIO(self.nbt.render()))
+        self.assertEqual(nbt["nested compound test"]["egg"]["name"].value,
+            "Egg")
+        self.assertEqual(nbt["nested compound test"]["ham"]["name"].value,
+            "Hampus")
+
+    def test_truncated(self):
+        nbt = NBTFile()
+        self.assertRaises(MalformedFileError, nbt.parse_data,
+            self.data[:500], True)
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = GzipFile(fileobj=StringIO(bigtest)).read()
+
+    def test_scan_root(self):
+        tags = scan_root(self.data)
+        self.assertEqual(len(tags), 11)
+        self.assertEqual(tags["listTest (compound)"][0], TAG_LIST)
+        self.assertEqual(tags["nested compound test"][0], TAG_COMPOUND)
+
+    def test_scan_compound(self):
+        tagid, start, end = scan_root(self.data)["nested compound test"]
+        tags, offset = scan_compound(self.data, start)
+        self.assertEqual(sorted(tags), ["egg", "ham"])
+        self.assertEqual(offset, end)
+
+    def test_read_byte_array(self):
+        tag = NBTFile(buffer=StringIO(self.data))
+        name = ("byteArrayTest (the first 1000 values of (n*n*255+n*7)%100,"
+            " starting with n=0 (0, 62, 34, 16, 8, ...))")
+        tagid, start, end = scan_root(self.data)[name]
+        self.assertEqual(tagid, TAG_BYTE_ARRAY)
+        self.assertEqual(str(read_byte_array(self.data, start)),
+            tag[name].value)
+
+    def test_truncated(self):
+        self.assertRaises(MalformedFileError, scan_root, self.data[:500])
+
+    def test_not_compound(self):
+        self.assertRaises(MalformedFileError, scan_root, "\x01")
+
 class TreeManipulationTest(unittest.TestCase):
 
     def setUp(self):
@@ -97,5 +206,40 @@ class TestTAGCompound(unittest.TestCase):
         self.tag["test"] = TAG_Compound()
         self.assertTrue("test" in self.tag)
 
+    def test_order(self):
+        for name in "cab":
+            self.tag[name] = TAG_String(name)
+        self.tag["a"] = TAG_String("A")
+        self.assertEqual(self.tag.keys(), ["c", "a", "b"])
+        self.assertEqual(self.tag[1].value, "A")
+
+    def test_delitem(self):
+        self.tag["test"] = TAG_Compound()
+        del self.tag["test"]
+        self.assertFalse("test" in self.tag)
+
+    def test_delitem_index(self):
+        self.tag["first"] = TAG_Compound()
+        self.tag["second"] = TAG_Compound()
+        del self.tag[0]
+        self.assertEqual(self.tag.keys(), ["second"])
+
+    def test_tags(self):
+        self.tag.tags = [TAG_String("a", name="first")]
+        self.assertEqual(self.tag["first"].value, "a")
+        self.assertEqual(len(self.tag.tags), 1)
+
+    def test_tags_append(self):
+        self.tag.tags.append(TAG_String("a", name="first"))
+        self.tag.tags.append(TAG_String("b", name="second"))
+        self.assertEqual(self.tag.keys(), ["first", "second"])
+        self.assertEqual(self.tag["second"].value, "b")
+
+    def test_tags_delitem(self):
+        self.tag["first"] = TAG_String("a")
+        self.tag["second"] = TAG_String("b")
+        del self.tag.tags[0]
+        self.assertEqual(self.tag.keys(), ["second"])
+
 if __name__ == '__main__':
     unittest.main()
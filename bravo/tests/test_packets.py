@@ -3,7 +3,7 @@
 from twisted.trial import unittest
 
 from construct import Container
-from construct import ArrayError, MappingError
+from construct import ArrayError, FieldError, MappingError
 
 import bravo.packets.beta
 import bravo.packets.infini
@@ -180,6 +180,31 @@ class TestPacketHelpers(unittest.TestCase):
         packet = bravo.packets.beta.make_packet("ping")
         self.assertEqual(packet, "\x00")
 
+    def test_make_packet_encoders(self):
+        """
+        Packets built with precompiled encoders should be identical to those
+        built with Construct.
+        """
+
+        packet = bravo.packets.beta.make_packet("teleport",
+            Container(eid=5), x=-1000.5, y=2048, z=70000, yaw=255, pitch=0)
+        built = "\x22" + bravo.packets.beta.packets[34].build(
+            Container(eid=5, x=-1000.5, y=2048, z=70000, yaw=255, pitch=0))
+        self.assertEqual(packet, built)
+
+        packet = bravo.packets.beta.make_packet("block", x=-5, y=127,
+            z=1 << 20, type=4, meta=15)
+        built = "\x35" + bravo.packets.beta.packets[53].build(
+            Container(x=-5, y=127, z=1 << 20, type=4, meta=15))
+        self.assertEqual(packet, built)
+
+    def test_make_packet_encoders_range(self):
+        self.assertRaises(FieldError, bravo.packets.beta.make_packet, "time",
+            timestamp=-1)
+
+    def test_compile_encoder_variable(self):
+        self.assertRaises(ValueError, bravo.packets.beta.compile_encoder, 3)
+
     def test_alphastring(self):
         s = "Just a test"
         parser = bravo.packets.beta.AlphaString("test")
@@ -237,6 +262,69 @@ class TestPacketIntegration(unittest.TestCase):
         reconstructed = bravo.packets.beta.make_packet("location", payload)
         self.assertEqual(packet, reconstructed)
 
+class TestPacketDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = bravo.packets.beta.PacketDecoder()
+
+    def test_trivial(self):
+        pass
+
+    def test_dribble(self):
+        packet = bravo.packets.beta.make_packet("location",
+            position=Container(x=6.5, y=67.24, stance=65.62, z=-7.5),
+            orientation=Container(rotation=90.0, pitch=-12.5),
+            grounded=Container(grounded=1))
+
+        for c in packet[:-1]:
+            self.assertEqual(self.decoder.feed(c), [])
+        (header, payload), = self.decoder.feed(packet[-1])
+
+        self.assertEqual(header, 13)
+        self.assertEqual(payload,
+            bravo.packets.beta.packets[13].parse(packet[1:]))
+        self.assertEqual(self.decoder.leftovers(), "")
+
+    def test_fixed(self):
+        packets = [
+            bravo.packets.beta.make_packet("grounded", grounded=1),
+            bravo.packets.beta.make_packet("position",
+                position=Container(x=1.5, y=64, stance=65.62, z=-1.5),
+                grounded=Container(grounded=0)),
+            bravo.packets.beta.make_packet("orientation",
+                orientation=Container(rotation=45.0, pitch=10.0),
+                grounded=Container(grounded=1)),
+            bravo.packets.beta.make_packet("digging", state="broken",
+                x=-100, y=64, z=200, face="-z"),
+        ]
+
+        parsed = self.decoder.feed("".join(packets))
+        self.assertEqual(len(parsed), len(packets))
+        for packet, (header, payload) in zip(packets, parsed):
+            self.assertEqual(header, ord(packet[0]))
+            self.assertEqual(payload,
+                bravo.packets.beta.packets[header].parse(packet[1:]))
+
+    def test_variable(self):
+        chat = bravo.packets.beta.make_packet("chat", message=u"Hello")
+        grounded = bravo.packets.beta.make_packet("grounded", grounded=0)
+
+        parsed = self.decoder.feed(chat[:4])
+        self.assertEqual(parsed, [])
+        parsed = self.decoder.feed(chat[4:] + grounded + chat[:2])
+        self.assertEqual([header for header, payload in parsed], [3, 10])
+        self.assertEqual(parsed[0][1].message, u"Hello")
+        self.assertEqual(self.decoder.leftovers(), chat[:2])
+
+    def test_unknown_value(self):
+        """
+        Packets with values the fast path doesn't know are left alone.
+        """
+
+        packet = "\x0e\x09" + "\x00" * 10
+        self.assertEqual(self.decoder.feed(packet), [])
+        self.assertEqual(self.decoder.leftovers(), packet)
+
 class TestInfiniPacketParsing(unittest.TestCase):
 
     def test_ping(self):
@@ -0,0 +1,239 @@
+import unittest
+import shutil
+import tempfile
+
+from twisted.python.filepath import FilePath
+
+from struct import pack
+from zlib import crc32
+
+from bravo.region import (PageAllocator, Region, RegionPool, compact_region,
+    recover_region)
+
+class TestPageAllocator(unittest.TestCase):
+
+    def test_empty(self):
+        allocator = PageAllocator([], 2)
+        self.assertEqual(len(allocator), 0)
+        self.assertEqual(allocator.allocate(3), 2)
+        self.assertEqual(allocator.end, 5)
+
+    def test_gaps(self):
+        allocator = PageAllocator([(3, 1), (6, 2)], 10)
+        self.assertEqual(sorted(allocator.extents.items()),
+            [(2, 1), (4, 2), (8, 2)])
+        self.assertEqual(len(allocator), 5)
+
+    def test_best_fit(self):
+        allocator = PageAllocator([(5, 1), (8, 1)], 9)
+        # Free runs: 2-4 (3 pages) and 6-7 (2 pages).
+        self.assertEqual(allocator.allocate(2), 6)
+        self.assertEqual(allocator.allocate(1), 2)
+        self.assertEqual(allocator.allocate(2), 3)
+
+    def test_grow(self):
+        allocator = PageAllocator([(2, 1)], 5)
+        # Pages 3 and 4 are free, at the end of the region.
+        self.assertEqual(allocator.allocate(4), 3)
+        self.assertEqual(allocator.end, 7)
+        self.assertEqual(len(allocator), 0)
+
+    def test_free_merge(self):
+        allocator = PageAllocator([(2, 1), (3, 1), (4, 1)], 5)
+        allocator.free(2, 1)
+        allocator.free(4, 1)
+        allocator.free(3, 1)
+        self.assertEqual(allocator.extents, {2: 3})
+        self.assertEqual(allocator.lengths, [(3, 2)])
+
+class TestRegion(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.fp = FilePath(self.d).child("r.0.0.mcr")
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def test_create(self):
+        region = Region(self.fp)
+        self.assertEqual(self.fp.getsize(), 8192)
+        self.assertEqual(region.positions, {})
+        self.assertEqual(region.read(1, 2), None)
+        region.close()
+
+    def test_write_read(self):
+        region = Region(self.fp)
+        region.write(1, 2, "hello".encode("zlib"))
+        self.assertEqual(region.read_nbt(1, 2).read(), "hello")
+        region.close()
+
+    def test_write_read_no_mmap(self):
+        region = Region(self.fp, use_mmap=False)
+        region.write(1, 2, "hello".encode("zlib"))
+        self.assertEqual(region.read_nbt(1, 2).read(), "hello")
+        region.close()
+
+    def test_read_many(self):
+        region = Region(self.fp, use_mmap=False)
+        region.write_many([(0, 0, "a".encode("zlib")),
+            (1, 0, ("b" * 5000).encode("zlib")), (2, 0, "c".encode("zlib"))])
+        records = region.read_many([(2, 0), (0, 0), (3, 0)])
+        self.assertEqual(sorted(records), [(0, 0), (2, 0)])
+        self.assertEqual(records[2, 0], (2, "c".encode("zlib")))
+        region.close()
+
+    def test_read_zero_copy(self):
+        region = Region(self.fp)
+        region.write(1, 2, "hello".encode("zlib"))
+        version, data = region.read(1, 2)
+        self.assertEqual(version, 2)
+        self.assertTrue(isinstance(data, buffer))
+        region.close()
+
+    def test_reopen(self):
+        region = Region(self.fp)
+        region.write(1, 2, "hello".encode("zlib"))
+        region.write(31, 31, "world".encode("zlib"))
+        region.close()
+
+        region = Region(self.fp)
+        self.assertEqual(sorted(region.positions), [(1, 2), (31, 31)])
+        self.assertEqual(region.read_nbt(31, 31).read(), "world")
+        region.close()
+
+    def test_grow(self):
+        region = Region(self.fp)
+        region.write(0, 0, "a")
+        data = "b" * 10000
+        region.write(0, 0, data)
+        self.assertEqual(str(region.read(0, 0)[1]), data)
+        self.assertEqual(region.positions[0, 0][1], 3)
+        region.close()
+
+    def test_timestamps(self):
+        region = Region(self.fp)
+        region.write(1, 2, "hello".encode("zlib"))
+        timestamp = region.timestamps[1, 2]
+        region.close()
+
+        region = Region(self.fp)
+        self.assertEqual(region.timestamps, {(1, 2): timestamp})
+        region.close()
+
+    def test_reuse_pages(self):
+        region = Region(self.fp, journal=False)
+        region.write(0, 0, "a" * 5000)
+        region.write(1, 0, "b")
+        region.write(0, 0, "a")
+        region.write(2, 0, "c")
+        self.assertEqual(region.positions[0, 0], (2, 1))
+        self.assertEqual(region.positions[2, 0], (3, 1))
+        region.close()
+
+    def test_compact(self):
+        region = Region(self.fp, journal=False)
+        region.write(0, 0, "a" * 10000)
+        region.write(1, 0, "b")
+        region.write(0, 0, "a")
+        region.close()
+
+        self.assertEqual(compact_region(self.fp), 2 * 4096)
+
+        region = Region(self.fp)
+        self.assertEqual(region.positions, {(0, 0): (2, 1), (1, 0): (3, 1)})
+        self.assertEqual(str(region.read(1, 0)[1]), "b")
+        region.close()
+
+class TestRegionJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.fp = FilePath(self.d).child("r.0.0.mcr")
+        self.journal = self.fp.siblingExtension(".journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def crash(self, content):
+        """
+        Write two versions of a chunk, and then pretend that the header of
+        the second write never made it to disk.
+        """
+
+        region = Region(self.fp)
+        region.write(0, 0, "old".encode("zlib"))
+        old = region.header()
+        region.write(0, 0, "new".encode("zlib"))
+        new = region.header()
+        region.close()
+
+        handle = self.fp.open("r+")
+        handle.write(old)
+        handle.close()
+
+        self.journal.setContent(content(new))
+
+    def test_no_journal(self):
+        region = Region(self.fp)
+        region.write(0, 0, "hello".encode("zlib"))
+        self.assertFalse(self.journal.exists())
+        self.assertFalse(recover_region(self.fp))
+        region.close()
+
+    def test_moves(self):
+        region = Region(self.fp)
+        region.write(0, 0, "a")
+        region.write(0, 0, "b")
+        self.assertEqual(region.positions[0, 0], (3, 1))
+        self.assertEqual(region.allocator.extents, {2: 1})
+        region.close()
+
+    def test_recover_finish(self):
+        self.crash(lambda header: pack(">L", crc32(header) & 0xffffffff) +
+            header)
+        region = Region(self.fp)
+        self.assertEqual(region.read_nbt(0, 0).read(), "new")
+        self.assertFalse(self.journal.exists())
+        region.close()
+
+    def test_recover_discard(self):
+        self.crash(lambda header: pack(">L", crc32(header) & 0xffffffff) +
+            header[:100])
+        self.assertFalse(recover_region(self.fp))
+        self.assertFalse(self.journal.exists())
+        region = Region(self.fp)
+        self.assertEqual(region.read_nbt(0, 0).read(), "old")
+        region.close()
+
+class TestRegionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.folder = FilePath(self.d)
+        self.pool = RegionPool(size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.d)
+
+    def test_missing(self):
+        self.assertEqual(self.pool.get(self.folder.child("r.0.0.mcr")), None)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_cached(self):
+        fp = self.folder.child("r.0.0.mcr")
+        region = self.pool.get(fp, create=True)
+        self.assertTrue(self.pool.get(fp) is region)
+
+    def test_evict_lru(self):
+        a, b, c = (self.folder.child("r.%d.0.mcr" % i) for i in range(3))
+        region = self.pool.get(a, create=True)
+        self.pool.get(b, create=True)
+        self.pool.get(a)
+        self.pool.get(c, create=True)
+
+        self.assertTrue(a in self.pool)
+        self.assertFalse(b in self.pool)
+        self.assertTrue(c in self.pool)
+        self.assertTrue(self.pool.get(a) is region)
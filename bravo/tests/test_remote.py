@@ -0,0 +1,136 @@
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from bravo.blocks import blocks
+from bravo.chunk import Chunk
+from bravo.remote import GenerationPool
+
+class RecordingPool(object):
+    """
+    A stand-in for a process pool, which only records the work handed to it.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def apply_async(self, f, args, callback):
+        self.calls.append(args)
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+class TestGenerationPool(unittest.TestCase):
+
+    def setUp(self):
+        self.p = GenerationPool(1, ["boring", "safety"])
+
+    def tearDown(self):
+        # Chunks handed to a recording pool are never generated, and are
+        # failed when the pool stops.
+        for chunk, d, call in self.p.running.values():
+            d.addErrback(lambda failure: None)
+        self.p.stop()
+
+    def record(self):
+        self.p.pool = RecordingPool()
+        self.p.clock = Clock()
+
+    def test_generate(self):
+        self.p.start()
+        d = self.p.generate(Chunk(1, 2), 0)
+
+        @d.addCallback
+        def cb(chunk):
+            self.assertEqual(chunk.get_block((0, 0, 0)),
+                blocks["bedrock"].slot)
+            self.assertEqual(chunk.get_block((0, 63, 0)),
+                blocks["stone"].slot)
+            self.assertEqual(chunk.skylight[0, 0, 64], 15)
+            self.assertEqual(chunk.heightmap[0, 0], 63)
+            self.assertEqual(self.p.generated, 1)
+            self.assertEqual(self.p.free, [0, 1])
+
+        return d
+
+    def test_limit(self):
+        self.record()
+        for i in range(3):
+            self.p.generate(Chunk(i, 0), 0)
+        self.assertEqual(len(self.p.pool.calls), 2)
+        self.assertEqual(len(self.p.queue), 1)
+        self.p.pool = None
+
+    def test_priority(self):
+        self.record()
+        self.p.free = []
+        self.p.priority = lambda x, z: abs(x)
+        for i in (5, -1, 3):
+            self.p.generate(Chunk(i, 0), 0)
+
+        self.p.free = [0]
+        self.p.dispatch()
+        self.assertEqual(self.p.pool.calls[0][0], -1)
+        self.p.pool = None
+
+    def test_order(self):
+        self.record()
+        self.p.free = []
+        for i in (5, -1, 3):
+            self.p.generate(Chunk(i, 0), 0)
+
+        self.p.free = [0, 1, 2]
+        self.p.dispatch()
+        self.assertEqual([args[0] for args in self.p.pool.calls], [5, -1, 3])
+        self.p.pool = None
+
+    def test_cancel(self):
+        self.record()
+        self.p.free = []
+        d = self.p.generate(Chunk(1, 2), 0)
+
+        self.assertFalse(self.p.cancel(2, 1))
+        self.assertTrue(self.p.cancel(1, 2))
+        self.assertEqual(self.p.queue, [])
+        self.p.pool = None
+        return self.assertFailure(d, CancelledError)
+
+    def test_error(self):
+        self.record()
+        self.p.free = [0]
+        d = self.p.generate(Chunk(0, 0), 0)
+        self.p.generated_chunk(Chunk(0, 0), d, 0, ("Traceback", 0))
+        self.assertEqual(self.p.free, [0])
+        self.assertEqual(self.p.running, {})
+        self.p.pool = None
+        return self.assertFailure(d, RuntimeError)
+
+    def test_timeout(self):
+        self.record()
+        self.p.start = self.record
+        for i in range(3):
+            self.p.generate(Chunk(i, 0), 0)
+
+        failed = []
+        for chunk, d, call in self.p.running.values():
+            d.addErrback(failed.append)
+        self.p.clock.advance(self.p.timeout)
+
+        self.assertEqual(len(failed), 2)
+        self.assertEqual([args[:2] for args in self.p.pool.calls], [(2, 0)])
+        self.assertEqual(len(self.p.running), 1)
+        self.p.pool = None
+
+    def test_stop_late(self):
+        self.record()
+        d = self.p.generate(Chunk(1, 2), 0)
+        slot, = self.p.running
+        self.p.pool = None
+        self.p.stop()
+
+        self.p.generated_chunk(Chunk(1, 2), d, slot, (None, 0))
+        self.assertEqual(sorted(self.p.free), [0, 1])
+        return self.assertFailure(d, RuntimeError)
@@ -0,0 +1,210 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from bravo.entity import Player
+from bravo.packets.beta import make_packet, parse_packets
+from bravo.protocols.beta import PacketQueue
+from bravo.tracking import EntityTracker
+
+class MockFactory(object):
+
+    def __init__(self):
+        self.chunk_subscribers = {}
+
+class MockTransport(StringTransport):
+
+    def write(self, data, key=None):
+        StringTransport.write(self, data)
+
+class MockProtocol(object):
+
+    def __init__(self, eid, x, z):
+        self.player = Player(username="player%d" % eid, eid=eid)
+        self.location = self.player.location
+        self.location.x = x
+        self.location.y = 64
+        self.location.z = z
+        self.transport = MockTransport()
+
+    def packets(self):
+        packets, leftovers = parse_packets(self.transport.value())
+        self.transport.clear()
+        return packets
+
+class TestEntityTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.f = MockFactory()
+        self.t = EntityTracker(self.f, distance=2, resync=3)
+
+        self.a = MockProtocol(1, 8, 8)
+        self.b = MockProtocol(2, 24, 8)
+        self.t.add(self.a)
+        self.t.add(self.b)
+
+    def subscribe(self, protocol, x, z):
+        self.f.chunk_subscribers.setdefault((x, z), set()).add(protocol)
+        self.t.subscribed(protocol, x, z)
+
+    def unsubscribe(self, protocol, x, z):
+        self.f.chunk_subscribers[x, z].discard(protocol)
+        self.t.unsubscribed(protocol, x, z)
+
+    def move(self, protocol, dx, dz):
+        protocol.location.x += dx
+        protocol.location.z += dz
+        self.t.moved(protocol)
+
+    def test_trivial(self):
+        pass
+
+    def test_unsubscribed(self):
+        self.move(self.a, 1, 0)
+        self.assertEqual(self.b.packets(), [])
+
+    def test_spawn(self):
+        self.subscribe(self.b, 0, 0)
+
+        packets = self.b.packets()
+        self.assertEqual([header for header, payload in packets],
+            [20, 30, 34])
+        self.assertEqual(packets[-1][1].eid, 1)
+        self.assertEqual(packets[-1][1].x, 8 * 32)
+        self.assertEqual(self.a.packets(), [])
+
+    def test_spawn_once(self):
+        self.subscribe(self.b, 0, 0)
+        self.b.packets()
+        self.subscribe(self.b, 0, 0)
+        self.assertEqual(self.b.packets(), [])
+
+    def test_distance(self):
+        far = MockProtocol(3, 16 * 5, 8)
+        self.t.add(far)
+        self.subscribe(self.a, 5, 0)
+        self.assertEqual(self.a.packets(), [])
+
+    def test_relative(self):
+        self.subscribe(self.b, 0, 0)
+        self.b.packets()
+
+        self.move(self.a, 1, -2)
+        (header, payload), = self.b.packets()
+        self.assertEqual(header, 31)
+        self.assertEqual((payload.x, payload.y, payload.z), (32, 0, -64))
+
+    def test_orientation(self):
+        self.subscribe(self.b, 0, 0)
+        self.b.packets()
+
+        self.a.location.yaw = 90
+        self.t.moved(self.a)
+        (header, payload), = self.b.packets()
+        self.assertEqual(header, 32)
+
+        self.a.location.yaw = 180
+        self.move(self.a, 1, 0)
+        (header, payload), = self.b.packets()
+        self.assertEqual(header, 33)
+
+    def test_resync(self):
+        self.subscribe(self.b, 0, 0)
+        self.b.packets()
+
+        for i in range(4):
+            self.move(self.a, 1, 0)
+        headers = [header for header, payload in self.b.packets()]
+        self.assertEqual(headers, [31, 31, 31, 34])
+
+    def test_far_move(self):
+        self.subscribe(self.b, 0, 0)
+        self.b.packets()
+
+        self.move(self.a, 0, 4)
+        (header, payload), = self.b.packets()
+        self.assertEqual(header, 34)
+        self.assertEqual(payload.z, 12 * 32)
+
+    def test_leave(self):
+        self.subscribe(self.b, 0, 0)
+        self.b.packets()
+
+        self.move(self.a, 0, 16)
+        (header, payload), = self.b.packets()
+        self.assertEqual(header, 29)
+        self.assertEqual(payload.eid, 1)
+
+    def test_enter(self):
+        self.subscribe(self.b, 0, 1)
+        self.move(self.a, 0, 16)
+
+        headers = [header for header, payload in self.b.packets()]
+        self.assertEqual(headers[0], 20)
+        self.assertEqual(headers[-1], 34)
+
+    def test_unsubscribe(self):
+        self.subscribe(self.b, 0, 0)
+        self.b.packets()
+        self.unsubscribe(self.b, 0, 0)
+
+        (header, payload), = self.b.packets()
+        self.assertEqual(header, 29)
+
+    def test_remove(self):
+        self.subscribe(self.b, 0, 0)
+        self.subscribe(self.a, 1, 0)
+        self.a.packets()
+        self.b.packets()
+
+        self.t.remove(self.a)
+        (header, payload), = self.b.packets()
+        self.assertEqual(header, 29)
+        self.assertEqual(self.t.watchers[self.b], set())
+        self.assertFalse(self.a in self.t.sent)
+
+    def test_subscribed_removed(self):
+        self.t.remove(self.a)
+        self.subscribe(self.a, 1, 0)
+
+        self.assertEqual(self.a.packets(), [])
+        self.assertEqual(self.t.watchers[self.b], set())
+        self.assertFalse(self.a in self.t.watching)
+
+    def test_spawn_removed(self):
+        self.t.remove(self.a)
+        self.t.spawn(self.a, self.b)
+        self.t.spawn(self.b, self.a)
+
+        self.assertEqual(self.t.watchers[self.b], set())
+        self.assertFalse(self.a in self.t.watchers)
+
+    def test_spawn_behind_bulk(self):
+        """
+        Moves and destruction should stay behind a spawn which is queued
+        behind chunk data.
+        """
+
+        clock = Clock()
+        transport = StringTransport()
+        self.b.transport = PacketQueue(transport, clock)
+        self.b.transport.pauseProducing()
+
+        self.b.transport.write(make_packet("prechunk", x=0, z=0, enabled=1))
+        self.b.transport.behind_bulk = True
+        self.subscribe(self.b, 0, 0)
+        self.b.transport.behind_bulk = False
+
+        self.move(self.a, 1, 0)
+        self.t.remove(self.a)
+        clock.advance(0)
+        self.assertEqual(transport.value(), "")
+
+        self.b.transport.resumeProducing()
+        clock.advance(0)
+        packets, leftovers = parse_packets(transport.value())
+        headers = [header for header, payload in packets]
+        self.assertEqual(headers[0], 50)
+        self.assertEqual(headers[1], 20)
+        self.assertEqual(headers[-2:], [31, 29])
+        self.assertEqual(self.b.transport.held, set())
@@ -6,6 +6,7 @@ from numpy import array
 from numpy.testing import assert_array_equal
 
 from bravo.utilities.bits import unpack_nibbles, pack_nibbles
+from bravo.utilities.bits import pack_nibble_array, unpack_nibble_array
 from bravo.utilities.chat import sanitize_chat
 from bravo.utilities.coords import split_coords, taxicab2, taxicab3
 from bravo.utilities.temporal import split_time
@@ -61,6 +62,14 @@ class TestBitTwiddling(unittest.TestCase):
             )
         )
 
+    def test_pack_nibble_array(self):
+        a = array([[1, 6, 14, 6], [9, 6, 2, 6]])
+        assert_array_equal(pack_nibble_array(a), [[0x61, 0x6e], [0x69, 0x62]])
+
+    def test_nibble_array_reflexivity(self):
+        a = array([[1, 6, 14, 6], [9, 6, 2, 6]])
+        assert_array_equal(unpack_nibble_array(pack_nibble_array(a)), a)
+
 class TestStringMunging(unittest.TestCase):
 
     def test_sanitize_chat_color_control_at_end(self):
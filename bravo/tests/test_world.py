@@ -1,6 +1,9 @@
 from twisted.trial import unittest
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (Deferred, gatherResults, inlineCallbacks,
+    returnValue)
+from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
 
 import numpy
 import shutil
@@ -9,8 +12,33 @@ import tempfile
 from itertools import product
 
 import bravo.config
+from bravo.blocks import blocks
 from bravo.errors import ChunkNotLoaded, SerializerReadException
-from bravo.world import World
+from bravo.location import Location
+from bravo.world import ChunkCache, Prefetcher, World
+
+class MockChunk(object):
+
+    nbytes = 100
+
+class MockWorld(object):
+    """
+    A stand-in for a world, which only records the chunks requested from it.
+    """
+
+    def __init__(self):
+        self.chunk_cache = {}
+        self.dirty_chunk_cache = {}
+        self._pending_chunks = {}
+        self.requested = []
+        self.queued = set()
+
+    def request_chunk(self, x, z):
+        self.requested.append((x, z))
+        return Deferred()
+
+    def cancel_chunk(self, x, z):
+        return (x, z) in self.queued
 
 class TestWorldChunks(unittest.TestCase):
 
@@ -131,6 +159,132 @@ class TestWorldChunks(unittest.TestCase):
             metadata = yield self.w.get_metadata((x, y, z))
             self.assertEqual(metadata, chunk.get_metadata((x, y, z)))
 
+    @inlineCallbacks
+    def test_write_back_readback(self):
+        chunk = yield self.w.request_chunk(0, 0)
+        chunk.set_block((1, 2, 3), blocks["stone"].slot)
+
+        yield self.w.write_back([chunk])
+        self.assertFalse(chunk.dirty)
+        self.assertTrue((0, 0) in self.w.chunk_cache)
+        self.assertFalse((0, 0) in self.w.dirty_chunk_cache)
+        self.assertEqual(self.w.writes, 1)
+
+        del chunk
+        self.w.chunk_cache.clear()
+        chunk = yield self.w.request_chunk(0, 0)
+        self.assertEqual(chunk.get_block((1, 2, 3)), blocks["stone"].slot)
+
+    @inlineCallbacks
+    def test_request_chunk_batched(self):
+        batches = []
+        load_chunks = self.w.serializer.load_chunks
+        def record(chunks):
+            batches.append(sorted((c.x, c.z) for c in chunks))
+            return load_chunks(chunks)
+        self.w.serializer.load_chunks = record
+
+        chunks = yield gatherResults([self.w.request_chunk(0, 0),
+            self.w.request_chunk(1, 0), self.w.request_chunk(0, 0)])
+
+        self.assertEqual(batches, [[(0, 0), (1, 0)]])
+        self.assertTrue(chunks[0] is chunks[2])
+
+    @inlineCallbacks
+    def test_request_chunk_disk_busy(self):
+        """
+        Chunks should be loaded without blocking while the disk is busy.
+        """
+
+        self.w.disk_lock.acquire()
+        try:
+            d = self.w.request_chunk(0, 0)
+            yield deferLater(reactor, 0.1, lambda: None)
+            self.assertFalse(d.called)
+        finally:
+            self.w.disk_lock.release()
+
+        chunk = yield d
+        self.assertEqual((chunk.x, chunk.z), (0, 0))
+        self.assertTrue(self.w.disk_waited > 0)
+
+    @inlineCallbacks
+    def test_write_back_superseded(self):
+        chunk = yield self.w.request_chunk(0, 0)
+        record, sequence = self.w.encode_chunk(chunk)
+
+        chunk.set_block((1, 2, 3), blocks["stone"].slot)
+        self.w.save_chunk(chunk)
+
+        # The older record must not clobber the newer one.
+        self.w.write_records([(0, 0, record, sequence)])
+
+        del chunk
+        self.w.chunk_cache.clear()
+        self.w.dirty_chunk_cache.clear()
+        chunk = yield self.w.request_chunk(0, 0)
+        self.assertEqual(chunk.get_block((1, 2, 3)), blocks["stone"].slot)
+
+    @inlineCallbacks
+    def test_sort_chunks_oldest_first(self):
+        for x in range(3):
+            yield self.w.request_chunk(x, 0)
+
+        written = []
+        self.w.write_back = written.extend
+        self.w.save_limit = 2
+        self.w.sort_chunks()
+
+        self.assertEqual([(c.x, c.z) for c in written], [(0, 0), (1, 0)])
+
+    @inlineCallbacks
+    def test_sort_chunks_coalesce(self):
+        yield self.w.request_chunk(0, 0)
+
+        written = []
+        self.w.write_back = written.extend
+        self.w._writing[0, 0] = 0
+        self.w.sort_chunks()
+
+        self.assertEqual(written, [])
+
+    @inlineCallbacks
+    def test_sort_chunks_rate(self):
+        yield self.w.request_chunk(0, 0)
+
+        written = []
+        self.w.write_back = written.extend
+        self.w.save_rate = 1024
+        self.w.write_debt = 4096
+        self.w.sort_chunks()
+
+        self.assertEqual(written, [])
+        self.assertEqual(self.w.write_debt, 3072)
+
+    @inlineCallbacks
+    def test_sort_chunks_compact(self):
+        """
+        Chunks should only be compacted once they have sat idle through a
+        pass of the management loop.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+        self.assertNotEqual(chunk.layers, None)
+        self.assertNotEqual(neighbor.layers, None)
+
+        self.w.write_back = lambda chunks: None
+        self.w.sort_chunks()
+        self.assertNotEqual(chunk.layers, None)
+
+        chunk.set_block((1, 2, 3), blocks["stone"].slot)
+        self.w.sort_chunks()
+        self.assertNotEqual(chunk.layers, None)
+        self.assertEqual(neighbor.layers, None)
+
+        self.w.sort_chunks()
+        self.assertEqual(chunk.layers, None)
+
     @inlineCallbacks
     def test_world_level_mark_chunk_dirty(self):
         chunk = yield self.w.request_chunk(0, 0)
@@ -198,6 +352,394 @@ class TestWorldChunks(unittest.TestCase):
 
         return d
 
+class TestWorldLighting(unittest.TestCase):
+
+    def setUp(self):
+        self.name = "unittest"
+        self.d = tempfile.mkdtemp()
+
+        bravo.config.configuration.add_section("world unittest")
+        bravo.config.configuration.set("world unittest", "url", "file://%s" % self.d)
+        bravo.config.configuration.set("world unittest", "serializer",
+            "alpha")
+
+        self.w = World(self.name)
+        self.w.pipeline = []
+        self.w.start()
+
+    def tearDown(self):
+        self.w.stop()
+        del self.w
+
+        shutil.rmtree(self.d)
+        bravo.config.configuration.remove_section("world unittest")
+
+    def test_trivial(self):
+        pass
+
+    @inlineCallbacks
+    def test_glow_across_border(self):
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+
+        self.w.sync_set_block((15, 64, 8), blocks["lightstone"].slot)
+        self.w.relight_chunk(chunk)
+        self.assertEqual(neighbor.blocklight[0, 8, 64], 15)
+        self.assertEqual(neighbor.blocklight[5, 8, 64], 10)
+        self.assertTrue(neighbor.dirty)
+
+        self.w.sync_destroy((15, 64, 8))
+        self.w.relight_chunk(chunk)
+        self.assertFalse(neighbor.blocklight.any())
+
+    @inlineCallbacks
+    def test_relight_chunk_deferred(self):
+        """
+        Edits shouldn't relight anything until the chunk is relit.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+
+        self.w.sync_set_block((15, 64, 8), blocks["lightstone"].slot)
+        self.w.sync_set_block((15, 64, 9), blocks["lightstone"].slot)
+        self.assertNotEqual(chunk.dirty_light, None)
+        self.assertFalse(neighbor.blocklight.any())
+
+        self.w.relight_chunk(chunk)
+        self.assertEqual(chunk.dirty_light, None)
+        self.assertEqual(chunk.blocklight[15, 8, 64], 15)
+        self.assertEqual(neighbor.blocklight[0, 9, 64], 15)
+
+    @inlineCallbacks
+    def test_glow_across_border_far(self):
+        """
+        Light sources out of reach of a border shouldn't touch neighbours.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+        neighbor.dirty = False
+
+        self.w.sync_set_block((0, 64, 8), blocks["torch"].slot)
+        self.w.relight_chunk(chunk)
+        self.assertFalse(neighbor.blocklight.any())
+        self.assertFalse(neighbor.dirty)
+
+    @inlineCallbacks
+    def test_glow_across_border_unloaded(self):
+        """
+        Light sources next to unloaded chunks should light them up when they
+        are loaded.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+
+        self.w.sync_set_block((15, 64, 8), blocks["lightstone"].slot)
+        self.w.relight_chunk(chunk)
+        self.assertTrue((-1, 0) in self.w._pending_edges[1, 0])
+
+        neighbor = yield self.w.request_chunk(1, 0)
+        self.assertEqual(neighbor.blocklight[0, 8, 64], 15)
+        self.assertFalse((1, 0) in self.w._pending_edges)
+
+    @inlineCallbacks
+    def test_stop_relights_clean_neighbor(self):
+        """
+        Stopping the world should save the clean neighbours which relighting
+        dirtied on the way out.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+        self.w.save_chunk(neighbor)
+        del self.w.dirty_chunk_cache[1, 0]
+        self.w.chunk_cache[1, 0] = neighbor
+
+        self.w.sync_set_block((15, 64, 8), blocks["lightstone"].slot)
+        self.w.stop()
+
+        self.w = World(self.name)
+        self.w.pipeline = []
+        self.w.start()
+        neighbor = yield self.w.request_chunk(1, 0)
+        self.assertEqual(neighbor.blocklight[0, 8, 64], 15)
+
+    @inlineCallbacks
+    def test_load_without_edges(self):
+        """
+        Loading a chunk without any queued edges shouldn't relight, expand,
+        or dirty its neighbours.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+        self.w.save_chunk(neighbor)
+        del self.w.dirty_chunk_cache[1, 0]
+        del neighbor
+
+        chunk.compact()
+        chunk.dirty = False
+        generation = chunk.generation
+
+        neighbor = yield self.w.request_chunk(1, 0)
+        self.assertEqual(chunk.layers, None)
+        self.assertEqual(chunk.generation, generation)
+        self.assertFalse(chunk.dirty)
+
+    @inlineCallbacks
+    def test_glow_across_corner(self):
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 1)
+
+        self.w.sync_set_block((15, 64, 15), blocks["lightstone"].slot)
+        self.w.relight_chunk(chunk)
+        self.assertEqual(neighbor.blocklight[0, 0, 64], 14)
+
+    @inlineCallbacks
+    def test_skylight_across_border(self):
+        yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+
+        # Put a roof over the neighbour, so that its only light comes in
+        # sideways.
+        neighbor.blocks[:, :, 10] = blocks["stone"].slot
+        neighbor.regenerate()
+        self.assertEqual(neighbor.skylight[0, 8, 5], 0)
+
+        self.w.propagate_light(neighbor)
+        self.assertEqual(neighbor.skylight[0, 8, 5], 14)
+        self.assertEqual(neighbor.skylight[1, 8, 5], 13)
+
+    @inlineCallbacks
+    def test_skylight_darkened_next_to_neighbor(self):
+        """
+        Edits which darken a chunk shouldn't be lit back up by the light
+        which the chunk shone into its neighbours before.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+
+        neighbor.blocks[:, :, 10] = blocks["stone"].slot
+        neighbor.regenerate()
+        self.w.propagate_light(neighbor)
+        self.assertEqual(neighbor.skylight[0, 8, 5], 14)
+
+        # Now put a roof over the chunk, too.
+        for x, z in product(xrange(16), repeat=2):
+            self.w.sync_set_block((x, 10, z), blocks["stone"].slot)
+        self.w.relight_chunk(chunk)
+
+        self.assertFalse(chunk.skylight[:, :, :10].any())
+        self.assertFalse(neighbor.skylight[:, :, :10].any())
+
+    @inlineCallbacks
+    def dig_tunnel(self):
+        """
+        Dig a tunnel under the ground, through two chunks, lit by a shaft
+        next to the border between them.
+        """
+
+        chunk = yield self.w.request_chunk(0, 0)
+        neighbor = yield self.w.request_chunk(1, 0)
+
+        for c in chunk, neighbor:
+            c.blocks[:, :, :64] = blocks["stone"].slot
+            c.blocks[:, 8, 50] = blocks["air"].slot
+            c.regenerate()
+        chunk.blocks[15, 8, 51:64] = blocks["air"].slot
+        chunk.regenerate()
+        self.w.propagate_light(chunk)
+
+        returnValue((chunk, neighbor))
+
+    @inlineCallbacks
+    def test_skylight_shaft_across_border(self):
+        chunk, neighbor = yield self.dig_tunnel()
+
+        self.assertEqual(list(chunk.skylight[10:, 8, 50]),
+            [10, 11, 12, 13, 14, 15])
+        self.assertEqual(list(neighbor.skylight[:6, 8, 50]),
+            [14, 13, 12, 11, 10, 9])
+
+    @inlineCallbacks
+    def test_skylight_shaft_sealed(self):
+        """
+        Sealing a shaft next to a border should darken both sides of the
+        border, instead of each side lighting the other back up.
+        """
+
+        chunk, neighbor = yield self.dig_tunnel()
+        neighbor.dirty = False
+
+        self.w.sync_set_block((15, 63, 8), blocks["stone"].slot)
+        self.w.relight_chunk(chunk)
+
+        self.assertFalse(chunk.skylight[:, 8, 50].any())
+        self.assertFalse(neighbor.skylight[:, 8, 50].any())
+        self.assertTrue(neighbor.dirty)
+
+    @inlineCallbacks
+    def test_skylight_stale_on_load(self):
+        """
+        Light which a chunk saved from a neighbour should be taken away when
+        it is loaded, if the neighbour has changed since.
+        """
+
+        chunk, neighbor = yield self.dig_tunnel()
+        self.w.save_chunk(neighbor)
+        del self.w.dirty_chunk_cache[1, 0]
+        del neighbor
+
+        self.w.sync_set_block((15, 63, 8), blocks["stone"].slot)
+        self.w.relight_chunk(chunk)
+
+        neighbor = yield self.w.request_chunk(1, 0)
+        self.assertFalse(chunk.skylight[:, 8, 50].any())
+        self.assertFalse(neighbor.skylight[:, 8, 50].any())
+
+class TestChunkCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ChunkCache(300, 60, self.clock)
+
+    def test_trivial(self):
+        pass
+
+    def test_get(self):
+        chunk = MockChunk()
+        self.cache[0, 0] = chunk
+
+        self.assertTrue(self.cache.get((0, 0)) is chunk)
+        self.assertEqual(self.cache.get((0, 1)), None)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_prune_budget(self):
+        chunks = [MockChunk() for i in range(4)]
+        for i, chunk in enumerate(chunks):
+            self.cache[i, 0] = chunk
+
+        # Use the oldest chunk, so that the second-oldest is evicted instead.
+        self.cache[0, 0]
+        self.cache.prune()
+
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.bytes, 300)
+        self.assertEqual(list(self.cache.entries), [(2, 0), (3, 0), (0, 0)])
+
+    def test_prune_ttl(self):
+        self.cache[0, 0] = MockChunk()
+        self.clock.advance(30)
+        self.cache[1, 0] = MockChunk()
+        self.clock.advance(40)
+        self.cache.prune()
+
+        self.assertEqual(list(self.cache.entries), [(1, 0)])
+
+    def test_prune_pinned(self):
+        self.cache[0, 0] = MockChunk()
+        self.clock.advance(90)
+        self.cache.prune(set([(0, 0)]))
+
+        self.assertEqual(list(self.cache.entries), [(0, 0)])
+
+    def test_prune_referenced(self):
+        """
+        Evicted chunks should still be found while they're referenced.
+        """
+
+        chunk = MockChunk()
+        self.cache[0, 0] = chunk
+        self.cache[1, 0] = MockChunk()
+        self.clock.advance(90)
+        self.cache.prune()
+
+        self.assertEqual(len(self.cache.entries), 0)
+        self.assertTrue(self.cache.get((0, 0)) is chunk)
+        self.assertFalse((1, 0) in self.cache)
+        self.assertEqual(list(self.cache.entries), [(0, 0)])
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.world = MockWorld()
+        view = [(i, j) for i, j in product(xrange(-2, 2), repeat=2)
+            if i**2 + j**2 <= 4]
+        self.p = Prefetcher(self.world, 3, view=view, clock=self.clock)
+        self.location = Location()
+
+    def move(self, dx, dz, names=("test",)):
+        self.clock.advance(1)
+        self.location.x += dx
+        self.location.z += dz
+        for name in names:
+            self.p.moved(name, self.location)
+
+    def test_trivial(self):
+        pass
+
+    def test_standing(self):
+        self.move(0, 0)
+        self.move(0, 0)
+        self.assertEqual(self.world.requested, [])
+
+    def test_moving(self):
+        self.move(0, 0)
+        self.move(8, 0)
+
+        # Two seconds at 4 blocks per second, three chunks ahead at most.
+        self.assertTrue(self.world.requested)
+        for x, z in self.world.requested:
+            self.assertTrue(x > 0)
+        self.assertEqual(self.p.requests, len(self.world.requested))
+        self.assertEqual(set(self.p.speculative),
+            set(self.world.requested))
+
+    def test_cached(self):
+        self.world.chunk_cache[3, 0] = MockChunk()
+        self.move(0, 0)
+        self.move(8, 0)
+        self.assertFalse((3, 0) in self.world.requested)
+
+    def test_claim(self):
+        self.move(0, 0)
+        self.move(8, 0)
+        coords = self.world.requested[0]
+        self.p.claim(coords)
+        self.p.claim(coords)
+
+        self.assertEqual(self.p.hits, 1)
+        self.assertFalse(coords in self.p.speculative)
+
+    def test_turn(self):
+        self.move(0, 0)
+        self.move(8, 0)
+        speculative = set(self.p.speculative)
+        self.world.queued = set(list(speculative)[:1])
+
+        self.clock.advance(5)
+        self.move(0, 0)
+
+        self.assertEqual(self.p.speculative, {})
+        self.assertEqual(self.p.cancelled, 1)
+        self.assertEqual(self.p.wasted, len(speculative) - 1)
+
+    def test_shared(self):
+        self.move(0, 0, names=("test", "other"))
+        self.move(8, 0, names=("test", "other"))
+        self.p.forget("test")
+
+        self.assertTrue(self.p.speculative)
+        self.assertEqual(self.p.wasted, 0)
+
+        self.p.forget("other")
+        self.assertEqual(self.p.speculative, {})
+        self.assertEqual(self.p.tracks, {})
+
 class TestWorldInit(unittest.TestCase):
 
     def setUp(self):
@@ -230,3 +772,47 @@ class TestWorldInit(unittest.TestCase):
         w = bravo.world.World(self.name)
         w.start()
         w.stop()
+
+    def test_stop_close(self):
+        """
+        Stopping a world should close its serializer, after saving.
+        """
+
+        w = World(self.name)
+        w.start()
+
+        calls = []
+        w.save_chunks = lambda chunks: calls.append("save_chunks")
+        w.serializer.close = lambda: calls.append("close")
+        w.stop()
+
+        self.assertEqual(calls, ["save_chunks", "close"])
+
+    @inlineCallbacks
+    def test_generation_processes(self):
+        bravo.config.configuration.set("world unittest",
+            "generation_processes", "1")
+        bravo.config.configuration.set("world unittest", "generators",
+            "boring")
+
+        w = World(self.name)
+        w.pipeline = []
+        w.start()
+        try:
+            chunk = yield w.request_chunk(0, 0)
+            self.assertEqual(chunk.get_block((0, 63, 0)),
+                blocks["stone"].slot)
+            self.assertEqual(w.generation_pool.generated, 1)
+        finally:
+            w.stop()
+
+    def test_prefetch_without_processes(self):
+        bravo.config.configuration.set("world unittest", "prefetch", "3")
+
+        w = World(self.name)
+        w.pipeline = []
+        w.start()
+        try:
+            self.assertEqual(w.prefetcher, None)
+        finally:
+            w.stop()
@@ -0,0 +1,251 @@
+from math import pi
+
+from bravo.packets.beta import make_packet
+from bravo.utilities.coords import split_coords
+
+class EntityTracker(object):
+    """
+    Keeper of which players can see which other players.
+
+    Players only see the players who are standing in chunks which they have
+    loaded, within a view distance. Avatars are spawned and destroyed as
+    players come into and go out of view, and movement is only sent to the
+    players who can see it, as small relative moves where possible.
+
+    Packets about an avatar are written along with its entity ID, so that a
+    transport which queues an avatar's spawn behind chunk data keeps its
+    movement and destruction queued behind the spawn.
+    """
+
+    def __init__(self, factory, distance=10, resync=20):
+        """
+        :param factory: the factory whose players are tracked
+        :param int distance: how far players can see other players, in chunks
+        :param int resync: how many relative moves are sent in a row before
+                           the absolute position is sent again
+        """
+
+        self.factory = factory
+        self.distance = distance
+        self.resync = resync
+
+        # The chunk which each tracked protocol is in, and the tracked
+        # protocols in each chunk.
+        self.positions = {}
+        self.occupants = {}
+
+        # The protocols which can see each tracked protocol, and the other
+        # way around.
+        self.watchers = {}
+        self.watching = {}
+
+        # The position and orientation last sent for each tracked protocol,
+        # in the units of the packets, and the number of relative moves sent
+        # since the last absolute one.
+        self.sent = {}
+
+        # Statistics.
+        self.relative = 0
+        self.absolute = 0
+
+    def chunk_of(self, protocol):
+        x, chaff, z, chaff = split_coords(protocol.location.x,
+            protocol.location.z)
+        return x, z
+
+    def location_of(self, protocol):
+        location = protocol.location
+        return (int(location.x * 32), int(location.y * 32),
+            int(location.z * 32), int(location.theta * 255 / (2 * pi)) % 256,
+            int(location.phi * 255 / (2 * pi)) % 256)
+
+    def can_see(self, watcher, protocol):
+        """
+        Whether one protocol can see another's avatar.
+        """
+
+        if watcher is protocol:
+            return False
+
+        x, z = self.positions[protocol]
+        if watcher not in self.factory.chunk_subscribers.get((x, z), ()):
+            return False
+
+        i, j = self.chunk_of(watcher)
+        return max(abs(x - i), abs(z - j)) <= self.distance
+
+    def spawn(self, watcher, protocol):
+        """
+        Show a protocol's avatar to a watcher, where it was last sent.
+        """
+
+        if watcher not in self.sent or protocol not in self.sent:
+            # One of them has already gone.
+            return
+
+        self.watchers[protocol].add(watcher)
+        self.watching.setdefault(watcher, set()).add(protocol)
+
+        x, y, z, yaw, pitch, moves = self.sent[protocol]
+        player = protocol.player
+
+        packet = player.save_to_packet()
+        packet += player.save_equipment_to_packet()
+        packet += make_packet("create", eid=player.eid)
+        packet += make_packet("teleport", eid=player.eid, x=x, y=y, z=z,
+            yaw=yaw, pitch=pitch)
+        watcher.transport.write(packet, player.eid)
+
+    def despawn(self, watcher, protocol):
+        """
+        Hide a protocol's avatar from a watcher.
+        """
+
+        self.watchers[protocol].discard(watcher)
+        self.watching[watcher].discard(protocol)
+
+        packet = make_packet("destroy", eid=protocol.player.eid)
+        watcher.transport.write(packet, protocol.player.eid)
+
+    def add(self, protocol):
+        """
+        Start tracking a protocol's player.
+        """
+
+        self.sent[protocol] = list(self.location_of(protocol)) + [0]
+        self.watchers[protocol] = set()
+        self.watching.setdefault(protocol, set())
+
+        coords = self.chunk_of(protocol)
+        self.positions[protocol] = coords
+        self.occupants.setdefault(coords, set()).add(protocol)
+
+        self.refresh(protocol)
+
+    def remove(self, protocol):
+        """
+        Stop tracking a protocol's player, and destroy its avatar wherever it
+        was shown.
+        """
+
+        if protocol not in self.sent:
+            return
+
+        for watcher in list(self.watchers[protocol]):
+            self.despawn(watcher, protocol)
+        del self.watchers[protocol]
+
+        for other in self.watching.pop(protocol, ()):
+            self.watchers[other].discard(protocol)
+
+        coords = self.positions.pop(protocol)
+        self.occupants[coords].discard(protocol)
+        if not self.occupants[coords]:
+            del self.occupants[coords]
+
+        del self.sent[protocol]
+
+    def refresh(self, protocol):
+        """
+        Work out afresh who can see a protocol, and whom it can see.
+        """
+
+        x, z = self.positions[protocol]
+
+        seen = set(watcher for watcher in
+            self.factory.chunk_subscribers.get((x, z), ())
+            if self.can_see(watcher, protocol))
+        for watcher in self.watchers[protocol] - seen:
+            self.despawn(watcher, protocol)
+        for watcher in seen - self.watchers[protocol]:
+            self.spawn(watcher, protocol)
+
+        visible = set()
+        for (i, j), occupants in self.occupants.iteritems():
+            if max(abs(x - i), abs(z - j)) <= self.distance:
+                visible.update(other for other in occupants
+                    if self.can_see(protocol, other))
+        for other in self.watching[protocol] - visible:
+            self.despawn(protocol, other)
+        for other in visible - self.watching[protocol]:
+            self.spawn(protocol, other)
+
+    def moved(self, protocol):
+        """
+        Send a protocol's movement to everybody who can see it.
+        """
+
+        if protocol not in self.sent:
+            return
+
+        coords = self.chunk_of(protocol)
+        previous = self.positions[protocol]
+        if coords != previous:
+            self.occupants[previous].discard(protocol)
+            if not self.occupants[previous]:
+                del self.occupants[previous]
+            self.occupants.setdefault(coords, set()).add(protocol)
+            self.positions[protocol] = coords
+            self.refresh(protocol)
+
+        x, y, z, yaw, pitch = self.location_of(protocol)
+        oldx, oldy, oldz, oldyaw, oldpitch, moves = self.sent[protocol]
+
+        if not self.watchers[protocol]:
+            # Whoever sees this avatar next is sent its position anyway.
+            self.sent[protocol] = [x, y, z, yaw, pitch, moves]
+            return
+
+        eid = protocol.player.eid
+        dx, dy, dz = x - oldx, y - oldy, z - oldz
+        turned = yaw != oldyaw or pitch != oldpitch
+
+        if (moves >= self.resync or
+            not all(-128 <= d <= 127 for d in (dx, dy, dz))):
+            packet = make_packet("teleport", eid=eid, x=x, y=y, z=z, yaw=yaw,
+                pitch=pitch)
+            moves = 0
+            self.absolute += 1
+        elif (dx or dy or dz) and turned:
+            packet = make_packet("entity-location", eid=eid, x=dx, y=dy,
+                z=dz, yaw=yaw, pitch=pitch)
+            moves += 1
+            self.relative += 1
+        elif dx or dy or dz:
+            packet = make_packet("entity-position", eid=eid, x=dx, y=dy,
+                z=dz)
+            moves += 1
+            self.relative += 1
+        elif turned:
+            packet = make_packet("entity-orientation", eid=eid, yaw=yaw,
+                pitch=pitch)
+        else:
+            return
+
+        self.sent[protocol] = [x, y, z, yaw, pitch, moves]
+
+        for watcher in self.watchers[protocol]:
+            watcher.transport.write(packet, eid)
+
+    def subscribed(self, watcher, x, z):
+        """
+        Show the avatars in a chunk which a protocol has just loaded.
+        """
+
+        if watcher not in self.sent:
+            return
+
+        watching = self.watching.get(watcher, ())
+        for other in list(self.occupants.get((x, z), ())):
+            if other not in watching and self.can_see(watcher, other):
+                self.spawn(watcher, other)
+
+    def unsubscribed(self, watcher, x, z):
+        """
+        Hide the avatars in a chunk which a protocol has just unloaded.
+        """
+
+        watching = self.watching.get(watcher, ())
+        for other in list(self.occupants.get((x, z), ())):
+            if other in watching:
+                self.despawn(watcher, other)
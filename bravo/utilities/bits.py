@@ -1,4 +1,4 @@
-from numpy import uint8, cast, dstack, fromstring
+from numpy import uint8, cast, dstack, empty, fromstring
 
 """
 Bit-twiddling devices.
@@ -34,7 +34,31 @@ def pack_nibbles(a):
     :returns: packed nibbles as a string of bytes
     """
 
-    a = a.reshape(-1, 2)
+    return pack_nibble_array(a.reshape(-1)).tostring()
+
+def pack_nibble_array(a):
+    """
+    Pack pairs of nibbles into bytes, along the last axis of an array.
+
+    :param `ndarray` a: nibbles to pack
+
+    :returns: `ndarray` of packed nibbles, half as long along the last axis
+    """
+
     if a.dtype != uint8:
         a = cast[uint8](a)
-    return ((a[:, 1] << 4) | a[:, 0]).tostring()
+    return (a[..., 1::2] << 4) | a[..., ::2]
+
+def unpack_nibble_array(a):
+    """
+    Unpack bytes into pairs of nibbles, along the last axis of an array.
+
+    :param `ndarray` a: bytes to unpack
+
+    :returns: `ndarray` of nibbles, twice as long along the last axis
+    """
+
+    unpacked = empty(a.shape[:-1] + (a.shape[-1] * 2,), dtype=uint8)
+    unpacked[..., ::2] = a & 0xf
+    unpacked[..., 1::2] = a >> 4
+    return unpacked
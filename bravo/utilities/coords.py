@@ -2,6 +2,18 @@
 Utilities for coordinate handling and munging.
 """
 
+from itertools import product
+
+circle = [(i, j)
+    for i, j in product(xrange(-10, 10), xrange(-10, 10))
+    if i**2 + j**2 <= 100
+]
+"""
+A list of points in a filled circle of radius 10.
+
+This is the area around a player, in chunks, which they can see.
+"""
+
 def split_coords(x, z):
     """
     Split a pair of coordinates into chunk and subchunk coordinates.
@@ -3,9 +3,11 @@ from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.template import flattenString, renderer, tags, Element, XMLString
 
 from bravo import version
+from bravo.chunk import packet_cache_stats
 from bravo.factories.beta import BravoFactory
 from bravo.ibravo import IWorldResource
 from bravo.plugin import retrieve_plugins
+from bravo.protocols.beta import PacketQueue
 
 root_template = """
 <html xmlns:t="http://twistedmatrix.com/ns/twisted.web.template/0.1">
@@ -94,13 +96,54 @@ class BravoWorldElement(Element):
         l.append(tags.li("Total chunks: %d" % total))
         l.append(tags.li("Clean chunks: %d" % len(world.chunk_cache)))
         l.append(tags.li("Dirty chunks: %d" % len(world.dirty_chunk_cache)))
-        l.append(tags.li("Chunks being generated: %d" %
+        l.append(tags.li("Chunks being written: %d" % len(world._writing)))
+        if world.writes:
+            l.append(tags.li("Chunk writes: %d, %d KiB, %.1f ms average, "
+                "%.1f ms last" % (world.writes, world.write_bytes // 1024,
+                world.write_time * 1000 / world.writes,
+                world.write_latency * 1000)))
+            l.append(tags.li("Disk: held %.1f ms by the last write, waited "
+                "on for %.1f ms by loads" % (world.disk_held * 1000,
+                world.disk_waited * 1000)))
+        cache = world.chunk_cache
+        l.append(tags.li("Chunk cache: %d hits, %d misses, %d evictions" %
+            (cache.hits, cache.misses, cache.evictions)))
+        l.append(tags.li("Chunk cache size: %d KiB of %d KiB" %
+            (cache.bytes // 1024, cache.budget // 1024)))
+        l.append(tags.li("Chunks being loaded or generated: %d" %
             len(world._pending_chunks)))
+        pool = world.generation_pool
+        if pool is not None:
+            l.append(tags.li("Chunks waiting for generation: %d" %
+                len(pool.queue)))
+            if pool.generated:
+                l.append(tags.li("Chunks generated: %d, %.1f ms waiting, "
+                    "%.1f ms generating on average" % (pool.generated,
+                    pool.wait_time * 1000 / pool.generated,
+                    pool.compute_time * 1000 / pool.generated)))
+        prefetcher = world.prefetcher
+        if prefetcher is not None:
+            l.append(tags.li("Chunk prefetching: %d requests, %d hits, "
+                "%d cancelled, %d wasted" % (prefetcher.requests,
+                prefetcher.hits, prefetcher.cancelled, prefetcher.wasted)))
         if world.permanent_cache:
             l.append(tags.li("Permanent cache: enabled, %d chunks" %
                 len(world.permanent_cache)))
         else:
             l.append(tags.li("Permanent cache: disabled"))
+        l.append(tags.li("Chunk packet cache: %(hits)d hits, %(misses)d misses"
+            % packet_cache_stats))
+        tracker = self.factory.tracker
+        l.append(tags.li("Movement packets: %d relative, %d absolute" %
+            (tracker.relative, tracker.absolute)))
+        sent = {"interactive": 0, "bulk": 0}
+        for protocol in self.factory.protocols.itervalues():
+            if isinstance(protocol.transport, PacketQueue):
+                for name, count in protocol.transport.bytes.iteritems():
+                    sent[name] += count
+        l.append(tags.li("Sent to connected players: %d KiB interactive, "
+            "%d KiB chunk data" % (sent["interactive"] // 1024,
+            sent["bulk"] // 1024)))
         status = tags.ul(*l)
         return tag(tags.h2("Status"), status)
 
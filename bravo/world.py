@@ -1,15 +1,20 @@
+from collections import OrderedDict
 from functools import wraps
-from itertools import product
+from itertools import chain, product
 import random
 import sys
+from threading import Lock
+from time import time
 import weakref
 
-from numpy import fromstring, uint8
-
-from twisted.internet.defer import (inlineCallbacks, maybeDeferred,
+from twisted.internet import reactor
+from twisted.internet.defer import (CancelledError, Deferred, DeferredList,
+                                    inlineCallbacks, maybeDeferred,
                                     returnValue, succeed)
 from twisted.internet.task import coiterate, LoopingCall
+from twisted.internet.threads import deferToThreadPool
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 
 from bravo.chunk import Chunk
 from bravo.config import configuration
@@ -18,7 +23,8 @@ from bravo.errors import ChunkNotLoaded, SerializerReadException
 from bravo.ibravo import ISerializer, ISerializerFactory
 from bravo.plugin import (retrieve_named_plugins, verify_plugin,
     PluginException)
-from bravo.utilities.coords import split_coords
+from bravo.remote import GenerationPool
+from bravo.utilities.coords import circle, split_coords
 from bravo.utilities.temporal import PendingEvent
 
 def coords_to_chunk(f):
@@ -63,6 +69,313 @@ def sync_coords_to_chunk(f):
 
     return decorated
 
+def light_reach(lower, upper, dx, dz):
+    """
+    Find the part of a neighbouring chunk which light from a region of a
+    chunk can reach.
+
+    :param tuple lower: lower corner of the region, inclusive
+    :param tuple upper: upper corner of the region, exclusive
+    :param int dx: X offset of the neighbour, in chunk coords
+    :param int dz: Z offset of the neighbour, in chunk coords
+    :returns: tuple of the lower and upper corners of the reachable region,
+        in the neighbour's coordinates, or None if it is out of reach
+    """
+
+    lx, ly, lz = lower
+    ux, uy, uz = upper
+
+    lower = (max(lx - 15 - dx * 16, 0), max(ly - 15, 0),
+        max(lz - 15 - dz * 16, 0))
+    upper = (min(ux + 15 - dx * 16, 16), min(uy + 15, 128),
+        min(uz + 15 - dz * 16, 16))
+
+    if lower[0] >= upper[0] or lower[2] >= upper[2]:
+        return None
+
+    return lower, upper
+
+class ChunkCache(object):
+    """
+    A cache of clean chunks, which evicts the least recently used chunks.
+
+    The cache holds on to chunks until they take up more than a budget of
+    bytes, or until they haven't been used for a while. Evicted chunks which
+    are still referenced elsewhere can still be found in the cache, so that
+    there is never more than one copy of a chunk.
+
+    :ivar int hits: number of chunks found by ``get()``
+    :ivar int misses: number of chunks not found by ``get()``
+    :ivar int evictions: number of chunks evicted
+    :ivar int bytes: bytes taken up by the cached chunks, as of the last
+        ``prune()``
+    """
+
+    hits = 0
+    misses = 0
+    evictions = 0
+    bytes = 0
+
+    def __init__(self, budget, ttl, clock=reactor):
+        """
+        :param int budget: size of the cache, in bytes
+        :param int ttl: how long unused chunks are cached, in seconds
+        :param clock: provider of ``seconds()``
+        """
+
+        self.budget = budget
+        self.ttl = ttl
+        self.clock = clock
+
+        # Chunks and the times they were last used, oldest first.
+        self.entries = OrderedDict()
+        self.evicted = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.entries) + len(self.evicted)
+
+    def __contains__(self, coords):
+        return coords in self.entries or coords in self.evicted
+
+    def __getitem__(self, coords):
+        if coords in self.entries:
+            chunk = self.entries.pop(coords)[0]
+        else:
+            # Raises KeyError for us.
+            chunk = self.evicted.pop(coords)
+
+        self.entries[coords] = [chunk, self.clock.seconds()]
+        return chunk
+
+    def __setitem__(self, coords, chunk):
+        self.evicted.pop(coords, None)
+        self.entries.pop(coords, None)
+        self.entries[coords] = [chunk, self.clock.seconds()]
+
+    def __delitem__(self, coords):
+        if coords in self.entries:
+            del self.entries[coords]
+        else:
+            del self.evicted[coords]
+
+    def get(self, coords, default=None):
+        """
+        Get a chunk, keeping track of hits and misses.
+        """
+
+        if coords in self:
+            self.hits += 1
+            return self[coords]
+
+        self.misses += 1
+        return default
+
+    def iterkeys(self):
+        return chain(self.entries.iterkeys(), self.evicted.iterkeys())
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        return chain(((coords, entry[0])
+            for coords, entry in self.entries.iteritems()),
+            self.evicted.iteritems())
+
+    def itervalues(self):
+        return (chunk for coords, chunk in self.iteritems())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def clear(self):
+        self.entries.clear()
+        self.evicted.clear()
+
+    def prune(self, pinned=()):
+        """
+        Evict chunks which are over budget or haven't been used for a while.
+
+        :param pinned: coordinates of chunks which must not be evicted
+        """
+
+        now = self.clock.seconds()
+        self.bytes = sum(entry[0].nbytes
+            for entry in self.entries.itervalues())
+
+        for coords, (chunk, used) in self.entries.items():
+            if coords in pinned:
+                # Pinned chunks are in use.
+                self[coords]
+                continue
+
+            if self.bytes <= self.budget and now - used < self.ttl:
+                # Everything else was used more recently.
+                break
+
+            del self.entries[coords]
+            self.evicted[coords] = chunk
+            self.bytes -= chunk.nbytes
+            self.evictions += 1
+
+class Prefetcher(object):
+    """
+    Requests chunks ahead of moving players, before they need them.
+
+    Each player's velocity is estimated from the changes in their location.
+    The chunks which would come into view if they kept going for a while are
+    requested speculatively, at a low priority. Speculation which no longer
+    matches where a player is heading is withdrawn, and cancelled if no work
+    has been done for it yet.
+
+    :ivar int requests: number of chunks requested speculatively
+    :ivar int hits: number of speculatively requested chunks which were
+        requested for real afterwards
+    :ivar int cancelled: number of speculative requests withdrawn before any
+        work was done for them
+    :ivar int wasted: number of speculative requests withdrawn after their
+        chunks were loaded or generated, or while they were
+    """
+
+    requests = 0
+    hits = 0
+    cancelled = 0
+    wasted = 0
+
+    def __init__(self, world, lookahead, view=circle, clock=reactor):
+        """
+        :param `World` world: the world to request chunks from
+        :param float lookahead: how far ahead to look, in seconds
+        :param list view: the chunks around a player which they can see,
+                          relative to the chunk they're in
+        :param clock: provider of ``seconds()``
+        """
+
+        self.world = world
+        self.lookahead = lookahead
+        self.view = view
+        self.clock = clock
+
+        # The time and place each player was last seen, and their velocity,
+        # in blocks per second.
+        self.tracks = {}
+        # The chunk each player is heading for, and the chunks they would
+        # see there which they can't see yet.
+        self.predictions = {}
+        # The players which speculated on each chunk.
+        self.speculative = {}
+
+    def moved(self, name, location):
+        """
+        Track a player's movement, and speculate on where they're heading.
+
+        :param str name: the player's name
+        :param `Location` location: the player's new location
+        """
+
+        now = self.clock.seconds()
+        x, z = location.x, location.z
+        vx = vz = 0
+
+        if name in self.tracks:
+            then, lastx, lastz, vx, vz = self.tracks[name]
+            elapsed = now - then
+            if elapsed > self.lookahead:
+                # The old velocity is too stale to go on.
+                vx = vz = 0
+            elif elapsed > 0:
+                # Smooth out the jitter in location updates.
+                vx = (vx + (x - lastx) / elapsed) / 2
+                vz = (vz + (z - lastz) / elapsed) / 2
+
+        self.tracks[name] = now, x, z, vx, vz
+
+        current = int(x // 16), int(z // 16)
+        ahead = (int((x + vx * self.lookahead) // 16),
+            int((z + vz * self.lookahead) // 16))
+
+        if name in self.predictions:
+            previous, old = self.predictions[name]
+            if ahead == previous:
+                return
+        else:
+            old = set()
+
+        if ahead == current:
+            new = set()
+        else:
+            new = (set((ahead[0] + i, ahead[1] + j) for i, j in self.view) -
+                set((current[0] + i, current[1] + j) for i, j in self.view))
+
+        self.predictions[name] = ahead, new
+
+        for coords in old - new:
+            self.withdraw(name, coords)
+        for coords in sorted(new - old, key=lambda (i, j):
+            (i - ahead[0])**2 + (j - ahead[1])**2):
+            self.speculate(name, coords)
+
+    def forget(self, name):
+        """
+        Stop tracking a player, and withdraw their speculation.
+        """
+
+        self.tracks.pop(name, None)
+        if name in self.predictions:
+            ahead, old = self.predictions.pop(name)
+            for coords in old:
+                self.withdraw(name, coords)
+
+    def speculate(self, name, coords):
+        """
+        Request a chunk on behalf of a player who might want it.
+        """
+
+        if coords in self.speculative:
+            self.speculative[coords].add(name)
+            return
+
+        world = self.world
+        if (coords in world.chunk_cache or coords in world.dirty_chunk_cache
+            or coords in world._pending_chunks):
+            return
+
+        d = world.request_chunk(*coords)
+        @d.addErrback
+        def eb(failure):
+            failure.trap(CancelledError)
+
+        self.speculative[coords] = set([name])
+        self.requests += 1
+
+    def withdraw(self, name, coords):
+        """
+        Withdraw a player's speculation on a chunk.
+
+        Once nobody is speculating on the chunk any longer, it is cancelled
+        if that's still possible.
+        """
+
+        names = self.speculative.get(coords)
+        if names is None:
+            return
+
+        names.discard(name)
+        if names:
+            return
+
+        del self.speculative[coords]
+        if self.world.cancel_chunk(*coords):
+            self.cancelled += 1
+        else:
+            self.wasted += 1
+
+    def claim(self, coords):
+        """
+        Note that a chunk has been requested for real.
+        """
+
+        if self.speculative.pop(coords, None) is not None:
+            self.hits += 1
+
 class World(object):
     """
     Object representing a world on disk.
@@ -81,9 +394,14 @@ class World(object):
     Whether objects belonging to this world may be written out to disk.
     """
 
-    async = False
+    generation_pool = None
+    """
+    The processes which generate chunks for this world, if any.
+    """
+
+    prefetcher = None
     """
-    Whether this world is using multiprocessing methods to generate geometry.
+    The `Prefetcher` which requests chunks ahead of players, if any.
     """
 
     dimension = "earth"
@@ -98,6 +416,21 @@ class World(object):
     This cache is used to speed up logins near the spawn point.
     """
 
+    factory = None
+    """
+    The factory serving this world, if any.
+    """
+
+    write_pool = None
+    """
+    The thread which writes chunks to disk, if any.
+    """
+
+    read_pool = None
+    """
+    The thread which loads chunks from disk, if any.
+    """
+
     spawn = (0, 0, 0)
     """
     The spawn point.
@@ -120,10 +453,53 @@ class World(object):
 
         self.config_name = "world %s" % name
 
-        self.chunk_cache = weakref.WeakValueDictionary()
-        self.dirty_chunk_cache = dict()
+        budget = configuration.getintdefault(self.config_name, "cache_size",
+            64)
+        ttl = configuration.getintdefault(self.config_name, "cache_ttl", 300)
+        self.chunk_cache = ChunkCache(budget * 1024 * 1024, ttl)
+        self.dirty_chunk_cache = OrderedDict()
+
+        self.save_limit = configuration.getintdefault(self.config_name,
+            "save_chunks", 8)
+        self.save_rate = configuration.getintdefault(self.config_name,
+            "save_rate", 0) * 1024
+
+        # Write-back statistics.
+        self.writes = 0
+        self.write_bytes = 0
+        self.write_time = 0.0
+        self.write_latency = 0.0
+        self.write_debt = 0
+
+        # How long the disk was last held for a write, and how long loads
+        # have waited for the disk in all.
+        self.disk_held = 0.0
+        self.disk_waited = 0.0
+
+        # Serializers aren't thread-safe, so only one thread may touch chunks
+        # on disk at a time. Writes hold the disk through a whole batch,
+        # syncs and all, which can take a good fraction of a second; the
+        # reactor must never wait on it, so only the reader and writer
+        # threads take this lock, along with saves which block on purpose.
+        self.disk_lock = Lock()
 
         self._pending_chunks = dict()
+        self._pending_loads = []
+
+        # The regions of unloaded chunks which need relighting against their
+        # neighbours once they are loaded, keyed by the chunk's coordinates
+        # and then by the neighbour's offset. These are only kept in memory.
+        self._pending_edges = dict()
+
+        # The generations of expanded chunks, as of the last time idle
+        # chunks were compacted.
+        self._generations = dict()
+
+        # Chunks being written in the background, and the sequence numbers of
+        # the newest records encoded for each chunk.
+        self._writing = dict()
+        self._latest = dict()
+        self._sequence = 0
 
     def start(self):
         """
@@ -140,16 +516,20 @@ class World(object):
             log.msg(pe)
             raise RuntimeError("Fatal error: Couldn't set up serializer!")
 
+        self.serializer.recover()
+
         self.seed = random.randint(0, sys.maxint)
 
-        # Check if we should offload chunk requests to ampoule.
-        if configuration.getbooleandefault("bravo", "ampoule", False):
-            try:
-                import ampoule
-                if ampoule:
-                    self.async = True
-            except ImportError:
-                pass
+        # Start the generation processes before any threads are started, so
+        # that they don't inherit them.
+        processes = configuration.getintdefault(self.config_name,
+            "generation_processes", 0)
+        if processes > 0:
+            generators = configuration.getlistdefault(self.config_name,
+                "generators", [])
+            self.generation_pool = GenerationPool(processes, generators)
+            self.generation_pool.priority = self.chunk_priority
+            self.generation_pool.start()
 
         # First, try loading the level, to see if there's any data out there
         # which we can use. If not, don't worry about it.
@@ -165,12 +545,28 @@ class World(object):
         if self.saving:
             self.serializer.save_level(self)
 
+        self.write_pool = ThreadPool(0, 1, "%s writer" % self.config_name)
+        self.write_pool.start()
+        self.read_pool = ThreadPool(0, 1, "%s reader" % self.config_name)
+        self.read_pool.start()
+
         self.chunk_management_loop = LoopingCall(self.sort_chunks)
         self.chunk_management_loop.start(1)
 
         log.msg("World started on %s, using serializer %s" %
             (world_url, self.serializer.name))
-        log.msg("Using Ampoule: %s" % self.async)
+        if self.generation_pool is not None:
+            log.msg("Generating chunks in %d processes" % processes)
+
+        lookahead = configuration.getintdefault(self.config_name, "prefetch",
+            0)
+        if lookahead > 0:
+            if self.generation_pool is None:
+                # Speculative chunks would be generated right away, in the
+                # reactor, and couldn't be cancelled.
+                log.msg("Not prefetching chunks without generation processes")
+            else:
+                self.prefetcher = Prefetcher(self, lookahead)
 
     def stop(self):
         """
@@ -185,9 +581,29 @@ class World(object):
 
         self.chunk_management_loop.stop()
 
-        # Flush all dirty chunks to disk.
-        for chunk in self.dirty_chunk_cache.itervalues():
-            self.save_chunk(chunk)
+        if self.generation_pool is not None:
+            self.generation_pool.stop()
+            self.generation_pool = None
+
+        # Let any loads and writes in progress finish.
+        if self.read_pool is not None:
+            self.read_pool.stop()
+            self.read_pool = None
+
+        if self.write_pool is not None:
+            self.write_pool.stop()
+            self.write_pool = None
+
+        # Relighting a chunk can dirty its neighbours, wherever they are
+        # cached, so every chunk is relit before any of them are saved.
+        chunks = list(chain(self.chunk_cache.itervalues(),
+            self.dirty_chunk_cache.itervalues()))
+        for chunk in chunks:
+            self.relight_chunk(chunk)
+
+        # Flush all dirty chunks to disk, including the ones which were
+        # dirtied since the caches were last sorted.
+        self.save_chunks([chunk for chunk in chunks if chunk.dirty])
 
         # Evict all chunks.
         self.chunk_cache.clear()
@@ -196,6 +612,9 @@ class World(object):
         # Save the level data.
         self.serializer.save_level(self)
 
+        # And let go of the files on disk.
+        self.serializer.close()
+
     def enable_cache(self, size):
         """
         Set the permanent cache size.
@@ -221,33 +640,142 @@ class World(object):
 
         rx = xrange(x - size, x + size)
         rz = xrange(z - size, z + size)
-        d = coiterate(self.request_chunk(x, z).addCallback(assign)
-            for x, z in product(rx, rz))
+
+        # Request a row of chunks at a time, so that they can be loaded
+        # together, without generating every missing chunk in one go.
+        d = coiterate(DeferredList([self.request_chunk(x, z)
+            .addCallback(assign) for z in rz]) for x in rx)
         d.addCallback(lambda chaff: log.msg("Cache size is now %d" % size))
 
     def sort_chunks(self):
         """
         Sort out the internal caches.
 
-        This method will always block when there are dirty chunks.
-        """
+        Chunks which have been dirtied are moved to the dirty cache. The
+        dirty chunks which have waited the longest are then written back
+        together in the background, up to ``save_chunks`` chunks and
+        ``save_rate`` KiB each second, and move back to the clean cache once
+        they are written. Afterwards, idle chunks are compacted, and the
+        clean cache is pruned.
 
-        first = True
+        A chunk which is dirtied again while it is being written is not
+        written twice at once; it is simply written again later.
+        """
 
-        all_chunks = dict(self.dirty_chunk_cache)
-        all_chunks.update(self.chunk_cache)
-        self.chunk_cache.clear()
-        self.dirty_chunk_cache.clear()
-        for coords, chunk in all_chunks.iteritems():
+        for coords, chunk in self.chunk_cache.items():
             if chunk.dirty:
-                if first:
-                    first = False
-                    self.save_chunk(chunk)
+                del self.chunk_cache[coords]
+                self.dirty_chunk_cache[coords] = chunk
+
+        self.write_debt = max(0, self.write_debt - self.save_rate)
+
+        if self.saving and not (self.save_rate and
+            self.write_debt >= self.save_rate):
+            chunks = []
+            for coords, chunk in self.dirty_chunk_cache.items():
+                if len(chunks) >= self.save_limit:
+                    break
+
+                if coords in self._writing:
+                    continue
+
+                if not chunk.dirty:
+                    # Saved by somebody else in the meantime.
+                    del self.dirty_chunk_cache[coords]
                     self.chunk_cache[coords] = chunk
-                else:
-                    self.dirty_chunk_cache[coords] = chunk
+                    continue
+
+                chunks.append(chunk)
+
+            if chunks:
+                self.write_back(chunks)
+
+        self.compact_chunks()
+        self.chunk_cache.prune(self.pinned_chunks())
+
+    def compact_chunks(self):
+        """
+        Compact the chunks which haven't changed since the last time around.
+
+        Chunks which are still being changed are left expanded, since they
+        would only be expanded again straight away.
+        """
+
+        generations = {}
+
+        for coords, chunk in chain(self.chunk_cache.iteritems(),
+            self.dirty_chunk_cache.iteritems()):
+            if chunk.layers is None:
+                continue
+
+            if self._generations.get(coords) == chunk.generation:
+                chunk.compact()
             else:
-                self.chunk_cache[coords] = chunk
+                generations[coords] = chunk.generation
+
+        self._generations = generations
+
+    def pinned_chunks(self):
+        """
+        Get the coordinates of the chunks which should stay in memory.
+
+        Chunks in the permanent cache, and chunks which any player has loaded,
+        are pinned.
+
+        :rtype: set
+        """
+
+        pinned = set()
+
+        if self.permanent_cache:
+            pinned.update((chunk.x, chunk.z) for chunk in self.permanent_cache)
+
+        if self.factory is not None:
+            for protocol in self.factory.protocols.itervalues():
+                pinned.update(protocol.chunks)
+
+        return pinned
+
+    def chunk_priority(self, x, z):
+        """
+        Get the priority with which a chunk should be generated.
+
+        Chunks which are only wanted speculatively come last, and chunks
+        closer to players come first.
+
+        :returns: tuple of whether the chunk is speculative, and the distance,
+                  in chunks, to the closest player, or 0 if there are no
+                  players
+        """
+
+        distance = None
+
+        if self.factory is not None:
+            for protocol in self.factory.protocols.itervalues():
+                px = protocol.location.x // 16
+                pz = protocol.location.z // 16
+                d = max(abs(px - x), abs(pz - z))
+                if distance is None or d < distance:
+                    distance = d
+
+        speculative = (self.prefetcher is not None and
+            (x, z) in self.prefetcher.speculative)
+
+        return speculative, distance or 0
+
+    def cancel_chunk(self, x, z):
+        """
+        Cancel the generation of a chunk, if it hasn't started yet.
+
+        Anybody waiting on the chunk gets a ``CancelledError``.
+
+        :returns: bool of whether the chunk was cancelled
+        """
+
+        if self.generation_pool is None:
+            return False
+
+        return self.generation_pool.cancel(x, z)
 
     def save_off(self):
         """
@@ -257,11 +785,6 @@ class World(object):
         interfering, for backing up the world.
         """
 
-        if not self.saving:
-            return
-
-        d = dict(self.chunk_cache)
-        self.chunk_cache = d
         self.saving = False
 
     def save_on(self):
@@ -269,11 +792,6 @@ class World(object):
         Enable saving to disk.
         """
 
-        if self.saving:
-            return
-
-        d = weakref.WeakValueDictionary(self.chunk_cache)
-        self.chunk_cache = d
         self.saving = True
 
     def postprocess_chunk(self, chunk):
@@ -309,50 +827,51 @@ class World(object):
         :returns: ``Deferred`` that will be called with the ``Chunk``
         """
 
-        if (x, z) in self.chunk_cache:
-            returnValue(self.chunk_cache[x, z])
-        elif (x, z) in self.dirty_chunk_cache:
+        if self.prefetcher is not None:
+            self.prefetcher.claim((x, z))
+
+        if (x, z) in self.dirty_chunk_cache:
             returnValue(self.dirty_chunk_cache[x, z])
+
+        chunk = self.chunk_cache.get((x, z))
+        if chunk is not None:
+            returnValue(chunk)
         elif (x, z) in self._pending_chunks:
             # Rig up another Deferred and wrap it up in a to-go box.
             retval = yield self._pending_chunks[x, z].deferred()
             returnValue(retval)
 
+        # Set up our event and generate our return-value Deferred. It has to
+        # be done early becaues PendingEvents only fire exactly once and it
+        # might fire immediately in certain cases. Anybody else asking for
+        # this chunk while it is loaded or generated will wait on it, too.
+        pe = PendingEvent()
+        # This one is for our return value.
+        retval = pe.deferred()
+        # This one is for scanning the chunk for automatons.
+        #pe.deferred().addCallback(self.factory.scan_chunk)
+        self._pending_chunks[x, z] = pe
+
         chunk = Chunk(x, z)
-        yield maybeDeferred(self.serializer.load_chunk, chunk)
+        try:
+            yield self.load_chunk(chunk)
+        except Exception:
+            del self._pending_chunks[x, z]
+            pe.errback()
+            retval = yield retval
 
         if chunk.populated:
             self.chunk_cache[x, z] = chunk
+            del self._pending_chunks[x, z]
             self.postprocess_chunk(chunk)
+            self.stitch_chunk(chunk)
             #self.factory.scan_chunk(chunk)
-            returnValue(chunk)
+            pe.callback(chunk)
+            retval = yield retval
+            returnValue(retval)
 
-        if self.async:
-            from ampoule import deferToAMPProcess
-            from bravo.remote import MakeChunk
-
-            d = deferToAMPProcess(MakeChunk,
-                x=x,
-                z=z,
-                seed=self.seed,
-                generators=configuration.getlist(self.config_name, "generators")
-            )
-
-            # Get chunk data into our chunk object.
-            def fill_chunk(kwargs):
-                chunk.blocks = fromstring(kwargs["blocks"],
-                    dtype=uint8).reshape(chunk.blocks.shape)
-                chunk.heightmap = fromstring(kwargs["heightmap"],
-                    dtype=uint8).reshape(chunk.heightmap.shape)
-                chunk.metadata = fromstring(kwargs["metadata"],
-                    dtype=uint8).reshape(chunk.metadata.shape)
-                chunk.skylight = fromstring(kwargs["skylight"],
-                    dtype=uint8).reshape(chunk.skylight.shape)
-                chunk.blocklight = fromstring(kwargs["blocklight"],
-                    dtype=uint8).reshape(chunk.blocklight.shape)
-
-                return chunk
-            d.addCallback(fill_chunk)
+        if self.generation_pool is not None:
+            d = self.generation_pool.generate(chunk, self.seed)
         else:
             # Populate the chunk the slow way. :c
             for stage in self.pipeline:
@@ -361,16 +880,6 @@ class World(object):
             chunk.regenerate()
             d = succeed(chunk)
 
-        # Set up our event and generate our return-value Deferred. It has to
-        # be done early becaues PendingEvents only fire exactly once and it
-        # might fire immediately in certain cases.
-        pe = PendingEvent()
-        # This one is for our return value.
-        retval = pe.deferred()
-        # This one is for scanning the chunk for automatons.
-        #pe.deferred().addCallback(self.factory.scan_chunk)
-        self._pending_chunks[x, z] = pe
-
         def pp(chunk):
             chunk.populated = True
             chunk.dirty = True
@@ -380,10 +889,22 @@ class World(object):
             self.dirty_chunk_cache[x, z] = chunk
             del self._pending_chunks[x, z]
 
+            # New chunks were lit on their own, so every border is relit, as
+            # far as light from each neighbour can reach.
+            for dx, dz in product((-1, 0, 1), repeat=2):
+                if dx or dz:
+                    self.queue_edge(x, z, dx, dz, *light_reach((0, 0, 0),
+                        (16, 128, 16), -dx, -dz))
+            self.stitch_chunk(chunk)
+
             return chunk
 
+        def failed(failure):
+            del self._pending_chunks[x, z]
+            return failure
+
         # Set up callbacks.
-        d.addCallback(pp)
+        d.addCallbacks(pp, failed)
         d.chainDeferred(pe)
 
         # Because multiple people might be attached to this callback, we're
@@ -396,15 +917,342 @@ class World(object):
         retval = yield retval
         returnValue(retval)
 
-    def save_chunk(self, chunk):
+    def load_chunk(self, chunk):
+        """
+        Load a chunk from disk.
+
+        Loads are put off until the reactor comes around again, and then
+        every chunk which was requested in the meantime is loaded at once.
+
+        :returns: ``Deferred`` that will fire once the chunk has been loaded
+        """
+
+        if not self._pending_loads:
+            reactor.callLater(0, self.load_pending_chunks)
+
+        d = Deferred()
+        self._pending_loads.append((chunk, d))
+        return d
+
+    def load_pending_chunks(self):
+        """
+        Load every chunk waiting to be loaded.
+        """
+
+        loads = self._pending_loads
+        self._pending_loads = []
+
+        d = self.read_chunks([chunk for chunk, chaff in loads])
+
+        def loaded(chaff):
+            for chunk, d in loads:
+                d.callback(chunk)
+
+        def failed(failure):
+            # Find the culprits by loading the chunks one at a time.
+            for chunk, d in loads:
+                e = self.read_chunks([chunk])
+                e.addCallback(lambda chaff, chunk=chunk: chunk)
+                e.chainDeferred(d)
+
+        d.addCallbacks(loaded, failed)
+
+    def read_chunks(self, chunks):
+        """
+        Load chunks from disk without blocking.
+
+        The chunks are loaded by the reader thread, which waits its turn for
+        the disk while the writer thread is writing. The reactor never has to
+        wait.
+
+        :returns: ``Deferred`` that will fire once the chunks have been loaded
+        """
+
+        def read():
+            started = time()
+            with self.disk_lock:
+                self.disk_waited += time() - started
+                self.serializer.load_chunks(chunks)
+
+        if self.read_pool is None:
+            return maybeDeferred(read)
+
+        return deferToThreadPool(reactor, self.read_pool, read)
+
+    def loaded_chunk(self, x, z):
+        """
+        Get a chunk, if it is already loaded.
+
+        :returns: the ``Chunk``, or None if it is not loaded
+        """
+
+        if (x, z) in self.chunk_cache:
+            return self.chunk_cache[x, z]
+        elif (x, z) in self.dirty_chunk_cache:
+            return self.dirty_chunk_cache[x, z]
+
+        return None
+
+    def neighbors(self, chunk):
+        """
+        Get the loaded neighbours of a chunk, including the diagonal ones.
 
-        if not chunk.dirty or not self.saving:
+        :returns: dict of ``Chunk``s, keyed by their offsets from the chunk
+        """
+
+        d = {}
+
+        for dx, dz in product((-1, 0, 1), repeat=2):
+            if not dx and not dz:
+                continue
+
+            neighbor = self.loaded_chunk(chunk.x + dx, chunk.z + dz)
+            if neighbor is not None:
+                d[dx, dz] = neighbor
+
+        return d
+
+    def propagate_light(self, chunk, lower=(0, 0, 0), upper=(16, 128, 16)):
+        """
+        Relight a region of a chunk, and the parts of its neighbours within
+        reach of the region.
+
+        The region's block light is regenerated with the light sources of
+        the neighbours, and so is the block light of the neighbours around
+        it. Skylight is regenerated across the borders in both directions;
+        light which the region no longer lets through is taken away from the
+        neighbours as well. Only chunks whose lighting actually changed are
+        marked dirty.
+
+        If the chunk's lighting changed, the parts of the neighbours which
+        aren't loaded, but are within reach of the region, are queued to be
+        relit by :meth:`stitch_chunk` once they are loaded.
+
+        :param tuple lower: lower corner of the region, inclusive
+        :param tuple upper: upper corner of the region, exclusive
+        """
+
+        neighbors = self.neighbors(chunk)
+        generations = dict((coords, neighbor.generation)
+            for coords, neighbor in neighbors.iteritems())
+
+        changed = chunk.regenerate_blocklight(lower, upper, neighbors)
+
+        for (dx, dz), neighbor in neighbors.iteritems():
+            region = light_reach(lower, upper, dx, dz)
+            if region is not None:
+                neighbor.regenerate_blocklight(region[0], region[1],
+                    self.neighbors(neighbor))
+
+        changed |= chunk.regenerate_skylight(lower, upper, neighbors)
+
+        if changed:
+            chunk.dirty = True
+
+            for dx, dz in product((-1, 0, 1), repeat=2):
+                if (dx or dz) and (dx, dz) not in neighbors:
+                    region = light_reach(lower, upper, dx, dz)
+                    if region is not None:
+                        self.queue_edge(chunk.x + dx, chunk.z + dz, -dx, -dz,
+                            *region)
+
+        for coords, neighbor in neighbors.iteritems():
+            if neighbor.generation != generations[coords]:
+                neighbor.dirty = True
+
+    def queue_edge(self, x, z, dx, dz, lower, upper):
+        """
+        Queue a region of an unloaded chunk to be relit against one of its
+        neighbours, once it is loaded.
+
+        Regions queued against the same neighbour are merged.
+
+        :param int x: X coordinate of the chunk, in chunk coords
+        :param int z: Z coordinate of the chunk, in chunk coords
+        :param int dx: X offset of the neighbour, in chunk coords
+        :param int dz: Z offset of the neighbour, in chunk coords
+        :param tuple lower: lower corner of the region, inclusive
+        :param tuple upper: upper corner of the region, exclusive
+        """
+
+        edges = self._pending_edges.setdefault((x, z), {})
+        if (dx, dz) in edges:
+            oldlower, oldupper = edges[dx, dz]
+            lower = tuple(min(i, j) for i, j in zip(lower, oldlower))
+            upper = tuple(max(i, j) for i, j in zip(upper, oldupper))
+        edges[dx, dz] = lower, upper
+
+    def relight_chunk(self, chunk):
+        """
+        Bring a chunk's lighting up to date after it has been edited.
+
+        Edits only mark the lighting around them as out of date; the whole
+        region is relit at once here, along with the chunk's neighbours
+        around it. This should be done before the chunk is sent or saved.
+        """
+
+        if chunk.dirty_light is None:
             return
 
-        self.serializer.save_chunk(chunk)
+        lower, upper = chunk.dirty_light
+        chunk.dirty_light = None
+
+        self.propagate_light(chunk, lower, upper)
+
+    def stitch_chunk(self, chunk):
+        """
+        Bring a freshly loaded chunk's lighting in line with its neighbours.
+
+        Only the regions which were queued while this chunk wasn't loaded are
+        relit, against the neighbours which changed since; a chunk which was
+        loaded without any queued edges is left alone. Edges queued against
+        neighbours which have since been unloaded are handed over to those
+        neighbours, to be relit against this chunk once they are loaded.
+        """
+
+        edges = self._pending_edges.pop((chunk.x, chunk.z), None)
+        if not edges:
+            return
+
+        neighbors = self.neighbors(chunk)
+        lower = upper = None
+
+        for (dx, dz), (l, u) in edges.iteritems():
+            if (dx, dz) in neighbors:
+                if lower is None:
+                    lower, upper = l, u
+                else:
+                    lower = tuple(min(i, j) for i, j in zip(lower, l))
+                    upper = tuple(max(i, j) for i, j in zip(upper, u))
+            else:
+                region = light_reach(l, u, dx, dz)
+                if region is not None:
+                    self.queue_edge(chunk.x + dx, chunk.z + dz, -dx, -dz,
+                        *region)
+
+        if lower is not None:
+            self.propagate_light(chunk, lower, upper)
+
+    def encode_chunk(self, chunk):
+        """
+        Encode a dirty chunk for writing, and mark it clean.
+
+        Every record is numbered, so that older records of a chunk are never
+        written over newer ones.
 
+        :returns: tuple of the record and its sequence number
+        """
+
+        self.relight_chunk(chunk)
+        record = self.serializer.encode_chunk(chunk)
+        chunk.compact()
         chunk.dirty = False
 
+        self._sequence += 1
+        self._latest[chunk.x, chunk.z] = self._sequence
+
+        return record, self._sequence
+
+    def write_records(self, records):
+        """
+        Write encoded chunks to disk, except for those which have been
+        superseded.
+
+        This method may be called from the writer thread.
+
+        :param records: list of (x, z, record, sequence) tuples
+        :returns: the number of bytes written, or None if unknown
+        """
+
+        with self.disk_lock:
+            started = time()
+            try:
+                records = [(x, z, record)
+                    for x, z, record, sequence in records
+                    if self._latest.get((x, z)) == sequence]
+                if not records:
+                    return 0
+                return self.serializer.write_chunks(records)
+            finally:
+                self.disk_held = time() - started
+
+    def write_back(self, chunks):
+        """
+        Save dirty chunks without blocking.
+
+        The chunks are encoded right away, and written together by the writer
+        thread.
+
+        :returns: ``Deferred`` that will fire once the chunks are written
+        """
+
+        started = time()
+        records = []
+        for chunk in chunks:
+            self._writing[chunk.x, chunk.z] = started
+            records.append((chunk.x, chunk.z) + self.encode_chunk(chunk))
+
+        if self.write_pool is None:
+            d = maybeDeferred(self.write_records, records)
+        else:
+            d = deferToThreadPool(reactor, self.write_pool,
+                self.write_records, records)
+
+        def written(count):
+            latency = time() - started
+            self.writes += len(chunks)
+            self.write_time += latency * len(chunks)
+            self.write_latency = latency
+            if count:
+                self.write_bytes += count
+                self.write_debt += count
+
+            for chunk, (x, z, record, sequence) in zip(chunks, records):
+                del self._writing[x, z]
+
+                if self._latest.get((x, z)) == sequence:
+                    del self._latest[x, z]
+
+                if not chunk.dirty and (x, z) in self.dirty_chunk_cache:
+                    del self.dirty_chunk_cache[x, z]
+                    self.chunk_cache[x, z] = chunk
+
+        def failed(failure):
+            for chunk in chunks:
+                del self._writing[chunk.x, chunk.z]
+                chunk.dirty = True
+            log.err(failure, "Couldn't save %d chunks" % len(chunks))
+
+        d.addCallbacks(written, failed)
+        return d
+
+    def save_chunk(self, chunk):
+        """
+        Save a dirty chunk, blocking until it is written.
+        """
+
+        self.save_chunks([chunk])
+
+    def save_chunks(self, chunks):
+        """
+        Save dirty chunks together, blocking until they are written.
+
+        This waits for the writer thread to finish whatever it is writing,
+        and then for the disk to sync, so it should only be used when the
+        world is stopping, or when somebody asked to wait.
+        """
+
+        if not self.saving:
+            return
+
+        records = [(chunk.x, chunk.z) + self.encode_chunk(chunk)
+            for chunk in chunks if chunk.dirty]
+        self.write_records(records)
+
+        for x, z, record, sequence in records:
+            if self._latest.get((x, z)) == sequence:
+                del self._latest[x, z]
+
     def load_player(self, username):
         """
         Retrieve player data.
@@ -5,7 +5,15 @@ import sys
 from bravo.nbt import NBTFile
 
 if len(sys.argv) < 2:
-    print "Usage: %s <file>" % __name__
+    print "Usage: %s <file> [path/to/tag]" % __name__
+    sys.exit(1)
 
-f = NBTFile(sys.argv[1])
-print f.pretty_tree()
+# Only the requested part of the file is parsed.
+tag = NBTFile(sys.argv[1], lazy=True)
+if len(sys.argv) > 2:
+    for name in sys.argv[2].split("/"):
+        if name.isdigit():
+            tag = tag.tags[int(name)]
+        else:
+            tag = tag[name]
+print tag.pretty_tree()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import sys
+
+from twisted.python.filepath import FilePath
+
+from bravo.region import compact_region
+
+if len(sys.argv) < 2:
+    print "Usage: %s <world or region file>..." % sys.argv[0]
+    sys.exit(1)
+
+total = 0
+
+for arg in sys.argv[1:]:
+    fp = FilePath(arg)
+
+    if fp.isdir():
+        if fp.child("region").isdir():
+            fp = fp.child("region")
+        regions = sorted(fp.globChildren("*.mcr"))
+    else:
+        regions = [fp]
+
+    for region in regions:
+        reclaimed = compact_region(region)
+        total += reclaimed
+        print "%s: reclaimed %d KiB" % (region.path, reclaimed // 1024)
+
+print "Reclaimed %d KiB in total" % (total // 1024)